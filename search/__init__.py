@@ -1,5 +1,6 @@
 import argparse
 import re
+import hashlib
 import os
 import sys
 import jinja2
@@ -88,11 +89,14 @@ class SearchGen:
         self._queryName = f'Query_{self._appName}'
 
         self._tranStmts = []
+        self._tranConds = []
         curTrans: TransmitTable = ir.table
         while len(curTrans.table) != 0:
             ((keyName, op), ds), = curTrans.table.items()
             (val, nxt), = ds.items()
-            self._tranStmts.append(f'if (!({_CPP_FIELDS[keyName][0]} {_CPP_CMPS[op]} {val})) return;')
+            cond = f'{_CPP_FIELDS[keyName][0]} {_CPP_CMPS[op]} {val}'
+            self._tranConds.append(cond)
+            self._tranStmts.append(f'if (!({cond})) return;')
             curTrans = nxt
 
         compUnit: CompUnit
@@ -102,6 +106,10 @@ class SearchGen:
         self._idxTypes = dict()
         self._regOrig = dict()
         self._regIdx = dict()
+        # index values each register is accessed with, and the expressions
+        # each index value is computed by if it depends on packet fields only
+        self._regIdxUses = dict()
+        self._idxExprs = dict()
         # self._resAssign = None
 
         def genStmt(v: StatementBase) -> str:
@@ -130,6 +138,7 @@ class SearchGen:
                 if v.register_table not in self._regIdx:
                     self._regIdx[v.register_table] = v.index
                     self._regOrig[v.register_table] = v.original_op
+                self._regIdxUses.setdefault(v.register_table, set()).add(v.index.get_id())
                 r = ''
 
                 # if _isResAssign(v):
@@ -145,6 +154,7 @@ class SearchGen:
 
             elif isinstance(v, StatementRegisterGet):
                 v: StatementRegisterGet
+                self._regIdxUses.setdefault(v.register_table, set()).add(v.index.get_id())
                 return f'{v.output.get_id()} = {v.register_table.get_id()}->get({v.index.get_id()});\n'
 
             elif isinstance(v, StatementCalcIndex):
@@ -160,6 +170,11 @@ class SearchGen:
                 rs = ', '.join(_getVal(x) for x in v.inputs)
                 if len(v.inputs) != 1:
                     rs = '{' + rs + '}'
+                exprs = self._idxExprs.setdefault(v.output.get_id(), set())
+                if all(type(x) == str and x in _CPP_FIELDS for x in v.inputs):
+                    exprs.add(rs)
+                else:
+                    exprs.add(None)
                 return f'{v.output.get_id()} = {rs};\n'
 
             elif isinstance(v, StatementSimpleCalc):
@@ -204,6 +219,11 @@ class SearchGen:
         for s in compUnit.resona.statements:
             self._stmts += genStmt(s)
 
+        # PktInfo fields read by the query, e.g. 'key.src_ip'; processColumns()
+        # loads only these from a columnar trace
+        self._columns = sorted(set(re.findall(
+            r'\bpkt\.((?:key\.)?\w+)', '\n'.join(self._tranStmts) + self._stmts)))
+
         self._valDefs = []
         for v in compUnit.resona.value_factory.value_list:
             v: Value
@@ -221,6 +241,8 @@ class SearchGen:
         self._regDefs = []
         self._regCreateBaseline = []
         self._regCreate = []
+        self._regCells = []
+        self._regHashes = []
         self._regReset = []
         self._regNum = 0
         for v in compUnit.resona.table_factory.table_list:
@@ -243,8 +265,15 @@ class SearchGen:
             self._regReset.append(f'{v.get_id()}->reset();')
             self._regCreateBaseline.append(f'p->{v.get_id()} = std::make_unique<BaselineRegister<{idxType}, {valType}>>();')
 
+            cells = f'PAGE_SIZE * 8 / {v.value_width}'
+            self._regCells.append(cells)
+            # the search precomputes the hashes of indices given by the packet
+            idxUses = self._regIdxUses.get(v, set())
+            exprs = set().union(*(self._idxExprs.get(x, {None}) for x in idxUses))
+            if len(idxUses) == 1 and len(exprs) == 1 and None not in exprs:
+                self._regHashes.append((curNum, idxType, exprs.pop()))
             d = f'c[{curNum}].d'
-            w = f'c[{curNum}].w * (PAGE_SIZE * 8 / {v.value_width})'
+            w = f'c[{curNum}].w * ({cells})'
             if isinstance(origOp, OpDistinct):
                 assert v.value_width == 1
                 self._regCreate.append(f'p->{v.get_id()} = std::make_unique<BloomFilter<{idxType}>>({d}, {w});')
@@ -339,12 +368,16 @@ class SearchGen:
     def output(self, targetPath: str):
         curPath = os.path.dirname(__file__)
         includePath = os.path.join(curPath, 'include')
+        tracePath = os.path.join(os.path.dirname(os.path.abspath(curPath)), 'trace')
         env = jinja2.Environment(loader=jinja2.FileSystemLoader(curPath))
         os.makedirs(targetPath, exist_ok=True)
         progName = f'autosketch-{self._appName.replace("_", "-")}'
+        # the program identifies its own query by the hash of its source
+        template = env.get_template('search.cpp.jinja')
+        sourceHash = hashlib.sha1(template.render(s=self, sourceHash='').encode()).hexdigest()
         with open(os.path.join(targetPath, f'{progName}.cpp'), 'w') as fp:
-            print(env.get_template('search.cpp.jinja').render(s=self), file=fp)
+            print(template.render(s=self, sourceHash=sourceHash), file=fp)
         with open(os.path.join(targetPath, f'conf.json'), 'w') as fp:
             print(env.get_template('conf.json.jinja').render(s=self, req=self._packetStream.requirement_dict), file=fp)
         with open(os.path.join(targetPath, f'Makefile'), 'w') as fp:
-            print(env.get_template('Makefile.jinja').render(includePath=includePath, progName=progName), file=fp)
+            print(env.get_template('Makefile.jinja').render(includePath=includePath, tracePath=tracePath, progName=progName), file=fp)
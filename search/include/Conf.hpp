@@ -2,6 +2,7 @@
 
 #include "Search.hpp"
 #include "Query.hpp"
+#include "Pcap.hpp"
 
 #include <jsoncpp/json/json.h>
 
@@ -22,17 +23,50 @@ SearchConf fromJson(const Json::Value &v) {
     .pageMax = jNonNull(v["pageMax"]).asUInt(),
     .maxStagePerOp = jNonNull(v["maxStagePerOp"]).asUInt(),
     .alpha = jNonNull(v["alpha"]).asDouble(),
-    .beta = jNonNull(v["beta"]).asDouble()
+    .beta = jNonNull(v["beta"]).asDouble(),
+    .epochSubset = v.get("epochSubset", 0).asUInt(),
+    .fidelityRounds = v.get("fidelityRounds", 0).asUInt(),
+    .fidelityMargin = v.get("fidelityMargin", 0.05).asDouble(),
+    .batchSize = v.get("batchSize", 1).asUInt(),
+    .listen = v.get("listen", "").asString(),
+    .telemetry = v.get("telemetry", "").asString()
   };
 }
 
 template <>
 TraceConf fromJson(const Json::Value &v) {
-  return {
-    .trace = std::make_shared<Trace>(readTrace(jNonNull(v["path"]).asCString())),
+  TraceConf res{
     .nEpoch = jNonNull(v["nEpoch"]).asUInt(),
     .interval = jNonNull(v["interval"]).asDouble()
   };
+  std::string path = jNonNull(v["path"]).asString();
+  if (isPcap(path.c_str()))
+    path = cachedPcapTrace(path);
+  res.path = path;
+  res.filterCache = v.get("filterCache", false).asBool();
+  res.baselineCache = v.get("baselineCache", false).asBool();
+  res.metricStore = v.get("metricStore", false).asBool();
+  res.hashStreams = v.get("hashStreams", false).asBool();
+  res.epochThreads = v.get("epochThreads", 1).asUInt();
+  if (res.epochThreads == 0)
+    res.epochThreads = std::max(1u, std::thread::hardware_concurrency());
+  if (v.isMember("bufferSize")) {
+    if (hasMagic(path.c_str(), COLUMN_TRACE_MAGIC) || hasMagic(path.c_str(), CHUNK_TRACE_MAGIC))
+      throw std::invalid_argument("bufferSize requires a .bin trace");
+    size_t bufferSize = v["bufferSize"].asUInt64();
+    res.stream = std::make_shared<const StreamConf>(StreamConf{
+      .path = path,
+      .bufferSize = bufferSize,
+      .nPkts = countPkts(path.c_str()),
+      // no more readers than cores make progress at once
+      .budget = std::make_shared<StreamBudget>(bufferSize, std::thread::hardware_concurrency())
+    });
+  } else if (hasMagic(path.c_str(), COLUMN_TRACE_MAGIC))
+    res.columns = std::make_shared<const ColumnTrace>(readColumnTrace(path.c_str()));
+  else
+    res.trace = std::make_shared<const Trace>(readTrace(path.c_str()));
+  indexEpochs(res, v.get("epochIndex", "").asString());
+  return res;
 }
 
 template <>
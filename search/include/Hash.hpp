@@ -1,9 +1,18 @@
 #pragma once
 
 #include <cassert>
+#include <cstdint>
+#include <cstdio>
 #include <cstring>
 
+#include <algorithm>
+#include <array>
+#include <memory>
+#include <stdexcept>
+#include <string>
+#include <type_traits>
 #include <vector>
+#include <mutex>
 #include <unordered_map>
 #include <unordered_set>
 
@@ -53,6 +62,46 @@ inline uint32_t select_crc(size_t hashId, const void *data, size_t size) {
   }
 }
 
+// 64-bit digest of a byte string, used to key on-disk caches.
+inline std::string hexDigest(const std::string &s) {
+  char buf[17];
+  snprintf(buf, sizeof(buf), "%08x%08x", calcCrc<0>(s.data(), s.size()), calcCrc<1>(s.data(), s.size()));
+  return buf;
+}
+
+// Writes the hashes with IDs below n of a key to out, as a register with n
+// rows hashes it.
+template <typename Key>
+void indexHashes(const Key &k, size_t n, uint32_t *out) {
+  static_assert(std::is_pod_v<Key>);
+  for (size_t h = 0; h < n; h++)
+    out[h] = select_crc(h, &k, sizeof(k));
+}
+
+// Precomputed hashes of register indices over the first nPkts packets of a
+// trace, one stream for each register whose index is a function of the packet
+// alone: at(k, i)[h] is the hash with ID h of the index register k takes for
+// packet i, for h below nHashes(). Registers then only mask them to their
+// width.
+class HashStreams {
+  std::shared_ptr<const void> storage_;
+  std::vector<const uint32_t *> streams_;  // null for registers without one
+  size_t nPkts_, nHashes_;
+
+public:
+  HashStreams(std::shared_ptr<const void> storage, std::vector<const uint32_t *> streams, size_t nPkts, size_t nHashes)
+    : storage_(std::move(storage)), streams_(std::move(streams)), nPkts_(nPkts), nHashes_(nHashes) {
+  }
+
+  size_t nHashes() const {
+    return nHashes_;
+  }
+  // Null if register k has no stream or packet i was not hashed.
+  const uint32_t *at(size_t k, size_t i) const {
+    return k < streams_.size() && streams_[k] && i < nPkts_ ? streams_[k] + i * nHashes_ : nullptr;
+  }
+};
+
 template <typename Key>
 class Hash {
 public:
@@ -84,3 +133,119 @@ using HashSet = std::unordered_set<Key, Hash<Key>, MemEqTo<Key>>;
 
 template <typename Key, typename Val>
 using HashMap = std::unordered_map<Key, Val, Hash<Key>, MemEqTo<Key>>;
+
+// Non-cryptographic hash for in-memory tables, much cheaper than a CRC.
+template <typename Key>
+uint64_t mixHash(const Key &k) {
+  static_assert(std::is_pod_v<Key>);
+  uint64_t h = sizeof(Key);
+  const char *p = reinterpret_cast<const char *>(&k);
+  for (size_t i = 0; i < sizeof(Key); i += 8) {
+    uint64_t w = 0;
+    memcpy(&w, p + i, std::min<size_t>(8, sizeof(Key) - i));
+    h = (h ^ w) * 0x9e3779b97f4a7c15ULL;
+    h ^= h >> 32;
+  }
+  h *= 0xd6e8feb86659fd93ULL;
+  return h ^ (h >> 32);
+}
+
+// Assigns dense IDs 0, 1, ... to keys in the order they are first inserted,
+// so that per-key state can live in flat arrays. Open addressing, linear
+// probing; IDs are never reused.
+template <typename Key>
+class KeyDict {
+  static constexpr uint32_t EMPTY = UINT32_MAX;
+
+  std::vector<Key> keys_;
+  std::vector<uint32_t> slots_ = std::vector<uint32_t>(16, EMPTY);
+
+  size_t slot(const Key &k) const {
+    size_t mask = slots_.size() - 1;
+    size_t s = mixHash(k) & mask;
+    while (slots_[s] != EMPTY && !MemEqTo<Key>()(keys_[slots_[s]], k))
+      s = (s + 1) & mask;
+    return s;
+  }
+
+  void grow() {
+    slots_.assign(slots_.size() * 2, EMPTY);
+    for (uint32_t id = 0; id < keys_.size(); id++)
+      slots_[slot(keys_[id])] = id;
+  }
+
+public:
+  static constexpr uint32_t NONE = EMPTY;
+
+  size_t size() const {
+    return keys_.size();
+  }
+  const Key &key(uint32_t id) const {
+    return keys_[id];
+  }
+  uint32_t find(const Key &k) const {
+    return slots_[slot(k)];
+  }
+  uint32_t insert(const Key &k) {
+    size_t s = slot(k);
+    if (slots_[s] != EMPTY)
+      return slots_[s];
+    if (keys_.size() >= UINT32_MAX - 1)
+      throw std::length_error("too many keys");
+    uint32_t id = keys_.size();
+    keys_.push_back(k);
+    if (keys_.size() * 2 > slots_.size())
+      grow();
+    else
+      slots_[s] = id;
+    return id;
+  }
+};
+
+// HashSet that threads can share: keys are split over N_SHARDS sets by hash,
+// each with its own lock, so that threads rarely wait on each other.
+template <typename Key, size_t N_SHARDS = 64>
+class ConcurrentHashSet {
+  struct Shard {
+    mutable std::mutex mtx;
+    HashSet<Key> set;
+  };
+  std::array<Shard, N_SHARDS> shards_;
+
+  Shard &shard(const Key &k) {
+    return shards_[mixHash(k) % N_SHARDS];
+  }
+  const Shard &shard(const Key &k) const {
+    return shards_[mixHash(k) % N_SHARDS];
+  }
+
+public:
+  bool contains(const Key &k) const {
+    const Shard &s = shard(k);
+    std::lock_guard<std::mutex> lck{s.mtx};
+    return s.set.count(k) != 0;
+  }
+  // Returns false if k was already there.
+  bool insert(const Key &k) {
+    Shard &s = shard(k);
+    std::lock_guard<std::mutex> lck{s.mtx};
+    return s.set.insert(k).second;
+  }
+  size_t size() const {
+    size_t n = 0;
+    for (const Shard &s : shards_) {
+      std::lock_guard<std::mutex> lck{s.mtx};
+      n += s.set.size();
+    }
+    return n;
+  }
+  // Calls f on every key, one shard at a time.
+  template <typename F>
+  void forEach(F f) const {
+    for (const Shard &s : shards_) {
+      std::lock_guard<std::mutex> lck{s.mtx};
+      for (const Key &k : s.set)
+        f(k);
+    }
+  }
+};
@@ -0,0 +1,99 @@
+#pragma once
+
+#include "Trace.hpp"
+
+#include <pcap.h>
+
+#include <spdlog/spdlog.h>
+
+// decode() from trace/packet.c, linked into the search program. PktInfo has
+// the layout of its tuple_t.
+extern "C" int decode(const uint8_t *pkt, uint32_t capLen, uint32_t actLen, double ts, PktInfo *p);
+
+constexpr int PACKET_STATUS_VALID = 1;   // STATUS_VALID in trace/packet.h
+constexpr uint32_t PCAP_MAX_CAPLEN = 1500;  // MAX_CAPLEN in trace/packet.h
+constexpr uint32_t PCAP_MIN_COPY_LEN = 128;
+
+inline bool isPcap(const char *path) {
+  FILE *fp = fopen(path, "rb");
+  if (!fp)
+    throw std::runtime_error(std::string("fopen: ") + strerror(errno));
+  uint32_t magic = 0;
+  bool ok = fread(&magic, sizeof(magic), 1, fp) == 1;
+  fclose(fp);
+  return ok && (magic == 0xa1b2c3d4 || magic == 0xd4c3b2a1   // microsecond pcap
+    || magic == 0xa1b23c4d || magic == 0x4d3cb2a1            // nanosecond pcap
+    || magic == 0x0a0d0d0a);                                 // pcapng
+}
+
+// Decodes a capture the same way as trace/preprocess and writes the valid
+// packets as a .bin trace.
+inline void decodePcap(const char *path, const char *out) {
+  char errbuf[PCAP_ERRBUF_SIZE];
+  pcap_t *pcap = pcap_open_offline(path, errbuf);
+  if (!pcap)
+    throw std::runtime_error(std::string("pcap_open_offline: ") + errbuf);
+  std::unique_ptr<pcap_t, void (*)(pcap_t *)> pcapGuard(pcap, pcap_close);
+
+  std::unique_ptr<FILE, int (*)(FILE *)> fp(fopen(out, "wb"), fclose);
+  if (!fp)
+    throw std::runtime_error(std::string("fopen: ") + strerror(errno));
+
+  std::vector<PktInfo> batch;
+  batch.reserve(1 << 16);
+  auto flush = [&]() {
+    if (fwrite(batch.data(), sizeof(PktInfo), batch.size(), fp.get()) != batch.size())
+      throw std::runtime_error(std::string("fwrite: ") + strerror(errno));
+    batch.clear();
+  };
+
+  uint8_t pktData[PCAP_MIN_COPY_LEN];
+  PktInfo p{};
+  pcap_pkthdr *hdr;
+  const u_char *pkt;
+  int rc;
+  while ((rc = pcap_next_ex(pcap, &hdr, &pkt)) == 1) {
+    double pktTs = static_cast<double>(hdr->ts.tv_usec) / 1000000 + hdr->ts.tv_sec;
+    uint32_t pktLen = std::min(hdr->caplen, PCAP_MAX_CAPLEN);
+    if (pktLen < PCAP_MIN_COPY_LEN) {
+      memset(pktData, 0, sizeof(pktData));
+      memcpy(pktData, pkt, pktLen);
+      pkt = pktData;
+    }
+    if (decode(pkt, pktLen, hdr->len, pktTs, &p) == PACKET_STATUS_VALID) {
+      batch.push_back(p);
+      if (batch.size() == batch.capacity())
+        flush();
+    }
+  }
+  if (rc == -1)
+    throw std::runtime_error(std::string("pcap_next_ex: ") + pcap_geterr(pcap));
+  flush();
+  if (fclose(fp.release()) != 0)
+    throw std::runtime_error(std::string("fclose: ") + strerror(errno));
+}
+
+// Returns the decoded .bin trace of a capture, decoding it on first use. The
+// cache file sits next to the capture and is keyed by its size and mtime, so
+// a modified capture is decoded again.
+inline std::string cachedPcapTrace(const std::string &path) {
+  struct stat st;
+  if (stat(path.c_str(), &st) < 0)
+    throw std::runtime_error(std::string("stat: ") + strerror(errno));
+  std::string cache = path + "." + std::to_string(st.st_size) + "-"
+    + std::to_string(st.st_mtim.tv_sec) + "." + std::to_string(st.st_mtim.tv_nsec) + ".bin";
+  if (access(cache.c_str(), R_OK) == 0)
+    return cache;
+
+  spdlog::info("decoding {} into {}", path, cache);
+  std::string tmp = cache + ".tmp" + std::to_string(getpid());
+  try {
+    decodePcap(path.c_str(), tmp.c_str());
+  } catch (...) {
+    unlink(tmp.c_str());
+    throw;
+  }
+  if (rename(tmp.c_str(), cache.c_str()) < 0)
+    throw std::runtime_error(std::string("rename: ") + strerror(errno));
+  return cache;
+}
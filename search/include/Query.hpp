@@ -22,38 +22,72 @@ protected:
 private:
   RecallPrecisionConf evalConf_;
 
+  // Position of the confidence quantile among the sorted metrics of nEpoch epochs.
+  size_t quantileIndex(size_t nEpoch) const {
+    size_t k = static_cast<size_t>(static_cast<double>(nEpoch) * evalConf_.confidence);
+    return k > 0 ? k - 1 : k;
+  }
+
 public:
   QueryRecallPrecision(RecallPrecisionConf evalConf)
     : evalConf_(evalConf) {
   }
 
-  bool evaluateResult(const std::vector<Result> &res, AppConf c) override {
-    size_t nEpoch = resBaseline_.size();
-    assert(res.size() == nEpoch);
+  std::vector<std::string> metricNames() const override {
+    return {"precision", "recall", "keys"};
+  }
+
+  double errorBudget() const override {
+    return std::min(1 - evalConf_.precisionMin, 1 - evalConf_.recallMin);
+  }
+
+  // An empty result has nothing wrong and an empty baseline nothing missed,
+  // so that no metric is NaN, which decide() could not rank.
+  EpochMetrics epochMetrics(const Result &res, size_t i) const override {
+    size_t correct = 0;
+    for (const auto &v : res)
+      if (resBaseline_[i].count(v))
+        correct++;
+    return {
+      res.empty() ? 1 : static_cast<double>(correct) / static_cast<double>(res.size()),
+      resBaseline_[i].empty() ? 1 : static_cast<double>(correct) / static_cast<double>(resBaseline_[i].size()),
+      static_cast<double>(resBaseline_[i].size())
+    };
+  }
+
+  bool decide(std::vector<EpochMetrics> metrics, AppConf c, Accuracy *acc, double margin) override {
+    size_t nEpoch = metrics.size();
 
     std::vector<double> precisions(nEpoch), recalls(nEpoch);
     double totKeys = 0;
     for (size_t i = 0; i < nEpoch; i++) {
-      size_t correct = 0;
-      for (const auto &v : res[i])
-        if (resBaseline_[i].count(v))
-          correct++;
-      precisions[i] = static_cast<double>(correct) / static_cast<double>(res[i].size());
-      recalls[i] = static_cast<double>(correct) / static_cast<double>(resBaseline_[i].size());
-      totKeys += resBaseline_[i].size();
+      precisions[i] = metrics[i][0];
+      recalls[i] = metrics[i][1];
+      totKeys += metrics[i][2];
     }
 
-    size_t k = static_cast<size_t>(static_cast<double>(nEpoch) * evalConf_.confidence);
-    if (k > 0)
-      k--;
+    size_t k = quantileIndex(nEpoch);
     std::nth_element(precisions.begin(), precisions.begin() + k, precisions.end(), std::greater<double>());
     std::nth_element(recalls.begin(), recalls.begin() + k, recalls.end(), std::greater<double>());
 
-    bool succ = precisions[k] >= evalConf_.precisionMin && recalls[k] >= evalConf_.recallMin;
+    bool succ = precisions[k] >= evalConf_.precisionMin - margin && recalls[k] >= evalConf_.recallMin - margin;
+    if (acc)
+      *acc = {{"precision", precisions[k]}, {"recall", recalls[k]}};
     spdlog::info("[{}] {}: precision {}, recall {}, confidence {}, avg. keys {}",
       succ ? "success" : "failure", c.str(), precisions[k], recalls[k], evalConf_.confidence, totKeys / nEpoch);
     return succ;
   }
+
+  // The k-th best of nEpoch values meets a target only if k + 1 of them do.
+  bool unreachable(const std::vector<EpochMetrics> &metrics, size_t nEpoch, double margin) const override {
+    size_t allowed = nEpoch - quantileIndex(nEpoch) - 1;
+    size_t lowPrecision = 0, lowRecall = 0;
+    for (const EpochMetrics &m : metrics) {
+      lowPrecision += !(m[0] >= evalConf_.precisionMin - margin);
+      lowRecall += !(m[1] >= evalConf_.recallMin - margin);
+    }
+    return lowPrecision > allowed || lowRecall > allowed;
+  }
 };
 
 struct AREConf {
@@ -73,47 +107,84 @@ protected:
 private:
   AREConf evalConf_;
 
+  // Position of the confidence quantile among the sorted metrics of nEpoch epochs.
+  size_t quantileIndex(size_t nEpoch) const {
+    size_t k = static_cast<size_t>(static_cast<double>(nEpoch) * evalConf_.confidence);
+    return k > 0 ? k - 1 : k;
+  }
+
 public:
   QueryARE(AREConf evalConf)
     : evalConf_(evalConf) {
   }
 
-  bool evaluateResult(const std::vector<Result> &res, AppConf c) override {
-    size_t nEpoch = resBaseline_.size();
-    assert(res.size() == nEpoch);
+  std::vector<std::string> metricNames() const override {
+    return {"are", "precision", "recall", "keys", "value"};
+  }
+
+  double errorBudget() const override {
+    return std::min({evalConf_.areMax, 1 - evalConf_.precisionMin, 1 - evalConf_.recallMin});
+  }
+
+  EpochMetrics epochMetrics(const Result &res, size_t i) const override {
+    size_t correct = 0;
+    double totEpVal = 0, totEpErr = 0;
+    for (const auto &v : resBaseline_[i]) {
+      totEpVal += v.second;
+      if (auto p = res.find(v.first); p != res.end()) {
+        correct++;
+        totEpErr += std::abs(static_cast<double>(p->second) - static_cast<double>(v.second)) / static_cast<double>(v.second);
+      } else {
+        totEpErr += 1.0;
+      }
+    }
+    // as in QueryRecallPrecision, an empty result or baseline gives no NaN
+    if (resBaseline_[i].empty())
+      return {0, res.empty() ? 1 : 0, 1, 0, 0};
+    return {
+      totEpErr / static_cast<double>(resBaseline_[i].size()),
+      res.empty() ? 1 : static_cast<double>(correct) / static_cast<double>(res.size()),
+      static_cast<double>(correct) / static_cast<double>(resBaseline_[i].size()),
+      static_cast<double>(resBaseline_[i].size()),
+      totEpVal / static_cast<double>(resBaseline_[i].size())
+    };
+  }
+
+  bool decide(std::vector<EpochMetrics> metrics, AppConf c, Accuracy *acc, double margin) override {
+    size_t nEpoch = metrics.size();
 
     std::vector<double> precisions(nEpoch), recalls(nEpoch), ares(nEpoch);
     double totKeys = 0, totAvgVal = 0;
     for (size_t i = 0; i < nEpoch; i++) {
-      size_t correct = 0;
-      double totEpVal = 0, totEpErr = 0;
-      for (const auto &v : resBaseline_[i]) {
-        totEpVal += v.second;
-        if (auto p = res[i].find(v.first); p != res[i].end()) {
-          correct++;
-          totEpErr += std::abs(static_cast<double>(p->second) - static_cast<double>(v.second)) / static_cast<double>(v.second);
-        } else {
-          totEpErr += 1.0;
-        }
-      }
-      precisions[i] = static_cast<double>(correct) / static_cast<double>(res[i].size());
-      recalls[i] = static_cast<double>(correct) / static_cast<double>(resBaseline_[i].size());
-      ares[i] = totEpErr / static_cast<double>(resBaseline_[i].size());
-
-      totKeys += resBaseline_[i].size();
-      totAvgVal += totEpVal / static_cast<double>(resBaseline_[i].size());
+      ares[i] = metrics[i][0];
+      precisions[i] = metrics[i][1];
+      recalls[i] = metrics[i][2];
+      totKeys += metrics[i][3];
+      totAvgVal += metrics[i][4];
     }
 
-    size_t k = static_cast<size_t>(static_cast<double>(nEpoch) * evalConf_.confidence);
-    if (k > 0)
-      k--;
+    size_t k = quantileIndex(nEpoch);
     std::nth_element(precisions.begin(), precisions.begin() + k, precisions.end(), std::greater<double>());
     std::nth_element(recalls.begin(), recalls.begin() + k, recalls.end(), std::greater<double>());
     std::nth_element(ares.begin(), ares.begin() + k, ares.end());
 
-    bool succ = ares[k] <= evalConf_.areMax && precisions[k] >= evalConf_.precisionMin && recalls[k] >= evalConf_.recallMin;
+    bool succ = ares[k] <= evalConf_.areMax + margin && precisions[k] >= evalConf_.precisionMin - margin && recalls[k] >= evalConf_.recallMin - margin;
+    if (acc)
+      *acc = {{"are", ares[k]}, {"precision", precisions[k]}, {"recall", recalls[k]}};
     spdlog::info("[{}] {}: are {}, precision {}, recall {}, confidence {}, avg. keys {}, avg. val {}",
       succ ? "success" : "failure", c.str(), ares[k], precisions[k], recalls[k], evalConf_.confidence, totKeys / nEpoch, totAvgVal / nEpoch);
     return succ;
   }
+
+  // The k-th best of nEpoch values meets a target only if k + 1 of them do.
+  bool unreachable(const std::vector<EpochMetrics> &metrics, size_t nEpoch, double margin) const override {
+    size_t allowed = nEpoch - quantileIndex(nEpoch) - 1;
+    size_t highAre = 0, lowPrecision = 0, lowRecall = 0;
+    for (const EpochMetrics &m : metrics) {
+      highAre += !(m[0] <= evalConf_.areMax + margin);
+      lowPrecision += !(m[1] >= evalConf_.precisionMin - margin);
+      lowRecall += !(m[2] >= evalConf_.recallMin - margin);
+    }
+    return highAre > allowed || lowPrecision > allowed || lowRecall > allowed;
+  }
 };
@@ -10,6 +10,7 @@
 #include <unordered_map>
 #include <numeric>
 #include <stdexcept>
+#include <type_traits>
 
 // using RegIndex = std::vector<std::byte>;
 
@@ -44,12 +45,43 @@
 //   }
 // };
 
+// inline size_t hRegIdx(size_t hashId, size_t w, const RegIndex &idx) {
+//   return select_crc(hashId, idx.data(), idx.size()) & (w - 1);
+// }
+
+template <typename RegIndex>
+size_t hRegIdx(size_t hashId, size_t w, const RegIndex &idx) {
+  static_assert(std::is_pod_v<RegIndex>);
+  return select_crc(hashId, &idx, sizeof(idx)) & (w - 1);
+}
+
 template <typename RegIndex, typename Value>
 class Register {
+  // hashes of the index of the current packet, see useHashes()
+  const uint32_t *hashes_ = nullptr;
+  size_t nHashes_ = 0;
+
+protected:
+  // Cell of row i of w cells that idx maps to.
+  size_t hashRow(size_t i, size_t w, const RegIndex &idx) const {
+    return i < nHashes_ ? hashes_[i] & (w - 1) : hRegIdx(i, w, idx);
+  }
+
 public:
   virtual ~Register() = default;
+  // Takes the hashes of the index of packet i from stream k of hashes instead
+  // of computing them on every access, until called with null hashes.
+  void useHashes(const HashStreams *hashes, size_t k, size_t i) {
+    hashes_ = hashes ? hashes->at(k, i) : nullptr;
+    nHashes_ = hashes_ ? hashes->nHashes() : 0;
+  }
   virtual void reset() = 0;
   virtual Value get(const RegIndex &idx) = 0;
+  // Distinct indices written in the epoch before the last reset(); only
+  // exact registers count them.
+  virtual size_t lastEpochKeys() const {
+    return 0;
+  }
   virtual void add(const RegIndex &idx, Value v) {
     throw std::logic_error("unsupported operation");
   }
@@ -61,38 +93,60 @@ public:
   }
 };
 
+// Exact register. Keys get dense IDs from a dictionary kept for the whole
+// trace, so values are a flat array; reset() only bumps the epoch and a
+// value is zero unless it was written in the current one.
 template <typename RegIndex, typename Value>
 class BaselineRegister : public Register<RegIndex, Value> {
-  HashMap<RegIndex, Value> m_;
+  // not std::vector<bool>, whose elements cannot be referenced
+  using Cell = std::conditional_t<std::is_same_v<Value, bool>, uint8_t, Value>;
+
+  KeyDict<RegIndex> ids_;
+  std::vector<Cell> vals_;
+  std::vector<uint32_t> epochs_;  // epoch in which each value was last written
+  uint32_t epoch_ = 1;
+  size_t nKeys_ = 0, lastKeys_ = 0;
+
+  Cell &slot(const RegIndex &idx) {
+    uint32_t id = ids_.insert(idx);
+    if (id >= vals_.size()) {
+      vals_.resize(ids_.size());
+      epochs_.resize(ids_.size(), 0);
+    }
+    if (epochs_[id] != epoch_) {
+      epochs_[id] = epoch_;
+      vals_[id] = Cell();
+      nKeys_++;
+    }
+    return vals_[id];
+  }
 
 public:
   void reset() override {
-    m_.clear();
+    epoch_++;
+    lastKeys_ = nKeys_;
+    nKeys_ = 0;
+  }
+  size_t lastEpochKeys() const override {
+    return lastKeys_;
   }
   Value get(const RegIndex &idx) override {
-    return m_[idx];
+    uint32_t id = ids_.find(idx);
+    if (id == ids_.NONE || epochs_[id] != epoch_)
+      return Value();
+    return static_cast<Value>(vals_[id]);
   }
   void add(const RegIndex &idx, Value v) override {
-    m_[idx] += v;
+    slot(idx) += v;
   }
   void minus(const RegIndex &idx, Value v) override {
-    m_[idx] -= v;
+    slot(idx) -= v;
   }
   void assign(const RegIndex &idx, Value v) override {
-    m_[idx] = v;
+    slot(idx) = v;
   }
 };
 
-// inline size_t hRegIdx(size_t hashId, size_t w, const RegIndex &idx) {
-//   return select_crc(hashId, idx.data(), idx.size()) & (w - 1);
-// }
-
-template <typename RegIndex>
-size_t hRegIdx(size_t hashId, size_t w, const RegIndex &idx) {
-  static_assert(std::is_pod_v<RegIndex>);
-  return select_crc(hashId, &idx, sizeof(idx)) & (w - 1);
-}
-
 template <typename RegIndex>
 class BloomFilter : public Register<RegIndex, bool> {
   std::vector<std::vector<bool>> m_;
@@ -108,13 +162,13 @@ public:
   bool get(const RegIndex &idx) override {
     bool res = true;
     for (size_t i = 0; i < m_.size(); i++)
-      res = res && m_[i][hRegIdx(i, m_[i].size(), idx)];
+      res = res && m_[i][this->hashRow(i, m_[i].size(), idx)];
     return res;
   }
   void assign(const RegIndex &idx, bool v) override {
     assert(v);
     for (size_t i = 0; i < m_.size(); i++)
-      m_[i][hRegIdx(i, m_[i].size(), idx)] = v;
+      m_[i][this->hashRow(i, m_[i].size(), idx)] = v;
   }
 };
 
@@ -134,13 +188,13 @@ public:
   Value get(const RegIndex &idx) override {
     Value res = std::numeric_limits<Value>::max();
     for (size_t i = 0; i < m_.size(); i++)
-      res = std::min(res, m_[i][hRegIdx(i, m_[i].size(), idx)]);
+      res = std::min(res, m_[i][this->hashRow(i, m_[i].size(), idx)]);
     return res;
   }
   void add(const RegIndex &idx, Value v) override {
     assert(v >= 0);
     for (size_t i = 0; i < m_.size(); i++)
-      m_[i][hRegIdx(i, m_[i].size(), idx)] += v;
+      m_[i][this->hashRow(i, m_[i].size(), idx)] += v;
   }
 };
 
@@ -153,10 +207,10 @@ public:
 
   void minus(const RegIndex &idx, Value v) override {
     for (size_t i = 0; i < m_.size(); i++)
-      m_[i][hRegIdx(i, m_[i].size(), idx)] -= v;
+      m_[i][this->hashRow(i, m_[i].size(), idx)] -= v;
   }
   void assign(const RegIndex &idx, Value v) override {
     for (size_t i = 0; i < m_.size(); i++)
-      m_[i][hRegIdx(i, m_[i].size(), idx)] = v;
+      m_[i][this->hashRow(i, m_[i].size(), idx)] = v;
   }
 };
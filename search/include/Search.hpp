@@ -2,20 +2,32 @@
 
 #include "Trace.hpp"
 #include "Hash.hpp"
+#include "Socket.hpp"
 
 #include <cstddef>
 
 #include <algorithm>
+#include <cmath>
+#include <limits>
+#include <numeric>
 #include <set>
+#include <fstream>
+#include <sstream>
 #include <queue>
 #include <array>
 #include <memory>
+#include <functional>
 #include <thread>
 #include <mutex>
+#include <shared_mutex>
+#include <atomic>
 #include <condition_variable>
+#include <exception>
 #include <random>
+#include <chrono>
 
 #include <spdlog/spdlog.h>
+#include <spdlog/fmt/ranges.h>
 
 constexpr size_t PAGE_SIZE = 16 << 10;
 constexpr size_t ALU_PER_STAGE = 4, PAGE_PER_STAGE = 48;
@@ -38,12 +50,650 @@ struct SearchConf {
   size_t aluMax, pageMax;
   size_t maxStagePerOp;
   double alpha, beta;
+  size_t epochSubset;  // search on this many representative epochs, 0 for all
+  size_t fidelityRounds;  // screen candidates on 1/2^k, ..., 1/2 of the epochs first
+  double fidelityMargin;  // how far a screened candidate may miss the targets
+  size_t batchSize;  // candidates a search thread evaluates in one pass
+  std::string listen;  // address workers connect to, empty for none
+  std::string telemetry;  // JSON lines file of evaluation records, empty for none
+};
+
+// Named accuracy metrics of a configuration, e.g. precision and recall.
+using Accuracy = std::vector<std::pair<std::string, double>>;
+
+// Accuracy metrics of one epoch, in the order of Query::metricNames().
+using EpochMetrics = std::vector<double>;
+
+// A .bin trace read from disk on every run instead of being held in memory.
+struct StreamConf {
+  std::string path;
+  size_t bufferSize;  // bytes of packets buffered by all runs together
+  size_t nPkts;
+  std::shared_ptr<StreamBudget> budget;  // splits bufferSize between the readers
 };
 
 struct TraceConf {
   std::shared_ptr<const Trace> trace;
+  std::shared_ptr<const ColumnTrace> columns;  // set instead of trace for columnar files
+  std::shared_ptr<const StreamConf> stream;    // set instead of trace for streamed files
+  std::shared_ptr<const EpochIndex> epochs;
   size_t nEpoch;
   double interval;
+  std::string path;          // file the packets were read from, if any
+  bool filterCache = false;  // keep pre-filtered traces next to path
+  bool baselineCache = false;  // keep baseline results next to path
+  bool metricStore = false;    // keep per-epoch metrics of evaluations next to path
+  bool hashStreams = false;    // precompute register index hashes, kept next to path
+  size_t epochThreads = 1;     // threads a run spreads the epochs over
+  std::shared_ptr<const HashStreams> hashes;  // set by Query::prehash()
+
+  size_t nPkts() const {
+    if (stream)
+      return stream->nPkts;
+    return columns ? columns->nPkts() : trace->size();
+  }
+};
+
+// Builds the epoch index of a trace once, or loads it from a sidecar file.
+inline void indexEpochs(TraceConf &traceConf, const std::string &sidecar = "") {
+  EpochIndex idx = [&]() {
+    if (traceConf.stream) {
+      // timestamps are requested in increasing order
+      StreamBudget::Share share(*traceConf.stream->budget);
+      TraceReader reader(traceConf.stream->path.c_str(), share.bytes());
+      const PktInfo *blk = nullptr;
+      size_t blkFirst = 0, blkLen = 0;
+      return readEpochIndex(sidecar, traceConf.nPkts(), [&](size_t i) {
+        while (i >= blkFirst + blkLen) {
+          blkFirst += blkLen;
+          blk = reader.next(blkLen);
+          if (!blk)
+            throw std::runtime_error("unexpected end of trace");
+        }
+        return blk[i - blkFirst].pkt_ts;
+      }, traceConf.nEpoch, traceConf.interval);
+    }
+    if (traceConf.columns) {
+      const ColumnTrace &t = *traceConf.columns;
+      return readEpochIndex(sidecar, t.nPkts(), [&](size_t i) {
+        return t.pkt_ts[i];
+      }, traceConf.nEpoch, traceConf.interval);
+    }
+    const Trace &t = *traceConf.trace;
+    return readEpochIndex(sidecar, t.size(), [&](size_t i) {
+      return t[i].pkt_ts;
+    }, traceConf.nEpoch, traceConf.interval);
+  }();
+  traceConf.epochs = std::make_shared<const EpochIndex>(std::move(idx));
+}
+
+// Modification time of the file a trace was read from, in nanoseconds.
+inline bool sourceMtime(const TraceConf &traceConf, int64_t &mtime) {
+  struct stat st;
+  if (traceConf.path.empty() || stat(traceConf.path.c_str(), &st) != 0)
+    return false;
+  mtime = st.st_mtim.tv_sec * 1000000000LL + st.st_mtim.tv_nsec;
+  return true;
+}
+
+// Calls onPkt for every packet of every epoch in order, and onEpoch after the
+// last packet of each epoch; the scan stops when onEpoch returns false.
+template <typename OnPkt, typename OnEpoch>
+void scanEpochs(const TraceConf &traceConf, OnPkt onPkt, OnEpoch onEpoch) {
+  const EpochIndex &epochs = *traceConf.epochs;
+  if (traceConf.stream) {
+    StreamBudget::Share share(*traceConf.stream->budget);
+    std::unique_ptr<TraceReader> reader;
+    const PktInfo *blk = nullptr;
+    size_t blkLen = 0, pos = 0;
+    for (size_t e = 0; e < epochs.nEpoch(); e++) {
+      if (!reader || pos != epochs.begin(e)) {
+        // skip the epochs left out of a selected index
+        reader.reset();
+        reader = std::make_unique<TraceReader>(traceConf.stream->path.c_str(), share.bytes(), epochs.begin(e));
+        blkLen = 0;
+        pos = epochs.begin(e);
+      }
+      while (pos < epochs.end(e)) {
+        if (blkLen == 0 && !(blk = reader->next(blkLen)))
+          throw std::runtime_error("unexpected end of trace");
+        size_t n = std::min(blkLen, epochs.end(e) - pos);
+        for (size_t i = 0; i < n; i++)
+          onPkt(blk[i]);
+        blk += n;
+        blkLen -= n;
+        pos += n;
+      }
+      if (!onEpoch())
+        return;
+    }
+    return;
+  }
+  for (size_t e = 0; e < epochs.nEpoch(); e++) {
+    for (size_t i = epochs.begin(e); i < epochs.end(e); i++)
+      onPkt(traceConf.columns ? (*traceConf.columns)[i] : (*traceConf.trace)[i]);
+    if (!onEpoch())
+      return;
+  }
+}
+
+// Drops the packets rejected by a query's filter chain, so that every run
+// over the trace only touches packets that can reach a register. With
+// filterCache the result is written next to the trace as the scan goes,
+// under the digest of the chain, and mapped back on this and later runs.
+template <typename Keep>
+TraceConf filterTrace(TraceConf traceConf, const std::string &signature, Keep keep) {
+  FilteredTraceHeader hdr{};
+  std::string digest = hexDigest(signature);
+  memcpy(hdr.magic, FILTERED_TRACE_MAGIC, sizeof(hdr.magic));
+  memcpy(hdr.signature, digest.data(), sizeof(hdr.signature));
+  hdr.sourcePkts = traceConf.nPkts();
+  hdr.nEpoch = traceConf.epochs->nEpoch();
+  hdr.interval = traceConf.interval;
+  bool useCache = traceConf.filterCache && sourceMtime(traceConf, hdr.sourceMtime);
+  std::string cachePath;
+  if (useCache)
+    cachePath = traceConf.path + ".filter-" + digest + ".bin";
+
+  TraceConf res = traceConf;
+  res.columns = nullptr;
+  res.stream = nullptr;
+  if (useCache && readFilteredTrace(cachePath.c_str(), hdr, res.trace, res.epochs)) {
+    spdlog::info("loaded filtered trace {}", cachePath);
+    return res;
+  }
+
+  if (useCache) {
+    FilteredTraceWriter writer(cachePath.c_str(), hdr);
+    scanEpochs(traceConf, [&](const PktInfo &pkt) {
+      if (keep(pkt))
+        writer.add(pkt);
+    }, [&]() {
+      writer.endEpoch();
+      return true;
+    });
+    spdlog::info("filter '{}' keeps {} of {} packets", signature, writer.finish(), hdr.sourcePkts);
+    if (!readFilteredTrace(cachePath.c_str(), hdr, res.trace, res.epochs))
+      throw std::runtime_error("cannot read filtered trace " + cachePath);
+    return res;
+  }
+  // a streamed or columnar trace is only filtered into a file, never into
+  // memory as full packets
+  if (traceConf.stream || traceConf.columns)
+    return traceConf;
+
+  std::vector<PktInfo> pkts;
+  std::vector<uint64_t> offsets{0};
+  scanEpochs(traceConf, [&](const PktInfo &pkt) {
+    if (keep(pkt))
+      pkts.push_back(pkt);
+  }, [&]() {
+    offsets.push_back(pkts.size());
+    return true;
+  });
+  spdlog::info("filter '{}' keeps {} of {} packets", signature, pkts.size(), hdr.sourcePkts);
+  res.trace = std::make_shared<const Trace>(std::move(pkts));
+  res.epochs = std::make_shared<const EpochIndex>(std::move(offsets));
+  return res;
+}
+
+// Baseline results are stored as the packed items (keys, or keys followed by
+// values) of every epoch, then the nRegs register key counts of every epoch,
+// see writeBaseline().
+constexpr char BASELINE_MAGIC[8] = {'A', 'S', 'B', 'A', 'S', 'E', 'L', '2'};
+
+struct BaselineHeader {
+  char magic[8];
+  char signature[16];  // hexDigest of the query source
+  uint64_t sourcePkts;
+  int64_t sourceMtime;
+  uint64_t nEpoch;
+  double interval;
+  uint64_t itemSize;
+  uint64_t nRegs;  // set by writeBaseline()
+};
+
+template <typename Key>
+constexpr size_t resultItemSize(const HashSet<Key> *) {
+  return sizeof(Key);
+}
+template <typename Key, typename Val>
+constexpr size_t resultItemSize(const HashMap<Key, Val> *) {
+  return sizeof(Key) + sizeof(Val);
+}
+
+template <typename Key>
+void appendResult(std::vector<char> &buf, const HashSet<Key> &res) {
+  for (const Key &k : res)
+    buf.insert(buf.end(), reinterpret_cast<const char *>(&k), reinterpret_cast<const char *>(&k) + sizeof(k));
+}
+template <typename Key, typename Val>
+void appendResult(std::vector<char> &buf, const HashMap<Key, Val> &res) {
+  for (const auto &v : res) {
+    buf.insert(buf.end(), reinterpret_cast<const char *>(&v.first), reinterpret_cast<const char *>(&v.first) + sizeof(Key));
+    buf.insert(buf.end(), reinterpret_cast<const char *>(&v.second), reinterpret_cast<const char *>(&v.second) + sizeof(Val));
+  }
+}
+
+template <typename Key>
+void parseResult(HashSet<Key> &res, const char *data, size_t n) {
+  res.reserve(n);
+  for (size_t i = 0; i < n; i++) {
+    Key k;
+    memcpy(&k, data + i * sizeof(Key), sizeof(Key));
+    res.insert(k);
+  }
+}
+template <typename Key, typename Val>
+void parseResult(HashMap<Key, Val> &res, const char *data, size_t n) {
+  res.reserve(n);
+  for (size_t i = 0; i < n; i++) {
+    Key k;
+    Val v;
+    memcpy(&k, data + i * (sizeof(Key) + sizeof(Val)), sizeof(Key));
+    memcpy(&v, data + i * (sizeof(Key) + sizeof(Val)) + sizeof(Key), sizeof(Val));
+    res.emplace(k, v);
+  }
+}
+
+template <typename Result>
+void writeBaseline(const char *path, BaselineHeader hdr, const std::vector<Result> &res,
+                   const std::vector<std::vector<size_t>> &keys) {
+  std::vector<uint64_t> offsets{0};
+  std::vector<char> items;
+  for (const Result &r : res) {
+    appendResult(items, r);
+    offsets.push_back(offsets.back() + r.size());
+  }
+  hdr.nRegs = keys.empty() ? 0 : keys[0].size();
+  std::vector<uint64_t> counts;
+  for (const auto &v : keys)
+    counts.insert(counts.end(), v.begin(), v.end());
+  std::string tmpPath = std::string(path) + ".tmp" + std::to_string(getpid());
+  FILE *fp = fopen(tmpPath.c_str(), "wb");
+  if (!fp)
+    throw std::runtime_error(std::string("fopen: ") + strerror(errno));
+  bool ok = fwrite(&hdr, sizeof(hdr), 1, fp) == 1
+    && fwrite(offsets.data(), sizeof(uint64_t), offsets.size(), fp) == offsets.size()
+    && fwrite(items.data(), 1, items.size(), fp) == items.size()
+    && fwrite(counts.data(), sizeof(uint64_t), counts.size(), fp) == counts.size();
+  ok = fclose(fp) == 0 && ok;
+  if (!ok || rename(tmpPath.c_str(), path) < 0) {
+    unlink(tmpPath.c_str());
+    throw std::runtime_error(std::string("cannot write baseline: ") + strerror(errno));
+  }
+}
+
+// Maps baseline results and register key counts written for `expected`,
+// whatever its nRegs; returns false if there are none or they belong to
+// another query or trace.
+template <typename Result>
+bool readBaseline(const char *path, const BaselineHeader &expected, std::vector<Result> &res,
+                  std::vector<std::vector<size_t>> &keys) {
+  if (access(path, R_OK) != 0)
+    return false;
+  size_t fsize;
+  auto storage = mapFile(path, fsize);
+  auto data = static_cast<const char *>(storage.get());
+  size_t offsetsSize = (expected.nEpoch + 1) * sizeof(uint64_t);
+  if (fsize < sizeof(BaselineHeader) + offsetsSize)
+    return false;
+  BaselineHeader hdr, want = expected;
+  memcpy(&hdr, data, sizeof(hdr));
+  want.nRegs = hdr.nRegs;
+  if (memcmp(&hdr, &want, sizeof(hdr)) != 0)
+    return false;
+  std::vector<uint64_t> offsets(hdr.nEpoch + 1);
+  memcpy(offsets.data(), data + sizeof(BaselineHeader), offsetsSize);
+  const char *items = data + sizeof(BaselineHeader) + offsetsSize;
+  const char *counts = items + offsets.back() * hdr.itemSize;
+  if (fsize != sizeof(BaselineHeader) + offsetsSize + offsets.back() * hdr.itemSize + hdr.nEpoch * hdr.nRegs * sizeof(uint64_t))
+    return false;
+
+  res.assign(hdr.nEpoch, Result());
+  keys.assign(hdr.nEpoch, std::vector<size_t>(hdr.nRegs));
+  for (size_t e = 0; e < hdr.nEpoch; e++) {
+    parseResult(res[e], items + offsets[e] * hdr.itemSize, offsets[e + 1] - offsets[e]);
+    for (size_t i = 0; i < hdr.nRegs; i++) {
+      uint64_t n;
+      memcpy(&n, counts + (e * hdr.nRegs + i) * sizeof(uint64_t), sizeof(n));
+      keys[e][i] = n;
+    }
+  }
+  return true;
+}
+
+// Hash streams are stored as the header followed by the stream of every
+// hashed register in order, nPkts * nHashes hashes each.
+constexpr char HASH_STREAMS_MAGIC[8] = {'A', 'S', 'H', 'A', 'S', 'H', 'S', '1'};
+
+struct HashStreamsHeader {
+  char magic[8];
+  char signature[16];  // hexDigest of the query source
+  uint64_t nPkts;
+  int64_t sourceMtime;
+  uint64_t nStreams;
+  uint64_t nHashes;
+};
+
+// Computes the hash streams of registers regs over the packets of the epochs
+// of a trace, see HashStreams; hashPkt(pkt, out) writes the hashes of packet
+// pkt for register k to out[k]. If the trace has a source file they are
+// written straight into a file next to it and mapped back on later runs, so
+// that the processes searching the trace share one copy in the page cache.
+template <typename HashPkt>
+std::shared_ptr<const HashStreams> hashTrace(const TraceConf &traceConf, const std::string &signature,
+                                             const std::vector<size_t> &regs, size_t nHashes, HashPkt hashPkt) {
+  // epochs start at the first packet; the packets after the last one are
+  // never evaluated
+  const EpochIndex &epochs = *traceConf.epochs;
+  size_t nPkts = epochs.end(epochs.nEpoch() - 1), streamSize = nPkts * nHashes;
+  size_t nRegs = regs.empty() ? 0 : *std::max_element(regs.begin(), regs.end()) + 1;
+  auto view = [&](std::shared_ptr<const void> storage, const uint32_t *data) {
+    std::vector<const uint32_t *> streams(nRegs, nullptr);
+    for (size_t j = 0; j < regs.size(); j++)
+      streams[regs[j]] = data + j * streamSize;
+    return std::make_shared<const HashStreams>(std::move(storage), std::move(streams), nPkts, nHashes);
+  };
+
+  HashStreamsHeader hdr{};
+  std::string digest = hexDigest(signature);
+  memcpy(hdr.magic, HASH_STREAMS_MAGIC, sizeof(hdr.magic));
+  memcpy(hdr.signature, digest.data(), sizeof(hdr.signature));
+  hdr.nPkts = nPkts;
+  hdr.nStreams = regs.size();
+  hdr.nHashes = nHashes;
+  size_t fileSize = sizeof(hdr) + regs.size() * streamSize * sizeof(uint32_t);
+  std::string cachePath;
+  if (!signature.empty() && sourceMtime(traceConf, hdr.sourceMtime))
+    cachePath = traceConf.path + ".hashes-" + digest + "-" + std::to_string(epochs.nEpoch()) + "-" + std::to_string(nHashes) + ".bin";
+  if (!cachePath.empty() && access(cachePath.c_str(), R_OK) == 0) {
+    size_t fsize;
+    auto storage = mapFile(cachePath.c_str(), fsize);
+    if (fsize == fileSize && memcmp(storage.get(), &hdr, sizeof(hdr)) == 0) {
+      spdlog::info("loaded hash streams {}", cachePath);
+      auto data = reinterpret_cast<const uint32_t *>(static_cast<const char *>(storage.get()) + sizeof(hdr));
+      return view(std::move(storage), data);
+    }
+  }
+
+  // with a cache file, the threads write into a shared mapping of it rather
+  // than into memory of the process
+  std::string tmpPath = cachePath + ".tmp" + std::to_string(getpid());
+  std::shared_ptr<std::vector<uint32_t>> heap;
+  uint32_t *hashes;
+  char *addr = nullptr;
+  if (cachePath.empty()) {
+    heap = std::make_shared<std::vector<uint32_t>>(regs.size() * streamSize);
+    hashes = heap->data();
+  } else {
+    int fd = open(tmpPath.c_str(), O_RDWR | O_CREAT | O_TRUNC, 0644);
+    if (fd < 0)
+      throw std::runtime_error(std::string("open: ") + strerror(errno));
+    if (ftruncate(fd, fileSize) < 0) {
+      int err = errno;
+      close(fd);
+      unlink(tmpPath.c_str());
+      throw std::runtime_error(std::string("ftruncate: ") + strerror(err));
+    }
+    void *p = mmap(nullptr, fileSize, PROT_READ | PROT_WRITE, MAP_SHARED, fd, 0);
+    int err = errno;
+    close(fd);
+    if (p == MAP_FAILED) {
+      unlink(tmpPath.c_str());
+      throw std::runtime_error(std::string("mmap: ") + strerror(err));
+    }
+    addr = static_cast<char *>(p);
+    memcpy(addr, &hdr, sizeof(hdr));
+    hashes = reinterpret_cast<uint32_t *>(addr + sizeof(hdr));
+  }
+
+  size_t nThreads = std::max<size_t>(1, traceConf.epochThreads);
+  std::vector<std::thread> threads;
+  for (size_t t = 0; t < nThreads; t++)
+    threads.emplace_back([&, t]() {
+      std::vector<uint32_t *> out(nRegs, nullptr);
+      for (size_t i = nPkts * t / nThreads; i < nPkts * (t + 1) / nThreads; i++) {
+        for (size_t j = 0; j < regs.size(); j++)
+          out[regs[j]] = hashes + j * streamSize + i * nHashes;
+        hashPkt(traceConf.columns ? (*traceConf.columns)[i] : (*traceConf.trace)[i], out.data());
+      }
+    });
+  for (auto &t : threads)
+    t.join();
+  spdlog::info("hashed the indices of {} registers for {} packets", regs.size(), nPkts);
+
+  if (cachePath.empty())
+    return view(std::move(heap), hashes);
+  if (munmap(addr, fileSize) < 0 || rename(tmpPath.c_str(), cachePath.c_str()) < 0) {
+    unlink(tmpPath.c_str());
+    throw std::runtime_error(std::string("cannot write hash streams: ") + strerror(errno));
+  }
+  size_t fsize;
+  auto storage = mapFile(cachePath.c_str(), fsize);
+  auto data = reinterpret_cast<const uint32_t *>(static_cast<const char *>(storage.get()) + sizeof(hdr));
+  return view(std::move(storage), data);
+}
+
+// Per-epoch statistics a representative subset of epochs should preserve:
+// the packets, the distinct keys and heavy-hitter mass of every key the query
+// counts by, and the size of the exact result.
+using EpochFeatures = std::vector<double>;
+
+// The keys are the indices of registers regs, which hashPkt(pkt, out) hashes
+// as hashTrace() does; two hashes of an index make its fingerprint. Without
+// any, the IP sources, destinations and pairs stand in for them. Heavy-hitter
+// mass is the share of packets with the busiest 1% of keys. Names the
+// features in names.
+template <typename HashPkt>
+std::vector<EpochFeatures> epochFeatures(const TraceConf &traceConf, const std::vector<size_t> &resultSizes,
+                                         const std::vector<size_t> &regs, HashPkt hashPkt, std::vector<std::string> &names) {
+  size_t nKeys = regs.empty() ? 3 : regs.size();
+  const char *ipKeys[] = {"sources", "destinations", "pairs"};
+  names = {"packets"};
+  for (size_t j = 0; j < nKeys; j++) {
+    std::string key = regs.empty() ? ipKeys[j] : fmt::format("register {}", regs[j]);
+    names.push_back(regs.empty() ? key : key + " keys");
+    names.push_back(key + " heavy-hitter mass");
+  }
+  names.push_back("baseline results");
+
+  size_t nRegs = regs.empty() ? 0 : *std::max_element(regs.begin(), regs.end()) + 1;
+  std::vector<std::array<uint32_t, 2>> hashes(nRegs);
+  std::vector<uint32_t *> out(nRegs, nullptr);
+  for (size_t r = 0; r < nRegs; r++)
+    out[r] = hashes[r].data();
+  std::vector<EpochFeatures> res;
+  std::vector<HashMap<uint64_t, uint32_t>> cnts(nKeys);
+  size_t nPkts = 0;
+  scanEpochs(traceConf, [&](const PktInfo &pkt) {
+    nPkts++;
+    if (regs.empty()) {
+      cnts[0][pkt.key.src_ip]++;
+      cnts[1][pkt.key.dst_ip]++;
+      cnts[2][static_cast<uint64_t>(pkt.key.src_ip) << 32 | pkt.key.dst_ip]++;
+      return;
+    }
+    hashPkt(pkt, out.data());
+    for (size_t j = 0; j < nKeys; j++)
+      cnts[j][static_cast<uint64_t>(hashes[regs[j]][0]) << 32 | hashes[regs[j]][1]]++;
+  }, [&]() {
+    EpochFeatures f{static_cast<double>(nPkts)};
+    for (auto &keys : cnts) {
+      std::vector<uint32_t> v;
+      for (const auto &c : keys)
+        v.push_back(c.second);
+      size_t nHeavy = std::max<size_t>(1, v.size() / 100);
+      double heavy = 0;
+      if (!v.empty()) {
+        std::nth_element(v.begin(), v.begin() + nHeavy - 1, v.end(), std::greater<uint32_t>());
+        for (size_t i = 0; i < nHeavy; i++)
+          heavy += v[i];
+      }
+      f.push_back(static_cast<double>(keys.size()));
+      f.push_back(nPkts ? heavy / nPkts : 0.0);
+      keys.clear();
+    }
+    f.push_back(static_cast<double>(resultSizes.at(res.size())));
+    res.push_back(std::move(f));
+    nPkts = 0;
+    return true;
+  });
+  return res;
+}
+
+// Picks k epochs whose features cover all epochs best: greedily adds the
+// epoch that most reduces the total distance from every epoch to its
+// nearest pick (k-medoids), on standardized log features.
+inline std::vector<size_t> selectEpochs(const std::vector<EpochFeatures> &features, size_t k) {
+  size_t n = features.size();
+  std::vector<size_t> res;
+  if (k >= n) {
+    res.resize(n);
+    std::iota(res.begin(), res.end(), 0);
+    return res;
+  }
+
+  size_t nFeatures = n ? features[0].size() : 0;
+  std::vector<EpochFeatures> z(n, EpochFeatures(nFeatures));
+  for (size_t f = 0; f < nFeatures; f++) {
+    double mean = 0, var = 0;
+    for (size_t i = 0; i < n; i++) {
+      z[i][f] = std::log1p(features[i][f]);
+      mean += z[i][f] / n;
+    }
+    for (size_t i = 0; i < n; i++)
+      var += (z[i][f] - mean) * (z[i][f] - mean) / n;
+    for (size_t i = 0; i < n; i++)
+      z[i][f] = var > 0 ? (z[i][f] - mean) / std::sqrt(var) : 0.0;
+  }
+  auto dist = [&](size_t i, size_t j) {
+    double d = 0;
+    for (size_t f = 0; f < nFeatures; f++)
+      d += (z[i][f] - z[j][f]) * (z[i][f] - z[j][f]);
+    return std::sqrt(d);
+  };
+
+  std::vector<double> nearest(n, std::numeric_limits<double>::infinity());
+  std::vector<bool> picked(n);
+  while (res.size() < k) {
+    size_t best = n;
+    double bestCost = std::numeric_limits<double>::infinity();
+    for (size_t j = 0; j < n; j++) {
+      if (picked[j])
+        continue;
+      double cost = 0;
+      for (size_t i = 0; i < n; i++)
+        cost += std::min(nearest[i], dist(i, j));
+      if (cost < bestCost) {
+        best = j;
+        bestCost = cost;
+      }
+    }
+    picked[best] = true;
+    res.push_back(best);
+    for (size_t i = 0; i < n; i++)
+      nearest[i] = std::min(nearest[i], dist(i, best));
+  }
+  std::sort(res.begin(), res.end());
+  return res;
+}
+
+// Selects k representative epochs of a trace by the features of
+// epochFeatures() and logs how far the mean of each feature over them is from
+// the mean over all epochs.
+template <typename HashPkt>
+std::vector<size_t> representativeEpochs(const TraceConf &traceConf, const std::vector<size_t> &resultSizes, size_t k,
+                                         const std::vector<size_t> &regs, HashPkt hashPkt) {
+  std::vector<std::string> names;
+  auto features = epochFeatures(traceConf, resultSizes, regs, hashPkt, names);
+  auto res = selectEpochs(features, k);
+  spdlog::info("representative epochs: {}", fmt::join(res, ", "));
+  for (size_t f = 0; f < names.size(); f++) {
+    double all = 0, sub = 0;
+    for (const auto &v : features)
+      all += v[f] / features.size();
+    for (size_t e : res)
+      sub += features[e][f] / res.size();
+    spdlog::info("{}: mean {:.4g} on all epochs, {:.4g} on the subset ({:+.1f}%)",
+      names[f], all, sub, all != 0 ? (sub - all) / all * 100 : 0.0);
+  }
+  return res;
+}
+
+// Tells whether a set of points holds one that is at most a query point in
+// every coordinate. The points are kept in a k-d tree whose nodes know the
+// least value of each coordinate in their subtree, so a query skips every
+// subtree without a candidate. Points at least some known point are not
+// inserted, so that the tree stays at the Pareto front.
+template <size_t N_DIM>
+class DominanceIndex {
+public:
+  using Point = std::array<int64_t, N_DIM>;
+
+private:
+  static constexpr uint32_t NONE = UINT32_MAX;
+
+  struct Node {
+    Point p, lo;  // the point, and the least coordinates in the subtree
+    uint32_t left = NONE, right = NONE;
+  };
+  std::vector<Node> nodes_;
+
+  static bool leq(const Point &x, const Point &y) {
+    for (size_t i = 0; i < N_DIM; i++)
+      if (x[i] > y[i])
+        return false;
+    return true;
+  }
+
+public:
+  size_t size() const {
+    return nodes_.size();
+  }
+
+  bool dominated(const Point &q) const {
+    if (nodes_.empty())
+      return false;
+    std::vector<uint32_t> stack{0};
+    while (!stack.empty()) {
+      const Node &n = nodes_[stack.back()];
+      stack.pop_back();
+      if (!leq(n.lo, q))
+        continue;
+      if (leq(n.p, q))
+        return true;
+      if (n.left != NONE)
+        stack.push_back(n.left);
+      if (n.right != NONE)
+        stack.push_back(n.right);
+    }
+    return false;
+  }
+
+  void insert(const Point &p) {
+    if (dominated(p))
+      return;
+    uint32_t id = nodes_.size();
+    if (nodes_.empty()) {
+      nodes_.push_back({p, p});
+      return;
+    }
+    uint32_t i = 0;
+    for (size_t depth = 0;; depth++) {
+      Node &n = nodes_[i];
+      for (size_t k = 0; k < N_DIM; k++)
+        n.lo[k] = std::min(n.lo[k], p[k]);
+      size_t axis = depth % N_DIM;
+      uint32_t &child = p[axis] < n.p[axis] ? n.left : n.right;
+      if (child == NONE) {
+        child = id;
+        break;
+      }
+      i = child;
+    }
+    nodes_.push_back({p, p});
+  }
 };
 
 template <size_t N_REGS>
@@ -65,66 +715,587 @@ public:
     }
   };
 
+  // Per-epoch metrics of evaluated configurations, appended to a file so
+  // that later runs only simulate the epochs they have not seen yet.
+  class MetricStore {
+    static constexpr char MAGIC[8] = {'A', 'S', 'M', 'E', 'T', 'R', 'C', '2'};
+
+    struct Header {
+      char magic[8];
+      char key[16];
+      uint64_t nRegs;
+      uint64_t nMetrics;
+    };
+    // followed by records of uint32_t d, w per register, uint32_t epoch and
+    // nMetrics doubles
+
+    struct Key {
+      AppConf c;
+      uint64_t epoch;
+    };
+
+    std::mutex mtx_;
+    FILE *fp_ = nullptr;
+    size_t nMetrics_;
+    HashMap<Key, EpochMetrics> metrics_;
+
+    size_t recordSize() const {
+      return (2 * N_REGS + 1) * sizeof(uint32_t) + nMetrics_ * sizeof(double);
+    }
+
+  public:
+    MetricStore(const std::string &path, const std::string &key, size_t nMetrics)
+      : nMetrics_(nMetrics) {
+      Header hdr{};
+      memcpy(hdr.magic, MAGIC, sizeof(hdr.magic));
+      memcpy(hdr.key, key.data(), std::min(key.size(), sizeof(hdr.key)));
+      hdr.nRegs = N_REGS;
+      hdr.nMetrics = nMetrics;
+
+      size_t fsize = 0;
+      std::shared_ptr<const void> storage;
+      if (access(path.c_str(), R_OK) == 0)
+        storage = mapFile(path.c_str(), fsize);
+      auto data = static_cast<const char *>(storage.get());
+      size_t n = 0;
+      if (fsize >= sizeof(hdr) && memcmp(data, &hdr, sizeof(hdr)) == 0) {
+        // a crash may leave a partial record at the end
+        n = (fsize - sizeof(hdr)) / recordSize();
+        for (size_t i = 0; i < n; i++) {
+          std::vector<uint32_t> ints(2 * N_REGS + 1);
+          const char *p = data + sizeof(hdr) + i * recordSize();
+          memcpy(ints.data(), p, ints.size() * sizeof(uint32_t));
+          Key k{};
+          for (size_t r = 0; r < N_REGS; r++)
+            k.c[r] = {ints[2 * r], ints[2 * r + 1]};
+          k.epoch = ints[2 * N_REGS];
+          EpochMetrics m(nMetrics);
+          memcpy(m.data(), p + ints.size() * sizeof(uint32_t), nMetrics * sizeof(double));
+          metrics_[k] = std::move(m);
+        }
+        spdlog::info("loaded {} epoch metrics from {}", n, path);
+      }
+
+      fp_ = fopen(path.c_str(), n > 0 ? "r+b" : "wb");
+      if (!fp_)
+        throw std::runtime_error(std::string("fopen: ") + strerror(errno));
+      if (n == 0 && fwrite(&hdr, sizeof(hdr), 1, fp_) != 1)
+        throw std::runtime_error(std::string("cannot write metrics: ") + strerror(errno));
+      fseek(fp_, sizeof(hdr) + n * recordSize(), SEEK_SET);
+    }
+    ~MetricStore() {
+      fclose(fp_);
+    }
+
+    bool get(AppConf c, size_t epoch, EpochMetrics &m) {
+      std::lock_guard<std::mutex> lck{mtx_};
+      auto p = metrics_.find(Key{c, epoch});
+      if (p == metrics_.end())
+        return false;
+      m = p->second;
+      return true;
+    }
+    void put(AppConf c, size_t epoch, const EpochMetrics &m) {
+      assert(m.size() == nMetrics_);
+      std::lock_guard<std::mutex> lck{mtx_};
+      metrics_[Key{c, epoch}] = m;
+      std::vector<uint32_t> ints;
+      for (RegConf rc : c) {
+        ints.push_back(rc.d);
+        ints.push_back(rc.w);
+      }
+      ints.push_back(epoch);
+      if (fwrite(ints.data(), sizeof(uint32_t), ints.size(), fp_) != ints.size()
+          || fwrite(m.data(), sizeof(double), m.size(), fp_) != m.size()
+          || fflush(fp_) != 0)
+        throw std::runtime_error(std::string("cannot write metrics: ") + strerror(errno));
+    }
+  };
+
   class QueryBase {
   public:
     virtual ~QueryBase() = default;
+    virtual TraceConf prefilter(TraceConf traceConf) = 0;
+    // Precomputes the index hashes of registers up to nHashes rows deep if
+    // traceConf.hashStreams is set.
+    virtual TraceConf prehash(TraceConf traceConf, size_t nHashes) = 0;
     virtual void runBaseline(TraceConf traceConf) = 0;
-    virtual bool eval(TraceConf traceConf, AppConf c) = 0;
+    virtual std::vector<size_t> baselineSizes() const = 0;
+    // Picks k epochs of the trace whose statistics for this query represent
+    // all of them, see ::representativeEpochs(); needs the baseline.
+    virtual std::vector<size_t> representativeEpochs(const TraceConf &traceConf, size_t k) = 0;
+    // Distinct keys each register of the exact query held in each epoch of
+    // the last baseline run, as selected by useBaselineEpochs().
+    virtual std::vector<std::vector<size_t>> registerKeys() const = 0;
+    // Cells per page of each register, empty if unknown.
+    virtual std::vector<size_t> registerCells() const {
+      return {};
+    }
+    // Share of keys a register may get wrong, from the accuracy targets.
+    virtual double errorBudget() const {
+      return 0.05;
+    }
+    // Compares results with the given epochs of the last baseline run only;
+    // an empty list restores all of them.
+    virtual void useBaselineEpochs(const std::vector<size_t> &epochs) = 0;
+    // Evaluates on the given epochs of the trace only, all of them if empty,
+    // with every accuracy target relaxed by margin.
+    virtual bool eval(TraceConf traceConf, AppConf c, Accuracy *acc = nullptr,
+                      const std::vector<size_t> &epochs = {}, double margin = 0) = 0;
+    // Evaluates several configurations in one pass over the trace.
+    virtual std::vector<bool> evalBatch(TraceConf traceConf, const std::vector<AppConf> &cs, std::vector<Accuracy> *accs = nullptr,
+                                        const std::vector<size_t> &epochs = {}, double margin = 0) = 0;
+    // Identifies the query for cached results; empty disables them.
+    virtual std::string querySignature() const {
+      return "";
+    }
   };
 
   template <typename Result>
   class Query : public QueryBase {
   public:
     class AppInstanceBase {
+    public:
+      // Called with the index and the result of every epoch as it completes;
+      // returning false stops the run.
+      using OnEpoch = std::function<bool(size_t, const Result &)>;
+
+    private:
+      std::vector<Result> runStream(const TraceConf &traceConf, const OnEpoch &onEpoch) {
+        std::vector<Result> res;
+        scanEpochs(traceConf, [this](const PktInfo &pkt) {
+          process(pkt);
+        }, [&]() {
+          res.push_back(switchWin());
+          return !onEpoch || onEpoch(res.size() - 1, res.back());
+        });
+        return res;
+      }
+
+      void processRange(const TraceConf &traceConf, size_t first, size_t last) {
+        const HashStreams *hashes = traceConf.hashes.get();
+        if (traceConf.columns) {
+          const ColumnTrace &t = *traceConf.columns;
+          for (size_t i = first; i < last; i++) {
+            if (hashes)
+              useHashes(hashes, i);
+            processColumns(t, i);
+          }
+        } else {
+          const PktInfo *pkts = traceConf.trace->data();
+          for (size_t i = first; i < last; i++) {
+            if (hashes)
+              useHashes(hashes, i);
+            process(pkts[i]);
+          }
+        }
+        if (hashes)
+          useHashes(nullptr, 0);
+      }
+
     protected:
       virtual void process(PktInfo pkt) = 0;
+      // Reads only the columns the query uses; see ColumnTrace.
+      virtual void processColumns(const ColumnTrace &t, size_t i) {
+        throw std::logic_error("unsupported operation");
+      }
       virtual Result switchWin() = 0;
+      // Points the registers at the hashes of packet i, see
+      // Register::useHashes(); null hashes detach them.
+      virtual void useHashes(const HashStreams *hashes, size_t i) {
+      }
 
     public:
       virtual ~AppInstanceBase() = default;
 
-      std::vector<Result> run(TraceConf traceConf) {
+      // Register::lastEpochKeys() of each register.
+      virtual std::vector<size_t> lastEpochKeys() const {
+        return {};
+      }
+
+      // Runs epoch e of the trace alone; traceConf.epochs must be set.
+      Result runEpoch(const TraceConf &traceConf, size_t e) {
+        const EpochIndex &epochs = *traceConf.epochs;
+        if (traceConf.stream) {
+          TraceConf one = traceConf;
+          one.epochs = std::make_shared<const EpochIndex>(epochs.select({e}));
+          return std::move(runStream(one, nullptr).at(0));
+        }
+        processRange(traceConf, epochs.begin(e), epochs.end(e));
+        return switchWin();
+      }
+
+      // Runs the epochs of the trace on all instances in one pass, feeding
+      // each block of packets to every instance while it is still in cache.
+      // Instance k skips epoch e unless wants(k, e) and stops once onEpoch(k,
+      // e, result) returns false.
+      static void runBatch(const TraceConf &traceConf, const std::vector<std::unique_ptr<AppInstanceBase>> &instances,
+                           const std::function<bool(size_t, size_t)> &wants,
+                           const std::function<bool(size_t, size_t, const Result &)> &onEpoch) {
+        constexpr size_t BLOCK_PKTS = 1024;
+        const EpochIndex &epochs = *traceConf.epochs;
+        std::vector<uint8_t> stopped(instances.size());
+        std::vector<size_t> fed;
+        auto startEpoch = [&](size_t e) {
+          fed.clear();
+          for (size_t k = 0; k < instances.size(); k++)
+            if (!stopped[k] && wants(k, e))
+              fed.push_back(k);
+        };
+        auto finishEpoch = [&](size_t e) {
+          for (size_t k : fed)
+            if (!onEpoch(k, e, instances[k]->switchWin()))
+              stopped[k] = 1;
+          return std::find(stopped.begin(), stopped.end(), 0) != stopped.end();
+        };
+
+        if (traceConf.stream) {
+          size_t e = 0;
+          startEpoch(e);
+          scanEpochs(traceConf, [&](const PktInfo &pkt) {
+            for (size_t k : fed)
+              instances[k]->process(pkt);
+          }, [&]() {
+            if (!finishEpoch(e))
+              return false;
+            if (++e < epochs.nEpoch())
+              startEpoch(e);
+            return true;
+          });
+          return;
+        }
+        for (size_t e = 0; e < epochs.nEpoch(); e++) {
+          startEpoch(e);
+          for (size_t first = epochs.begin(e); first < epochs.end(e); first += BLOCK_PKTS) {
+            size_t last = std::min(first + BLOCK_PKTS, epochs.end(e));
+            for (size_t k : fed)
+              instances[k]->processRange(traceConf, first, last);
+          }
+          if (!finishEpoch(e))
+            return;
+        }
+      }
+
+      std::vector<Result> run(TraceConf traceConf, const OnEpoch &onEpoch = nullptr) {
         spdlog::debug("start running");
+        if (!traceConf.epochs)
+          indexEpochs(traceConf);
+        const EpochIndex &epochs = *traceConf.epochs;
         std::vector<Result> res;
-        size_t curEpoch = 0;
-        double startTime = traceConf.trace->at(0).pkt_ts;
-        for (PktInfo pkt : *traceConf.trace) {
-          while (pkt.pkt_ts - startTime >= traceConf.interval) {
-            res.push_back(switchWin());
-            startTime += traceConf.interval;
-            // spdlog::debug("passing epoch {}", curEpoch);
-
-            if (++curEpoch == traceConf.nEpoch)
-              goto DONE;
+        if (traceConf.stream) {
+          res = runStream(traceConf, onEpoch);
+        } else {
+          for (size_t e = 0; e < epochs.nEpoch(); e++) {
+            res.push_back(runEpoch(traceConf, e));
+            if (onEpoch && !onEpoch(e, res.back()))
+              break;
           }
-          process(pkt);
         }
-      DONE:
-        spdlog::debug("finished running with {} epoches", curEpoch);
-        if (curEpoch < traceConf.nEpoch)
-          throw std::runtime_error("finished in epoch " + std::to_string(curEpoch) + "/" + std::to_string(traceConf.nEpoch));
+        spdlog::debug("finished running with {} of {} epoches", res.size(), epochs.nEpoch());
         return res;
       }
     };
 
   protected:
     std::vector<Result> resBaseline_;
+    std::vector<Result> resBaselineAll_;  // all epochs while resBaseline_ holds some
+    std::vector<std::vector<size_t>> keysBaseline_, keysBaselineAll_;  // lastEpochKeys() alongside them
+    std::shared_ptr<MetricStore> metricStore_;
 
     virtual std::unique_ptr<AppInstanceBase> createInstanceBaseline() = 0;
     virtual std::unique_ptr<AppInstanceBase> createInstance(AppConf c) = 0;
-    virtual bool evaluateResult(const std::vector<Result> &res, AppConf c) = 0;
+
+    // Like AppInstanceBase::run(), but spreads the epochs over
+    // traceConf.epochThreads instances made by create, which is fine since
+    // switchWin() resets the registers. Results and onEpoch calls are still in
+    // epoch order. If keys is set, it gets the lastEpochKeys() of every epoch
+    // run.
+    std::vector<Result> runEpochs(TraceConf traceConf, const std::function<std::unique_ptr<AppInstanceBase>()> &create,
+                                  const typename AppInstanceBase::OnEpoch &onEpoch = nullptr,
+                                  std::vector<std::vector<size_t>> *keys = nullptr) {
+      if (!traceConf.epochs)
+        indexEpochs(traceConf);
+      size_t nEpoch = traceConf.epochs->nEpoch();
+      size_t nWorkers = std::min(traceConf.epochThreads, nEpoch);
+      if (keys)
+        keys->clear();
+      if (nWorkers <= 1) {
+        auto instance = create();
+        return instance->run(traceConf, [&](size_t e, const Result &r) {
+          if (keys)
+            keys->push_back(instance->lastEpochKeys());
+          return !onEpoch || onEpoch(e, r);
+        });
+      }
+
+      spdlog::debug("running {} epochs on {} threads", nEpoch, nWorkers);
+      std::vector<Result> res(nEpoch);
+      if (keys)
+        keys->resize(nEpoch);
+      std::vector<uint8_t> finished(nEpoch);
+      size_t next = 0, delivered = 0;
+      bool stop = false;
+      std::exception_ptr error;
+      std::mutex mtx;
+      auto worker = [&]() {
+        std::unique_lock<std::mutex> lck{mtx};
+        try {
+          lck.unlock();
+          auto instance = create();
+          lck.lock();
+          while (!stop && next < nEpoch) {
+            size_t e = next++;
+            lck.unlock();
+            Result r = instance->runEpoch(traceConf, e);
+            if (keys)
+              (*keys)[e] = instance->lastEpochKeys();
+            lck.lock();
+            res[e] = std::move(r);
+            finished[e] = 1;
+            for (; !stop && delivered < nEpoch && finished[delivered]; delivered++)
+              if (onEpoch && !onEpoch(delivered, res[delivered]))
+                stop = true;
+          }
+        } catch (...) {
+          if (!lck.owns_lock())
+            lck.lock();
+          if (!error)
+            error = std::current_exception();
+          stop = true;
+        }
+      };
+      std::vector<std::thread> threads;
+      for (size_t i = 0; i < nWorkers; i++)
+        threads.emplace_back(worker);
+      for (auto &t : threads)
+        t.join();
+      if (error)
+        std::rethrow_exception(error);
+      res.resize(delivered);
+      if (keys)
+        keys->resize(delivered);
+      return res;
+    }
+    virtual std::vector<std::string> metricNames() const = 0;
+    // Metrics of the result of the i-th epoch against resBaseline_[i].
+    virtual EpochMetrics epochMetrics(const Result &res, size_t i) const = 0;
+    // Whether metrics of all epochs meet the accuracy requirements, each
+    // relaxed by margin.
+    virtual bool decide(std::vector<EpochMetrics> metrics, AppConf c, Accuracy *acc, double margin) = 0;
+    // Whether the requirements are missed whatever the other epochs of
+    // nEpoch in total give, given the metrics of some of them.
+    virtual bool unreachable(const std::vector<EpochMetrics> &metrics, size_t nEpoch, double margin) const {
+      return false;
+    }
+    // The query's stateless packet filters; an empty signature means none.
+    virtual bool filterPacket(const PktInfo &pkt) const {
+      return true;
+    }
+    virtual std::string filterSignature() const {
+      return "";
+    }
+    // Registers whose index is a function of the packet alone, and the
+    // hashes of their indices for a packet, written as indexHashes() does
+    // to out[k] for register k.
+    virtual std::vector<size_t> hashedRegisters() const {
+      return {};
+    }
+    virtual void hashIndices(const PktInfo &pkt, size_t nHashes, uint32_t *const *out) const {
+    }
 
   public:
+    using QueryBase::querySignature;
+    TraceConf prefilter(TraceConf traceConf) override {
+      std::string signature = filterSignature();
+      if (signature.empty())
+        return traceConf;
+      return filterTrace(std::move(traceConf), signature, [this](const PktInfo &pkt) {
+        return filterPacket(pkt);
+      });
+    }
+    TraceConf prehash(TraceConf traceConf, size_t nHashes) override {
+      auto regs = hashedRegisters();
+      // a streamed trace has no packet positions to look hashes up by
+      if (!traceConf.hashStreams || traceConf.stream || regs.empty() || nHashes == 0)
+        return traceConf;
+      if (!traceConf.epochs)
+        indexEpochs(traceConf);
+      traceConf.hashes = hashTrace(traceConf, querySignature(), regs, nHashes, [&](const PktInfo &pkt, uint32_t *const *out) {
+        hashIndices(pkt, nHashes, out);
+      });
+      return traceConf;
+    }
     void runBaseline(TraceConf traceConf) override {
-      resBaseline_ = createInstanceBaseline()->run(std::move(traceConf));
+      resBaselineAll_.clear();
+      keysBaselineAll_.clear();
+      if (!traceConf.epochs)
+        indexEpochs(traceConf);
+      openMetricStore(traceConf);
+
+      BaselineHeader hdr{};
+      std::string cachePath;
+      if (traceConf.baselineCache && !querySignature().empty() && sourceMtime(traceConf, hdr.sourceMtime)) {
+        std::string digest = hexDigest(querySignature());
+        memcpy(hdr.magic, BASELINE_MAGIC, sizeof(hdr.magic));
+        memcpy(hdr.signature, digest.data(), sizeof(hdr.signature));
+        hdr.sourcePkts = traceConf.nPkts();
+        hdr.nEpoch = traceConf.epochs->nEpoch();
+        hdr.interval = traceConf.interval;
+        hdr.itemSize = resultItemSize(static_cast<const Result *>(nullptr));
+        cachePath = traceConf.path + ".baseline-" + digest + "-" + std::to_string(hdr.nEpoch) + ".bin";
+        if (readBaseline(cachePath.c_str(), hdr, resBaseline_, keysBaseline_)) {
+          spdlog::info("loaded baseline {}", cachePath);
+          return;
+        }
+      }
+
+      resBaseline_ = runEpochs(traceConf, [this]() {
+        return createInstanceBaseline();
+      }, nullptr, &keysBaseline_);
+      if (!cachePath.empty())
+        writeBaseline(cachePath.c_str(), hdr, resBaseline_, keysBaseline_);
+    }
+    // Epochs keep their boundaries as nEpoch grows, so the metrics of an
+    // epoch hold for any nEpoch of the same trace and interval.
+    void openMetricStore(const TraceConf &traceConf) {
+      metricStore_ = nullptr;
+      int64_t mtime;
+      if (!traceConf.metricStore || querySignature().empty() || !sourceMtime(traceConf, mtime))
+        return;
+      std::string names;
+      for (const auto &v : metricNames())
+        names += v + ",";
+      std::string key = hexDigest(fmt::format("{}|{}|{}|{}", querySignature(), mtime, traceConf.interval, names));
+      metricStore_ = std::make_shared<MetricStore>(traceConf.path + ".metrics-" + key + ".bin", key, metricNames().size());
+    }
+    std::vector<size_t> baselineSizes() const override {
+      std::vector<size_t> res;
+      for (const auto &v : resBaseline_)
+        res.push_back(v.size());
+      return res;
+    }
+    std::vector<size_t> representativeEpochs(const TraceConf &traceConf, size_t k) override {
+      return ::representativeEpochs(traceConf, baselineSizes(), k, hashedRegisters(), [this](const PktInfo &pkt, uint32_t *const *out) {
+        hashIndices(pkt, 2, out);
+      });
     }
-    bool eval(TraceConf traceConf, AppConf c) override {
-      std::string strC = "[";
-      for (size_t i = 0; i < N_REGS; i++)
-        strC += fmt::format("({}, {}), ", c[i].d, c[i].w);
-      strC += "]";
-      spdlog::debug("evaluating {}", strC);
-      return evaluateResult(createInstance(c)->run(std::move(traceConf)), c);
+    std::vector<std::vector<size_t>> registerKeys() const override {
+      return keysBaseline_;
+    }
+    void useBaselineEpochs(const std::vector<size_t> &epochs) override {
+      if (!resBaselineAll_.empty()) {
+        resBaseline_ = std::move(resBaselineAll_);
+        keysBaseline_ = std::move(keysBaselineAll_);
+      }
+      resBaselineAll_.clear();
+      keysBaselineAll_.clear();
+      if (epochs.empty())
+        return;
+      resBaselineAll_ = std::move(resBaseline_);
+      keysBaselineAll_ = std::move(keysBaseline_);
+      resBaseline_.clear();
+      keysBaseline_.clear();
+      for (size_t e : epochs) {
+        resBaseline_.push_back(resBaselineAll_.at(e));
+        keysBaseline_.push_back(keysBaselineAll_.at(e));
+      }
+    }
+    bool eval(TraceConf traceConf, AppConf c, Accuracy *acc = nullptr,
+              const std::vector<size_t> &epochs = {}, double margin = 0) override {
+      std::vector<Accuracy> accs;
+      bool succ = evalBatch(std::move(traceConf), {c}, &accs, epochs, margin)[0];
+      if (acc)
+        *acc = std::move(accs[0]);
+      return succ;
+    }
+    std::vector<bool> evalBatch(TraceConf traceConf, const std::vector<AppConf> &cs, std::vector<Accuracy> *accs = nullptr,
+                                const std::vector<size_t> &epochs = {}, double margin = 0) override {
+      for (AppConf c : cs) {
+        std::string strC = "[";
+        for (size_t i = 0; i < N_REGS; i++)
+          strC += fmt::format("({}, {}), ", c[i].d, c[i].w);
+        strC += "]";
+        spdlog::debug("evaluating {}", strC);
+      }
+
+      if (!traceConf.epochs)
+        indexEpochs(traceConf);
+      auto allEpochs = traceConf.epochs;
+      const EpochIndex &index = *allEpochs;
+      std::vector<size_t> positions = epochs;
+      if (positions.empty()) {
+        positions.resize(index.nEpoch());
+        std::iota(positions.begin(), positions.end(), 0);
+      } else {
+        for (AppConf c : cs)
+          spdlog::info("screening {} on {} of {} epochs", c.str(), positions.size(), index.nEpoch());
+      }
+
+      // metrics[k][i] belongs to candidate k and epoch positions[i] of the index
+      size_t n = positions.size(), nCand = cs.size();
+      std::vector<std::vector<EpochMetrics>> metrics(nCand, std::vector<EpochMetrics>(n)), done(nCand);
+      std::vector<std::vector<uint8_t>> stored(nCand, std::vector<uint8_t>(n));
+      std::vector<uint8_t> aborted(nCand);
+      for (size_t k = 0; k < nCand; k++) {
+        for (size_t i = 0; i < n; i++)
+          if (metricStore_ && metricStore_->get(cs[k], index.id(positions[i]), metrics[k][i])) {
+            stored[k][i] = 1;
+            done[k].push_back(metrics[k][i]);
+          }
+        // most candidates fail on a few epochs, stop simulating once they do
+        aborted[k] = unreachable(done[k], n, margin);
+      }
+      std::vector<size_t> missing;
+      for (size_t i = 0; i < n; i++)
+        for (size_t k = 0; k < nCand; k++)
+          if (!aborted[k] && !stored[k][i]) {
+            missing.push_back(i);
+            break;
+          }
+
+      if (!missing.empty()) {
+        if (missing.size() < index.nEpoch()) {
+          std::vector<size_t> simulated;
+          for (size_t i : missing)
+            simulated.push_back(positions[i]);
+          spdlog::debug("simulating {} of {} epochs", simulated.size(), index.nEpoch());
+          traceConf.epochs = std::make_shared<const EpochIndex>(index.select(simulated));
+        }
+        auto onEpoch = [&](size_t k, size_t j, const Result &res) {
+          size_t i = missing[j], e = positions[i];
+          metrics[k][i] = epochMetrics(res, e);
+          if (metricStore_)
+            metricStore_->put(cs[k], index.id(e), metrics[k][i]);
+          done[k].push_back(metrics[k][i]);
+          aborted[k] = unreachable(done[k], n, margin);
+          return !aborted[k];
+        };
+        if (nCand == 1) {
+          runEpochs(traceConf, [&]() {
+            return createInstance(cs[0]);
+          }, [&](size_t j, const Result &res) {
+            return onEpoch(0, j, res);
+          });
+        } else {
+          std::vector<std::unique_ptr<AppInstanceBase>> instances;
+          for (AppConf c : cs)
+            instances.push_back(createInstance(c));
+          AppInstanceBase::runBatch(traceConf, instances, [&](size_t k, size_t j) {
+            return !aborted[k] && !stored[k][missing[j]];
+          }, onEpoch);
+        }
+      }
+
+      std::vector<bool> res(nCand);
+      if (accs)
+        accs->assign(nCand, Accuracy());
+      for (size_t k = 0; k < nCand; k++) {
+        if (aborted[k])
+          spdlog::info("[failure] {}: missed after {} of {} epochs", cs[k].str(), done[k].size(), n);
+        else
+          res[k] = decide(std::move(metrics[k]), cs[k], accs ? &(*accs)[k] : nullptr, margin);
+      }
+      return res;
     }
   };
 
@@ -133,24 +1304,130 @@ private:
   TraceConf traceConf_;
   SearchConf searchConf_;
 
-  mutable std::mutex mtx_;
-  mutable std::condition_variable cv_;
-  int nActive_ = 0;
-  std::vector<std::thread> threads_;
+  // Candidates waiting for evaluation, kept with their resource scores,
+  // cheapest first. Every search thread pushes the neighbours it finds to a
+  // queue of its own and takes from it, and only steals from the others when
+  // it runs dry, so that threads rarely wait on the same lock. A candidate is
+  // outstanding from push() until the thread that took it calls done(); only
+  // such threads push, so none is left once that count drops to zero.
+  class CandidateQueues {
+    struct Entry {
+      double score;
+      AppConf c;
+      bool operator <(const Entry &other) const {
+        return score > other.score;
+      }
+    };
+    struct Queue {
+      std::mutex mtx;
+      std::priority_queue<Entry> q;
+    };
+    std::vector<Queue> queues_;
+    std::atomic<size_t> queued_{0}, outstanding_{0}, nIdle_{0};
+    std::mutex idleMtx_;
+    std::condition_variable idleCv_;
 
-  class Cmp {
-    const Search *search_;
+    bool tryTake(size_t i, AppConf &c) {
+      Queue &q = queues_[i % queues_.size()];
+      std::lock_guard<std::mutex> lck{q.mtx};
+      if (q.q.empty())
+        return false;
+      c = q.q.top().c;
+      q.q.pop();
+      queued_--;
+      return true;
+    }
+    bool tryTakeAny(size_t i, AppConf &c) {
+      for (size_t j = 0; j < queues_.size(); j++)
+        if (tryTake(i + j, c))
+          return true;
+      return false;
+    }
 
   public:
-    Cmp(const Search *search) : search_(search) {
+    explicit CandidateQueues(size_t nQueues) : queues_(std::max<size_t>(1, nQueues)) {
     }
-    bool operator ()(AppConf x, AppConf y) const {
-      return search_->getResourceScore(x) > search_->getResourceScore(y);
+
+    void push(size_t i, double score, AppConf c) {
+      // counted first, so that a thread stealing it cannot settle it before
+      outstanding_++;
+      queued_++;
+      {
+        Queue &q = queues_[i % queues_.size()];
+        std::lock_guard<std::mutex> lck{q.mtx};
+        q.q.push({score, c});
+      }
+      if (nIdle_ > 0) {
+        std::lock_guard<std::mutex> lck{idleMtx_};
+        idleCv_.notify_one();
+      }
+    }
+
+    // Takes up to n candidates for thread i, waiting while there are none
+    // but some are outstanding. Returns none once the search is over.
+    std::vector<AppConf> take(size_t i, size_t n) {
+      std::vector<AppConf> cs;
+      AppConf c;
+      while (!tryTakeAny(i, c)) {
+        std::unique_lock<std::mutex> lck{idleMtx_};
+        nIdle_++;
+        idleCv_.wait(lck, [this]() {
+          return queued_ > 0 || outstanding_ == 0;
+        });
+        nIdle_--;
+        if (outstanding_ == 0)
+          return cs;
+      }
+      cs.push_back(c);
+      while (cs.size() < n && tryTakeAny(i, c))
+        cs.push_back(c);
+      return cs;
+    }
+
+    // Settles n taken candidates, after their neighbours are pushed.
+    void done(size_t n) {
+      if ((outstanding_ -= n) == 0) {
+        std::lock_guard<std::mutex> lck{idleMtx_};
+        idleCv_.notify_all();
+      }
+    }
+
+    void waitFinished() {
+      std::unique_lock<std::mutex> lck{idleMtx_};
+      idleCv_.wait(lck, [this]() {
+        return outstanding_ == 0;
+      });
+    }
+
+    size_t size() const {
+      return queued_;
     }
   };
-  HashSet<AppConf> vis_;
-  std::priority_queue<AppConf, std::vector<AppConf>, Cmp> candidates_;
+
+  // Guards the results; queue and visited set have locks of their own.
+  mutable std::shared_mutex mtx_;
+  std::atomic<size_t> nActive_{0};
+  std::vector<std::thread> threads_;
+
+  ConcurrentHashSet<AppConf> vis_;
+  CandidateQueues candidates_;
   std::vector<AppConf> answers_, failures_;
+  std::vector<AppConf> screened_;  // failed a screening round only, prune nothing
+  DominanceIndex<2 * N_REGS> answerIndex_, failureIndex_;
+  HashMap<AppConf, Accuracy> accuracies_;
+
+  std::string checkpointPath_;
+  std::string checkpointKey_;
+  mutable std::mutex checkpointMtx_;  // orders the checkpoint writes
+  bool resume_ = false;
+  std::vector<std::vector<size_t>> rungs_;  // epochs of each screening round
+  bool finished_ = false;  // set once no candidate is left
+
+  std::unique_ptr<FILE, int (*)(FILE *)> telemetry_{nullptr, fclose};
+  std::chrono::steady_clock::time_point startTime_;
+  std::atomic<size_t> nThreadsStarted_{0}, prunedQueued_{0}, prunedNeighbors_{0};
+  size_t nEvals_ = 0;
+  double evalTime_ = 0;
 
   bool checkRegConf(RegConf c) const{
     size_t alu = c.d, mem = c.w;
@@ -186,7 +1463,52 @@ private:
                         (searchConf_.beta / 2) * (mems / MAX_PAGE_FOR_ONE_ALU);
   }
 
+  // Seeds the queue with the smallest width each depth needs by the usual
+  // Bloom filter and Count-Min bound: with n keys hashed into each of d rows
+  // of w cells, a key collides in all of them with probability about
+  // (1 - e^{-n/w})^d. A register may get errorBudget() / N_REGS of the keys
+  // wrong in the busiest epoch. Each seed also comes with half its width, so
+  // that the queue starts on both sides of the predicted boundary.
   void initCandidates() {
+    auto cells = query_->registerCells();
+    if (cells.size() != N_REGS) {
+      initShuffledCandidates();
+      return;
+    }
+    std::vector<size_t> maxKeys(N_REGS, 1);
+    for (const auto &v : query_->registerKeys())
+      for (size_t i = 0; i < N_REGS && i < v.size(); i++)
+        maxKeys[i] = std::max(maxKeys[i], v[i]);
+    double p = query_->errorBudget() / N_REGS;
+    for (size_t i = 0; i < N_REGS; i++)
+      spdlog::info("register {}: up to {} keys per epoch, {} cells per page", i, maxKeys[i], cells[i]);
+
+    for (size_t d = 1; d <= searchConf_.aluMax; d++) {
+      AppConf c, half;
+      bool ok = true;
+      for (size_t i = 0; i < N_REGS && ok; i++) {
+        double need = maxKeys[i] / (cells[i] * -std::log1p(-std::pow(p, 1.0 / d)));
+        size_t w = 1;
+        while (w < need && w * 2 <= searchConf_.pageMax)
+          w *= 2;
+        while (w > 1 && !checkRegConf({d, w}))
+          w /= 2;
+        ok = checkRegConf({d, w});
+        c[i] = {d, w};
+        half[i] = {d, std::max<size_t>(1, w / 2)};
+      }
+      if (!ok)
+        continue;
+      for (AppConf x : {c, half})
+        if (vis_.insert(x))
+          candidates_.push(d, getResourceScore(x), x);
+      spdlog::info("seeded {}", c.str());
+    }
+    if (candidates_.size() == 0)
+      initShuffledCandidates();
+  }
+
+  void initShuffledCandidates() {
     std::mt19937 g;
 
     std::vector<size_t> alus, pages;
@@ -204,42 +1526,54 @@ private:
         cs[j][i] = {alus[j], pages[j]};
       }
     }
-    for (AppConf c : cs) {
+    for (size_t j = 0; j < cs.size(); j++) {
       bool flag = true;
-      for (RegConf rc : c)
+      for (RegConf rc : cs[j])
         if (!checkRegConf(rc))
           flag = false;
-      if (flag) {
-        vis_.insert(c);
-        candidates_.push(c);
-      }
+      if (flag && vis_.insert(cs[j]))
+        candidates_.push(j, getResourceScore(cs[j]), cs[j]);
     }
   }
 
-  bool strictExamine(AppConf c) const {
-    for (auto c1 : answers_) {
-      bool flag = false;
-      for (size_t i = 0; i < N_REGS; i++)
-        if (c[i].d < c1[i].d || c[i].w < c1[i].w)
-          flag = true;
-      if (!flag)
-        return false;
+  // A configuration at least an answer in every d and w succeeds too, and
+  // one at most a failure fails; failures are indexed negated.
+  static typename DominanceIndex<2 * N_REGS>::Point dominancePoint(AppConf c, int64_t sign) {
+    typename DominanceIndex<2 * N_REGS>::Point p;
+    for (size_t i = 0; i < N_REGS; i++) {
+      p[2 * i] = sign * static_cast<int64_t>(c[i].d);
+      p[2 * i + 1] = sign * static_cast<int64_t>(c[i].w);
     }
-    for (auto c1 : failures_) {
-      bool flag = false;
-      for (size_t i = 0; i < N_REGS; i++)
-        if (c[i].d > c1[i].d || c[i].w > c1[i].w)
-          flag = true;
-      if (!flag)
-        return false;
+    return p;
+  }
+
+  void addResult(AppConf c, bool succ) {
+    if (succ) {
+      answers_.push_back(c);
+      answerIndex_.insert(dominancePoint(c, 1));
+    } else {
+      failures_.push_back(c);
+      failureIndex_.insert(dominancePoint(c, -1));
     }
-    return true;
   }
 
-  bool examineCandidate(AppConf c) const {
-    if (vis_.count(c))
-      return false;
-    return strictExamine(c);
+  // Called with mtx_ held, shared or not.
+  bool strictExamine(AppConf c) const {
+    return !answerIndex_.dominated(dominancePoint(c, 1)) && !failureIndex_.dominated(dominancePoint(c, -1));
+  }
+
+  // Queues the neighbours of a settled candidate on queue i. Called with mtx_
+  // held exclusively, together with addResult(), so that a checkpoint never
+  // has a result without its neighbours.
+  void pushNeighbors(size_t i, AppConf c, bool succ) {
+    for (AppConf x : calcNeighbors(c, succ)) {
+      if (vis_.contains(x))
+        continue;
+      if (!strictExamine(x))
+        prunedNeighbors_++;
+      else if (vis_.insert(x))
+        candidates_.push(i, getResourceScore(x), x);
+    }
   }
 
   std::vector<AppConf> calcNeighbors(AppConf c, bool succ) {
@@ -270,47 +1604,306 @@ private:
     return neighbors;
   }
 
-  void searchThread() {
-    std::unique_lock<std::mutex> lck{mtx_};
+  // Evaluates configurations on some epochs with a margin like
+  // Query::evalBatch(); returns false if the evaluator is gone.
+  using Evaluate = std::function<bool(const TraceConf &traceConf, const std::vector<AppConf> &cs,
+    const std::vector<size_t> &epochs, double margin, std::vector<bool> &succ, std::vector<Accuracy> &accs)>;
 
-    while (1) {
-      while (candidates_.empty() && nActive_ != 0)
-        cv_.wait(lck);
+  bool evalLocal(const TraceConf &traceConf, const std::vector<AppConf> &cs,
+                 const std::vector<size_t> &epochs, double margin, std::vector<bool> &succ, std::vector<Accuracy> &accs) {
+    succ = query_->evalBatch(traceConf, cs, &accs, epochs, margin);
+    return true;
+  }
+
+  void searchThread(const Evaluate &evaluate) {
+    size_t thread = nThreadsStarted_++;
 
-      spdlog::debug("{} candidates, {} active threads", candidates_.size(), nActive_);
-      if (candidates_.empty())
+    while (1) {
+      // up to batchSize candidates share one pass over the trace
+      std::vector<AppConf> taken = candidates_.take(thread, std::max<size_t>(1, searchConf_.batchSize)), batch;
+      spdlog::debug("{} candidates, {} active threads", candidates_.size(), nActive_.load());
+      if (taken.empty())
         break;
-      auto c = candidates_.top();
-      candidates_.pop();
+      {
+        std::shared_lock<std::shared_mutex> lck{mtx_};
+        for (AppConf c : taken)
+          if (strictExamine(c))
+            batch.push_back(c);
+          else
+            prunedQueued_++;
+      }
       nActive_++;
 
-      if (strictExamine(c)) {
-        lck.unlock();
-        bool succ = query_->eval(traceConf_, c);
-        lck.lock();
+      // successive halving: a candidate that misses the targets by more than
+      // fidelityMargin on few epochs fails without running on all of them
+      for (size_t r = 0; !batch.empty() && r <= rungs_.size(); r++) {
+        bool full = r == rungs_.size();
+        std::vector<size_t> epochs = full ? std::vector<size_t>() : rungs_[r];
+        // running evaluations share the epoch threads, the last few get more
+        TraceConf traceConf = traceConf_;
+        traceConf.epochThreads = std::max<size_t>(1, traceConf_.epochThreads / std::max<size_t>(1, nActive_));
+        std::vector<bool> succ;
+        std::vector<Accuracy> accs;
+        auto start = std::chrono::steady_clock::now();
+        bool ok = evaluate(traceConf, batch, epochs, full ? 0 : searchConf_.fidelityMargin, succ, accs);
+        double wallTime = std::chrono::duration<double>(std::chrono::steady_clock::now() - start).count();
 
-        if (succ)
-          answers_.push_back(c);
-        else
-          failures_.push_back(c);
-        for (AppConf x : calcNeighbors(c, succ))
-          if (examineCandidate(x)) {
-            vis_.insert(x);
-            candidates_.push(x);
+        if (!ok) {
+          // leave the unsettled candidates to the other evaluators
+          for (AppConf c : batch)
+            candidates_.push(thread, getResourceScore(c), c);
+          nActive_--;
+          candidates_.done(taken.size());
+          return;
+        }
+
+        std::vector<AppConf> advanced;
+        {
+          std::unique_lock<std::shared_mutex> lck{mtx_};
+          evalTime_ += wallTime;
+          for (size_t k = 0; k < batch.size(); k++) {
+            AppConf c = batch[k];
+            nEvals_++;
+            if (succ[k] && !full) {
+              // other threads may have settled it meanwhile
+              if (strictExamine(c))
+                advanced.push_back(c);
+            } else {
+              // a few epochs do not show a whole region fails
+              if (full)
+                addResult(c, succ[k]);
+              else
+                screened_.push_back(c);
+              accuracies_[c] = accs[k];
+              pushNeighbors(thread, c, succ[k]);
+            }
           }
+        }
+        if (telemetry_) {
+          std::unique_lock<std::shared_mutex> lck{mtx_};
+          for (size_t k = 0; k < batch.size(); k++)
+            writeTelemetry(batch[k], succ[k] ? (full ? "success" : "advanced") : (full ? "failure" : "screened"), accs[k],
+              epochs, batch.size(), wallTime, thread);
+        }
+        batch = std::move(advanced);
       }
+      saveCheckpoint();
 
       nActive_--;
+      candidates_.done(taken.size());
       spdlog::debug("next job");
-      if (!candidates_.empty() || nActive_ == 0)
-        cv_.notify_all();
     }
   }
 
+  // Epochs of the screening rounds, 1/2^fidelityRounds of them first and
+  // doubling up to a half. Taking them in bit-reversed order spreads every
+  // round over the trace and makes it extend the previous one, so that the
+  // metric store can reuse the earlier rounds.
+  std::vector<std::vector<size_t>> fidelityRungs() const {
+    size_t nEpoch = traceConf_.epochs->nEpoch(), p = 1;
+    while (p < nEpoch)
+      p <<= 1;
+    std::vector<size_t> order;
+    for (size_t i = 0; i < p; i++) {
+      size_t j = 0;
+      for (size_t b = 1, x = i; b < p; b <<= 1, x >>= 1)
+        j = j << 1 | (x & 1);
+      if (j < nEpoch)
+        order.push_back(j);
+    }
+    std::vector<std::vector<size_t>> rungs;
+    for (size_t r = searchConf_.fidelityRounds; r > 0; r--) {
+      auto n = static_cast<size_t>(std::ceil(nEpoch / std::ldexp(1.0, static_cast<int>(std::min<size_t>(r, 64)))));
+      if (n >= nEpoch || (!rungs.empty() && n == rungs.back().size()))
+        continue;
+      std::vector<size_t> rung(order.begin(), order.begin() + n);
+      std::sort(rung.begin(), rung.end());
+      rungs.push_back(std::move(rung));
+    }
+    return rungs;
+  }
+
+  // Identifies what evaluations in a checkpoint are valid for: the query, the
+  // trace and the epochs searched on.
+  std::string checkpointKey() const {
+    std::string key = fmt::format("{}|{}|{}|{}|{}|{}", query_->querySignature(), traceConf_.path,
+      traceConf_.nPkts(), traceConf_.interval, traceConf_.nEpoch, searchConf_.epochSubset);
+    if (searchConf_.fidelityRounds > 0)
+      key += fmt::format("|{}|{}", searchConf_.fidelityRounds, searchConf_.fidelityMargin);
+    return hexDigest(key);
+  }
+
+  static std::string confStr(AppConf c) {
+    std::string s;
+    for (RegConf rc : c)
+      s += fmt::format(" {} {}", rc.d, rc.w);
+    return s;
+  }
+
+  static AppConf parseConf(std::istream &is) {
+    AppConf c;
+    for (RegConf &rc : c)
+      if (!(is >> rc.d >> rc.w))
+        throw std::runtime_error("invalid checkpoint");
+    return c;
+  }
+
+  static std::string jsonNumber(double v) {
+    return std::isfinite(v) ? fmt::format("{:.17g}", v) : "null";
+  }
+  static std::string confJson(AppConf c) {
+    std::vector<std::string> regs;
+    for (RegConf rc : c)
+      regs.push_back(fmt::format("[{}, {}]", rc.d, rc.w));
+    return fmt::format("[{}]", fmt::join(regs, ", "));
+  }
+
+  // One JSON line per evaluation. Packets per second counts all packets of
+  // the evaluated epochs, so it overstates the rate of runs that stopped
+  // early or reused stored metrics. Called with mtx_ held.
+  void writeTelemetry(AppConf c, const char *result, const Accuracy &acc, const std::vector<size_t> &epochs,
+                      size_t batchSize, double wallTime, size_t thread) {
+    if (!telemetry_)
+      return;
+    const EpochIndex &index = *traceConf_.epochs;
+    size_t nEpoch = epochs.empty() ? index.nEpoch() : epochs.size(), pkts = 0;
+    for (size_t i = 0; i < nEpoch; i++) {
+      size_t e = epochs.empty() ? i : epochs[i];
+      pkts += index.end(e) - index.begin(e);
+    }
+    std::vector<std::string> metrics;
+    for (const auto &v : acc)
+      metrics.push_back(fmt::format("\"{}\": {}", v.first, jsonNumber(v.second)));
+    std::string line = fmt::format(
+      "{{\"event\": \"eval\", \"time\": {}, \"conf\": {}, \"score\": {}, \"result\": \"{}\", "
+      "\"accuracy\": {{{}}}, \"epochs\": {}, \"batch\": {}, \"wallTime\": {}, \"pktsPerSec\": {}, "
+      "\"thread\": {}, \"queue\": {}, \"prunedQueued\": {}, \"prunedNeighbors\": {}}}\n",
+      jsonNumber(std::chrono::duration<double>(std::chrono::steady_clock::now() - startTime_).count()),
+      confJson(c), jsonNumber(getResourceScore(c)), result, fmt::join(metrics, ", "), nEpoch, batchSize,
+      jsonNumber(wallTime), jsonNumber(wallTime > 0 ? pkts * batchSize / wallTime : 0), thread,
+      candidates_.size(), prunedQueued_.load(), prunedNeighbors_.load());
+    if (fputs(line.c_str(), telemetry_.get()) < 0 || fflush(telemetry_.get()) != 0)
+      throw std::runtime_error(std::string("cannot write telemetry: ") + strerror(errno));
+  }
+
+  void writeTelemetrySummary(AppConf answer) {
+    if (!telemetry_)
+      return;
+    std::string line = fmt::format(
+      "{{\"event\": \"summary\", \"wallTime\": {}, \"evalTime\": {}, \"evaluations\": {}, "
+      "\"answers\": {}, \"failures\": {}, \"screened\": {}, \"visited\": {}, \"prunedQueued\": {}, \"prunedNeighbors\": {}, "
+      "\"answer\": {}, \"score\": {}}}\n",
+      jsonNumber(std::chrono::duration<double>(std::chrono::steady_clock::now() - startTime_).count()),
+      jsonNumber(evalTime_), nEvals_, answers_.size(), failures_.size(), screened_.size(), vis_.size(), prunedQueued_.load(), prunedNeighbors_.load(),
+      confJson(answer), jsonNumber(getResourceScore(answer)));
+    if (fputs(line.c_str(), telemetry_.get()) < 0 || fflush(telemetry_.get()) != 0)
+      throw std::runtime_error(std::string("cannot write telemetry: ") + strerror(errno));
+  }
+
+  // Writes the whole search state. Every visited candidate without a result
+  // yet is saved as pending, so that a resumed search evaluates again the
+  // ones queued or being evaluated; those found dominated meanwhile are
+  // dropped again when taken.
+  void saveCheckpoint() const {
+    if (checkpointPath_.empty())
+      return;
+    std::lock_guard<std::mutex> checkpointLck{checkpointMtx_};
+    std::string s = "key " + checkpointKey_ + "\n";
+    std::vector<AppConf> visited;
+    // the results and the candidates they queued are added under mtx_ at once
+    std::shared_lock<std::shared_mutex> lck{mtx_};
+    vis_.forEach([&](AppConf c) {
+      visited.push_back(c);
+    });
+    for (AppConf c : visited)
+      s += "visited" + confStr(c) + "\n";
+    for (auto [list, name] : {std::pair(&answers_, "answer"), std::pair(&failures_, "failure"), std::pair(&screened_, "screened")})
+      for (AppConf c : *list) {
+        s += name + confStr(c);
+        if (auto p = accuracies_.find(c); p != accuracies_.end())
+          for (const auto &v : p->second)
+            s += fmt::format(" {} {:.17g}", v.first, v.second);
+        s += "\n";
+      }
+    for (AppConf c : visited)
+      if (!accuracies_.count(c))
+        s += "pending" + confStr(c) + "\n";
+    lck.unlock();
+
+    std::string tmpPath = checkpointPath_ + ".tmp";
+    FILE *fp = fopen(tmpPath.c_str(), "w");
+    if (!fp)
+      throw std::runtime_error(std::string("fopen: ") + strerror(errno));
+    bool ok = fwrite(s.data(), 1, s.size(), fp) == s.size();
+    ok = fclose(fp) == 0 && ok;
+    if (!ok || rename(tmpPath.c_str(), checkpointPath_.c_str()) < 0)
+      throw std::runtime_error(std::string("cannot write checkpoint: ") + strerror(errno));
+  }
+
+  bool loadCheckpoint() {
+    std::ifstream fs(checkpointPath_);
+    if (!fs)
+      return false;
+    std::string line, kind;
+    if (!std::getline(fs, line) || line != "key " + checkpointKey_)
+      throw std::runtime_error("checkpoint " + checkpointPath_ + " belongs to another query, trace, epochSubset or fidelity setting");
+    for (size_t i = 0; std::getline(fs, line); i++) {
+      std::istringstream is(line);
+      is >> kind;
+      AppConf c = parseConf(is);
+      if (kind == "visited") {
+        vis_.insert(c);
+      } else if (kind == "pending") {
+        candidates_.push(i, getResourceScore(c), c);
+      } else if (kind == "answer" || kind == "failure" || kind == "screened") {
+        if (kind == "screened")
+          screened_.push_back(c);
+        else
+          addResult(c, kind == "answer");
+        Accuracy acc;
+        std::string name;
+        double v;
+        while (is >> name >> v)
+          acc.emplace_back(name, v);
+        accuracies_[c] = std::move(acc);
+      } else {
+        throw std::runtime_error("invalid checkpoint");
+      }
+    }
+    spdlog::info("resumed from {}: {} evaluated, {} pending", checkpointPath_,
+      answers_.size() + failures_.size() + screened_.size(), candidates_.size());
+    return true;
+  }
+
   AppConf pickAnswer() const {
     if (answers_.empty())
       throw std::runtime_error("no satisfied configuration");
-    return *std::max_element(answers_.begin(), answers_.end(), Cmp(this));
+    return *std::min_element(answers_.begin(), answers_.end(), [this](AppConf x, AppConf y) {
+      return getResourceScore(x) < getResourceScore(y);
+    });
+  }
+
+  // Checks the answers found on a subset of epochs on all of them, cheapest
+  // first, and reports how their accuracy differs.
+  AppConf confirmAnswer(const TraceConf &fullConf) {
+    if (answers_.empty())
+      throw std::runtime_error("no satisfied configuration");
+    std::vector<AppConf> cs = answers_;
+    std::sort(cs.begin(), cs.end(), [this](AppConf x, AppConf y) {
+      return getResourceScore(x) < getResourceScore(y);
+    });
+    query_->useBaselineEpochs({});
+    for (AppConf c : cs) {
+      Accuracy acc;
+      bool succ = query_->eval(fullConf, c, &acc);
+      const Accuracy &sub = accuracies_.at(c);
+      for (size_t i = 0; i < acc.size() && i < sub.size(); i++)
+        spdlog::info("{} {}: {} on the subset, {} on all epochs ({:+.4f})",
+          c.str(), acc[i].first, sub[i].second, acc[i].second, acc[i].second - sub[i].second);
+      if (succ)
+        return c;
+    }
+    throw std::runtime_error("no configuration satisfied on the subset is satisfied on all epochs, try a larger epochSubset");
   }
 
 public:
@@ -318,16 +1911,203 @@ public:
     : query_(std::move(query))
     , traceConf_(std::move(traceConf))
     , searchConf_(std::move(searchConf))
-    , candidates_(Cmp(this)) {
+    , candidates_(std::max<size_t>(searchConf_.nThreads, std::thread::hardware_concurrency())) {
   }
 
-  AppConf run() {
+  // Saves the search state to path after every evaluation; with resume, the
+  // search continues from the state saved there instead of starting over.
+  void setCheckpoint(std::string path, bool resume) {
+    checkpointPath_ = std::move(path);
+    resume_ = resume;
+  }
+
+  // Runs the search loop for a worker connected on fd. The protocol is
+  // text lines: the worker sends "hello <checkpoint key>" and gets "reject"
+  // if the key differs, or else answers every "eval <margin> <n> <epoch>...
+  // <m> <d w>..." with m lines of "result <0|1> <metric> <value>...".
+  void remoteThread(int fd) {
+    LineChannel ch(fd);
+    std::string line;
+    if (!ch.recv(line) || line != "hello " + checkpointKey_) {
+      spdlog::warn("rejected a worker for another query, trace or search setting");
+      ch.send("reject");
+      return;
+    }
+    spdlog::info("worker connected");
+    searchThread([&](const TraceConf &traceConf, const std::vector<AppConf> &cs,
+                     const std::vector<size_t> &epochs, double margin, std::vector<bool> &succ, std::vector<Accuracy> &accs) {
+      std::string req = fmt::format("eval {:.17g} {}", margin, epochs.size());
+      for (size_t e : epochs)
+        req += fmt::format(" {}", e);
+      req += fmt::format(" {}", cs.size());
+      for (AppConf c : cs)
+        req += confStr(c);
+      if (!ch.send(req))
+        return false;
+      succ.clear();
+      accs.clear();
+      for (size_t k = 0; k < cs.size(); k++) {
+        if (!ch.recv(line))
+          return false;
+        std::istringstream is(line);
+        std::string kind, name;
+        int s;
+        double v;
+        if (!(is >> kind >> s) || kind != "result")
+          return false;
+        succ.push_back(s != 0);
+        accs.emplace_back();
+        while (is >> name >> v)
+          accs.back().emplace_back(name, v);
+      }
+      return true;
+    });
+    std::shared_lock<std::shared_mutex> lck{mtx_};
+    if (!finished_)
+      spdlog::warn("lost a worker");
+  }
+
+  void serveConnection(const std::string &address, size_t epochThreads) {
+    LineChannel ch(connectSocket(address));
+    if (!ch.send("hello " + checkpointKey_))
+      throw std::runtime_error("lost the coordinator at " + address);
+    TraceConf traceConf = traceConf_;
+    traceConf.epochThreads = epochThreads;
+    std::string line, kind;
+    while (ch.recv(line)) {
+      if (line == "reject")
+        throw std::runtime_error("the coordinator at " + address + " searches another query, trace or search setting");
+      std::istringstream is(line);
+      double margin;
+      size_t n;
+      if (!(is >> kind >> margin >> n) || kind != "eval")
+        throw std::runtime_error("invalid request from the coordinator: " + line);
+      std::vector<size_t> epochs(n);
+      for (size_t &e : epochs)
+        is >> e;
+      is >> n;
+      std::vector<AppConf> cs;
+      for (size_t k = 0; k < n && is; k++)
+        cs.push_back(parseConf(is));
+      if (!is)
+        throw std::runtime_error("invalid request from the coordinator: " + line);
+
+      std::vector<Accuracy> accs;
+      auto succ = query_->evalBatch(traceConf, cs, &accs, epochs, margin);
+      for (size_t k = 0; k < cs.size(); k++) {
+        std::string reply = fmt::format("result {}", succ[k] ? 1 : 0);
+        for (const auto &v : accs[k])
+          reply += fmt::format(" {} {:.17g}", v.first, v.second);
+        if (!ch.send(reply))
+          return;
+      }
+    }
+  }
+
+  // Prefilters the trace, runs the baseline and selects the epochs to
+  // search on. Returns whether they are a subset of fullConf.
+  bool prepare(TraceConf &fullConf) {
+    traceConf_ = query_->prefilter(std::move(traceConf_));
+    // no register is deeper than aluMax rows
+    traceConf_ = query_->prehash(std::move(traceConf_), std::min<size_t>(searchConf_.aluMax, N_CRCS));
     query_->runBaseline(traceConf_);
-    initCandidates();
+    fullConf = traceConf_;
+    bool subset = searchConf_.epochSubset > 0 && searchConf_.epochSubset < traceConf_.epochs->nEpoch();
+    if (subset) {
+      auto epochs = query_->representativeEpochs(traceConf_, searchConf_.epochSubset);
+      traceConf_.epochs = std::make_shared<const EpochIndex>(traceConf_.epochs->select(epochs));
+      query_->useBaselineEpochs(epochs);
+    }
+    checkpointKey_ = checkpointKey();
+    return subset;
+  }
+
+  AppConf run() {
+    startTime_ = std::chrono::steady_clock::now();
+    if (!searchConf_.telemetry.empty()) {
+      telemetry_.reset(fopen(searchConf_.telemetry.c_str(), resume_ ? "a" : "w"));
+      if (!telemetry_)
+        throw std::runtime_error(std::string("fopen: ") + strerror(errno));
+    }
+    TraceConf fullConf;
+    bool subset = prepare(fullConf);
+    rungs_ = fidelityRungs();
+    for (const auto &rung : rungs_)
+      spdlog::info("screening round on {} of {} epochs: {}", rung.size(), traceConf_.epochs->nEpoch(), fmt::join(rung, ", "));
+
+    if (!resume_ || !loadCheckpoint()) {
+      if (resume_)
+        spdlog::warn("no checkpoint at {}, starting over", checkpointPath_);
+      initCandidates();
+    }
+    saveCheckpoint();
+    Evaluate local = [this](auto &&...args) {
+      return evalLocal(args...);
+    };
     for (size_t i = 0; i < searchConf_.nThreads; i++)
-      threads_.emplace_back(&Search::searchThread, this);
+      threads_.emplace_back(&Search::searchThread, this, local);
+
+    // workers may connect at any time and each gets a search thread
+    int listenFd = -1;
+    std::thread acceptor;
+    if (!searchConf_.listen.empty()) {
+      listenFd = listenSocket(searchConf_.listen);
+      spdlog::info("waiting for workers on {}", searchConf_.listen);
+      acceptor = std::thread([this, listenFd]() {
+        int fd;
+        while ((fd = accept(listenFd, nullptr, nullptr)) >= 0 || errno == EINTR) {
+          std::lock_guard<std::shared_mutex> lck{mtx_};
+          if (fd >= 0 && !finished_)
+            threads_.emplace_back(&Search::remoteThread, this, fd);
+          else if (fd >= 0)
+            close(fd);
+        }
+      });
+    }
+
+    candidates_.waitFinished();
+    {
+      std::lock_guard<std::shared_mutex> lck{mtx_};
+      finished_ = true;
+    }
+    if (acceptor.joinable()) {
+      closeListener(listenFd, searchConf_.listen);
+      acceptor.join();
+    }
     for (auto &t : threads_)
       t.join();
-    return pickAnswer();
+    AppConf answer = subset ? confirmAnswer(fullConf) : pickAnswer();
+    writeTelemetrySummary(answer);
+    return answer;
+  }
+
+  // Evaluates the configurations a coordinator sends, on nThreads
+  // connections, until it closes them. The worker reads the same
+  // configuration file and trace as the coordinator.
+  void serve(const std::string &address) {
+    // several processes cannot append to the same metric store
+    traceConf_.metricStore = false;
+    TraceConf fullConf;
+    prepare(fullConf);
+
+    size_t nConn = std::max<size_t>(1, searchConf_.nThreads);
+    size_t epochThreads = std::max<size_t>(1, traceConf_.epochThreads / nConn);
+    std::exception_ptr error;
+    std::vector<std::thread> conns;
+    for (size_t i = 0; i < nConn; i++)
+      conns.emplace_back([&]() {
+        try {
+          serveConnection(address, epochThreads);
+        } catch (...) {
+          std::lock_guard<std::shared_mutex> lck{mtx_};
+          if (!error)
+            error = std::current_exception();
+        }
+      });
+    for (auto &t : conns)
+      t.join();
+    if (error)
+      std::rethrow_exception(error);
+    spdlog::info("the coordinator closed the connection");
   }
 };
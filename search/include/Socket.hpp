@@ -0,0 +1,130 @@
+#pragma once
+
+#include <cstdio>
+#include <cstring>
+#include <cerrno>
+
+#include <string>
+#include <memory>
+#include <stdexcept>
+
+#include <unistd.h>
+#include <signal.h>
+#include <netdb.h>
+#include <sys/socket.h>
+#include <sys/un.h>
+
+// Stream sockets between a search coordinator and its workers. Addresses
+// are unix:<path> or tcp:<host>:<port>; an empty host listens on all
+// interfaces.
+
+// Calls f with a sockaddr for the address, as socket(), bind() and connect()
+// take it.
+template <typename F>
+int withSockaddr(const std::string &address, F f) {
+  if (address.rfind("unix:", 0) == 0) {
+    std::string path = address.substr(5);
+    sockaddr_un sa{};
+    if (path.empty() || path.size() >= sizeof(sa.sun_path))
+      throw std::runtime_error("invalid unix socket path '" + path + "'");
+    sa.sun_family = AF_UNIX;
+    memcpy(sa.sun_path, path.data(), path.size());
+    return f(AF_UNIX, reinterpret_cast<const sockaddr *>(&sa), static_cast<socklen_t>(sizeof(sa)));
+  }
+  if (address.rfind("tcp:", 0) == 0) {
+    size_t colon = address.rfind(':');
+    std::string host = address.substr(4, colon - 4), port = address.substr(colon + 1);
+    if (colon < 4 || port.empty())
+      throw std::runtime_error("invalid tcp address '" + address + "', expected tcp:<host>:<port>");
+    addrinfo hints{}, *ai;
+    hints.ai_family = AF_UNSPEC;
+    hints.ai_socktype = SOCK_STREAM;
+    hints.ai_flags = AI_PASSIVE;
+    if (int rc = getaddrinfo(host.empty() ? nullptr : host.c_str(), port.c_str(), &hints, &ai); rc != 0)
+      throw std::runtime_error(std::string("getaddrinfo: ") + gai_strerror(rc));
+    std::unique_ptr<addrinfo, void (*)(addrinfo *)> aiGuard(ai, freeaddrinfo);
+    return f(ai->ai_family, ai->ai_addr, ai->ai_addrlen);
+  }
+  throw std::runtime_error("invalid address '" + address + "', expected unix:<path> or tcp:<host>:<port>");
+}
+
+inline int listenSocket(const std::string &address) {
+  return withSockaddr(address, [&](int family, const sockaddr *sa, socklen_t len) {
+    int fd = socket(family, SOCK_STREAM, 0);
+    if (fd < 0)
+      throw std::runtime_error(std::string("socket: ") + strerror(errno));
+    int one = 1;
+    if (family == AF_UNIX)
+      unlink(reinterpret_cast<const sockaddr_un *>(sa)->sun_path);
+    else
+      setsockopt(fd, SOL_SOCKET, SO_REUSEADDR, &one, sizeof(one));
+    if (bind(fd, sa, len) < 0 || listen(fd, SOMAXCONN) < 0) {
+      int err = errno;
+      close(fd);
+      throw std::runtime_error("cannot listen on " + address + ": " + strerror(err));
+    }
+    return fd;
+  });
+}
+
+// Stops accept() calls waiting on fd, then closes it.
+inline void closeListener(int fd, const std::string &address) {
+  shutdown(fd, SHUT_RDWR);
+  close(fd);
+  if (address.rfind("unix:", 0) == 0)
+    unlink(address.substr(5).c_str());
+}
+
+inline int connectSocket(const std::string &address) {
+  return withSockaddr(address, [&](int family, const sockaddr *sa, socklen_t len) {
+    int fd = socket(family, SOCK_STREAM, 0);
+    if (fd < 0)
+      throw std::runtime_error(std::string("socket: ") + strerror(errno));
+    if (connect(fd, sa, len) < 0) {
+      int err = errno;
+      close(fd);
+      throw std::runtime_error("cannot connect to " + address + ": " + strerror(err));
+    }
+    return fd;
+  });
+}
+
+// Newline-terminated messages over a connected socket, which it owns.
+class LineChannel {
+  FILE *in_, *out_;
+
+public:
+  explicit LineChannel(int fd) {
+    // a peer that went away makes send() fail instead of killing the process
+    signal(SIGPIPE, SIG_IGN);
+    int fd2 = dup(fd);
+    in_ = fdopen(fd, "r");
+    out_ = fd2 < 0 ? nullptr : fdopen(fd2, "w");
+    if (!in_ || !out_) {
+      int err = errno;
+      in_ ? fclose(in_) : close(fd);
+      if (fd2 >= 0)
+        out_ ? fclose(out_) : close(fd2);
+      throw std::runtime_error(std::string("fdopen: ") + strerror(err));
+    }
+  }
+  LineChannel(const LineChannel &) = delete;
+  LineChannel &operator =(const LineChannel &) = delete;
+  ~LineChannel() {
+    fclose(in_);
+    fclose(out_);
+  }
+
+  // Returns false if the peer went away.
+  bool send(const std::string &line) {
+    return fputs(line.c_str(), out_) >= 0 && fputc('\n', out_) != EOF && fflush(out_) == 0;
+  }
+  // Returns false at the end of the stream.
+  bool recv(std::string &line) {
+    line.clear();
+    int ch;
+    while ((ch = fgetc(in_)) != EOF && ch != '\n')
+      line += static_cast<char>(ch);
+    return ch != EOF;
+  }
+};
@@ -1,13 +1,29 @@
 #pragma once
 
+#include <cassert>
+#include <cerrno>
+#include <cstddef>
 #include <cstdint>
 #include <cstdio>
 #include <cstdlib>
 #include <cstring>
 
+#include <algorithm>
+#include <atomic>
+#include <condition_variable>
+#include <exception>
+#include <memory>
+#include <mutex>
+#include <string>
+#include <thread>
 #include <vector>
 #include <stdexcept>
 
+#include <fcntl.h>
+#include <unistd.h>
+#include <sys/mman.h>
+#include <sys/stat.h>
+
 constexpr uint8_t IP_PROTOCOL_ICMP = 1;
 constexpr uint8_t IP_PROTOCOL_TCP = 6;
 constexpr uint8_t IP_PROTOCOL_UDP = 17;
@@ -51,29 +67,723 @@ struct PktInfo {
   uint8_t tcp_hdr_size;
 } __attribute__((packed));
 
-using Trace = std::vector<PktInfo>;
+// Read-only view of a packet trace. The packets are either memory-mapped from
+// a trace file or owned in memory; copies and slices share the same storage.
+class Trace {
+  std::shared_ptr<const void> storage_;
+  const PktInfo *data_ = nullptr;
+  size_t size_ = 0;
 
-inline Trace readTrace(const char *path) {
-  FILE *fp = fopen(path, "r");
+public:
+  using value_type = PktInfo;
+  using const_iterator = const PktInfo *;
+
+  Trace() = default;
+  Trace(std::shared_ptr<const void> storage, const PktInfo *data, size_t size)
+    : storage_(std::move(storage)), data_(data), size_(size) {
+  }
+  explicit Trace(std::vector<PktInfo> pkts) {
+    auto p = std::make_shared<const std::vector<PktInfo>>(std::move(pkts));
+    data_ = p->data();
+    size_ = p->size();
+    storage_ = std::move(p);
+  }
+
+  const PktInfo *begin() const {
+    return data_;
+  }
+  const PktInfo *end() const {
+    return data_ + size_;
+  }
+  const PktInfo *data() const {
+    return data_;
+  }
+  size_t size() const {
+    return size_;
+  }
+  bool empty() const {
+    return size_ == 0;
+  }
+  const PktInfo &operator [](size_t i) const {
+    return data_[i];
+  }
+  const PktInfo &at(size_t i) const {
+    if (i >= size_)
+      throw std::out_of_range("trace index out of range");
+    return data_[i];
+  }
+
+  Trace slice(size_t first, size_t last) const {
+    assert(first <= last && last <= size_);
+    return Trace(storage_, data_ + first, last - first);
+  }
+};
+
+// Maps a whole file read-only. The mapping is shared with the page cache, so
+// concurrent processes reading the same trace do not hold private copies.
+inline std::shared_ptr<const void> mapFile(const char *path, size_t &fsize) {
+  int fd = open(path, O_RDONLY);
+  if (fd < 0)
+    throw std::runtime_error(std::string("open: ") + strerror(errno));
+
+  struct stat st;
+  if (fstat(fd, &st) < 0) {
+    int err = errno;
+    close(fd);
+    throw std::runtime_error(std::string("fstat: ") + strerror(err));
+  }
+  fsize = static_cast<size_t>(st.st_size);
+  if (fsize == 0) {
+    close(fd);
+    return nullptr;
+  }
+
+  void *addr = mmap(nullptr, fsize, PROT_READ, MAP_SHARED, fd, 0);
+  int err = errno;
+  close(fd);
+  if (addr == MAP_FAILED)
+    throw std::runtime_error(std::string("mmap: ") + strerror(err));
+  madvise(addr, fsize, MADV_SEQUENTIAL);
+
+  return std::shared_ptr<const void>(addr, [fsize](const void *p) {
+    munmap(const_cast<void *>(p), fsize);
+  });
+}
+
+inline bool hasMagic(const char *path, const char (&magic)[8]) {
+  FILE *fp = fopen(path, "rb");
   if (!fp)
     throw std::runtime_error(std::string("fopen: ") + strerror(errno));
+  char buf[8];
+  bool res = fread(buf, 1, sizeof(buf), fp) == sizeof(buf) && memcmp(buf, magic, sizeof(buf)) == 0;
+  fclose(fp);
+  return res;
+}
+
+// Compressed chunked trace container written by `preprocess --chunked`; see
+// trace/chunks.h for the layout.
+constexpr char CHUNK_TRACE_MAGIC[8] = {'A', 'S', 'C', 'H', 'K', 'T', 'R', '1'};
+
+struct ChunkTraceHeader {
+  char magic[8];
+  uint64_t nPkts;
+  uint64_t nChunks;
+  uint64_t indexOffset;
+};
+
+struct ChunkIndex {
+  uint64_t offset;
+  uint64_t size;
+  uint64_t firstPkt;
+  uint64_t nPkts;
+};
+
+class ChunkDecoder {
+  const uint8_t *p_, *end_;
+
+  void need(size_t n) const {
+    if (static_cast<size_t>(end_ - p_) < n)
+      throw std::runtime_error("corrupted trace chunk");
+  }
+
+public:
+  ChunkDecoder(const uint8_t *p, size_t size) : p_(p), end_(p + size) {
+  }
+
+  uint64_t varint() {
+    uint64_t v = 0;
+    for (int shift = 0; shift < 64; shift += 7) {
+      need(1);
+      uint8_t b = *p_++;
+      v |= static_cast<uint64_t>(b & 0x7f) << shift;
+      if (!(b & 0x80))
+        return v;
+    }
+    throw std::runtime_error("corrupted trace chunk");
+  }
+  int64_t zigzag() {
+    uint64_t v = varint();
+    return static_cast<int64_t>(v >> 1) ^ -static_cast<int64_t>(v & 1);
+  }
+  template <typename T>
+  T raw() {
+    T v;
+    need(sizeof(T));
+    memcpy(&v, p_, sizeof(T));
+    p_ += sizeof(T);
+    return v;
+  }
+};
+
+inline void decodeChunk(const uint8_t *data, const ChunkIndex &e, PktInfo *out) {
+  ChunkDecoder dec(data + e.offset, e.size);
 
-  int rc = fseek(fp, 0, SEEK_END);
-  if (rc < 0)
-    throw std::runtime_error(std::string("fseek: ") + strerror(errno));
-  long fsize = ftell(fp);
-  if (fsize < 0)
-    throw std::runtime_error(std::string("ftell: ") + strerror(errno));
-  rewind(fp);
+  int64_t ts = dec.raw<int64_t>();
+  std::vector<uint32_t> ips(dec.varint());
+  for (size_t i = 0; i < ips.size(); i++)
+    ips[i] = static_cast<uint32_t>(dec.varint() + (i == 0 ? 0 : ips[i - 1]));
+  auto ip = [&](uint64_t id) {
+    if (id >= ips.size())
+      throw std::runtime_error("corrupted trace chunk");
+    return ips[id];
+  };
+
+  for (size_t i = 0; i < e.nPkts; i++) {
+    PktInfo &pkt = out[i];
+    ts += dec.zigzag();
+    // same arithmetic as the preprocessor, so the timestamps are bit-exact
+    pkt.pkt_ts = static_cast<double>(ts % 1000000) / 1000000 + static_cast<double>(ts / 1000000);
+    pkt.key.src_ip = ip(dec.varint());
+    pkt.key.dst_ip = ip(dec.varint());
+    pkt.key.src_port = static_cast<uint16_t>(dec.varint());
+    pkt.key.dst_port = static_cast<uint16_t>(dec.varint());
+    pkt.size = static_cast<int32_t>(dec.zigzag());
+    pkt.key.proto = dec.raw<uint8_t>();
+    pkt.tcp_ack = dec.raw<uint32_t>();
+    pkt.tcp_seq = dec.raw<uint32_t>();
+    pkt.tcp_flag = dec.raw<uint8_t>();
+    pkt.ip_hdr_size = dec.raw<uint8_t>();
+    pkt.tcp_hdr_size = dec.raw<uint8_t>();
+  }
+}
+
+// Decodes the chunks on all cores into an in-memory trace.
+inline Trace readChunkTrace(const char *path) {
+  size_t fsize;
+  auto storage = mapFile(path, fsize);
+  auto data = static_cast<const uint8_t *>(storage.get());
+  if (fsize < sizeof(ChunkTraceHeader))
+    throw std::runtime_error("incorrect chunk trace file length");
+  ChunkTraceHeader hdr;
+  memcpy(&hdr, data, sizeof(hdr));
+  if (hdr.indexOffset > fsize || (fsize - hdr.indexOffset) / sizeof(ChunkIndex) < hdr.nChunks)
+    throw std::runtime_error("incorrect chunk trace file length");
+  std::vector<ChunkIndex> index(hdr.nChunks);
+  memcpy(index.data(), data + hdr.indexOffset, hdr.nChunks * sizeof(ChunkIndex));
+  for (const auto &e : index)
+    if (e.offset > fsize || e.size > fsize - e.offset || e.firstPkt > hdr.nPkts || e.nPkts > hdr.nPkts - e.firstPkt)
+      throw std::runtime_error("corrupted trace chunk index");
+
+  std::vector<PktInfo> pkts(hdr.nPkts);
+  std::atomic<size_t> next{0};
+  std::exception_ptr err;
+  std::mutex errMtx;
+  auto worker = [&]() {
+    try {
+      for (size_t i; (i = next++) < index.size(); )
+        decodeChunk(data, index[i], pkts.data() + index[i].firstPkt);
+    } catch (...) {
+      std::lock_guard<std::mutex> lck{errMtx};
+      err = std::current_exception();
+      next = index.size();
+    }
+  };
+  size_t nThreads = std::max<size_t>(1, std::min<size_t>(std::thread::hardware_concurrency(), index.size()));
+  std::vector<std::thread> threads;
+  for (size_t i = 1; i < nThreads; i++)
+    threads.emplace_back(worker);
+  worker();
+  for (auto &t : threads)
+    t.join();
+  if (err)
+    std::rethrow_exception(err);
+
+  return Trace(std::move(pkts));
+}
+
+inline Trace readTrace(const char *path) {
+  if (hasMagic(path, CHUNK_TRACE_MAGIC))
+    return readChunkTrace(path);
+
+  size_t fsize;
+  auto storage = mapFile(path, fsize);
 
   if (fsize % sizeof(PktInfo) != 0)
     throw std::runtime_error("incorrect trace file length");
   size_t n = fsize / sizeof(PktInfo);
 
-  Trace res(n);
-  if (fread(res.data(), sizeof(PktInfo), n, fp) != n)
-    throw std::runtime_error(std::string("fread: ") + strerror(errno));
+  auto data = static_cast<const PktInfo *>(storage.get());
+  return Trace(std::move(storage), data, n);
+}
+
+// Number of packets in a .bin trace, without reading it.
+inline size_t countPkts(const char *path) {
+  struct stat st;
+  if (stat(path, &st) < 0)
+    throw std::runtime_error(std::string("stat: ") + strerror(errno));
+  if (st.st_size % sizeof(PktInfo) != 0)
+    throw std::runtime_error("incorrect trace file length");
+  return st.st_size / sizeof(PktInfo);
+}
+
+// Divides the buffer memory of a streamed trace between the readers open at
+// once: each takes one of nShares equal shares for as long as it reads, and
+// waits while none is free.
+class StreamBudget {
+  std::mutex mtx_;
+  std::condition_variable cv_;
+  size_t free_, share_;
+
+public:
+  StreamBudget(size_t bytes, size_t nShares)
+    : free_(std::max<size_t>(1, nShares)), share_(bytes / std::max<size_t>(1, nShares)) {
+  }
+
+  // Holds one share while alive.
+  class Share {
+    StreamBudget &budget_;
+
+  public:
+    explicit Share(StreamBudget &budget) : budget_(budget) {
+      std::unique_lock<std::mutex> lck{budget_.mtx_};
+      budget_.cv_.wait(lck, [this] { return budget_.free_ > 0; });
+      budget_.free_--;
+    }
+    Share(const Share &) = delete;
+    Share &operator =(const Share &) = delete;
+    ~Share() {
+      {
+        std::lock_guard<std::mutex> lck{budget_.mtx_};
+        budget_.free_++;
+      }
+      budget_.cv_.notify_one();
+    }
+    size_t bytes() const {
+      return budget_.share_;
+    }
+  };
+};
+
+// Reads a .bin trace sequentially within a fixed memory budget. The budget is
+// split into two blocks; a background thread fills one while the caller
+// processes the other.
+class TraceReader {
+  int fd_;
+  size_t nPkts_, blockPkts_;
+  size_t readPos_;  // next packet to read, owned by the prefetch thread
+
+  std::vector<PktInfo> bufs_[2];
+  size_t lens_[2] = {0, 0};
+  bool filled_[2] = {false, false};
+  size_t cur_ = 0;
+  bool held_ = false;
+  bool stop_ = false;
+  std::exception_ptr err_;
+
+  std::mutex mtx_;
+  std::condition_variable cv_;
+  std::thread thread_;
+
+  void prefetch() {
+    for (size_t b = 0; ; b ^= 1) {
+      {
+        std::unique_lock<std::mutex> lck{mtx_};
+        cv_.wait(lck, [&] { return stop_ || !filled_[b]; });
+        if (stop_)
+          return;
+      }
 
+      size_t n = std::min(blockPkts_, nPkts_ - readPos_);
+      size_t done = 0, bytes = n * sizeof(PktInfo);
+      auto dst = reinterpret_cast<char *>(bufs_[b].data());
+      std::exception_ptr err;
+      while (done < bytes) {
+        ssize_t rc = pread(fd_, dst + done, bytes - done, (readPos_ * sizeof(PktInfo)) + done);
+        if (rc <= 0) {
+          err = std::make_exception_ptr(std::runtime_error(std::string("pread: ") + (rc < 0 ? strerror(errno) : "unexpected end of file")));
+          break;
+        }
+        done += rc;
+      }
+      readPos_ += n;
+
+      std::lock_guard<std::mutex> lck{mtx_};
+      lens_[b] = n;
+      filled_[b] = true;
+      err_ = err;
+      cv_.notify_all();
+      if (n == 0 || err)
+        return;
+    }
+  }
+
+public:
+  TraceReader(const char *path, size_t bufferSize, size_t first = 0) {
+    fd_ = open(path, O_RDONLY);
+    if (fd_ < 0)
+      throw std::runtime_error(std::string("open: ") + strerror(errno));
+    struct stat st;
+    if (fstat(fd_, &st) < 0 || st.st_size % sizeof(PktInfo) != 0) {
+      close(fd_);
+      throw std::runtime_error("incorrect trace file length");
+    }
+    nPkts_ = st.st_size / sizeof(PktInfo);
+    readPos_ = std::min(first, nPkts_);
+    posix_fadvise(fd_, 0, 0, POSIX_FADV_SEQUENTIAL);
+
+    blockPkts_ = std::max<size_t>(1, bufferSize / 2 / sizeof(PktInfo));
+    for (auto &buf : bufs_)
+      buf.resize(blockPkts_);
+    thread_ = std::thread(&TraceReader::prefetch, this);
+  }
+  TraceReader(const TraceReader &) = delete;
+  TraceReader &operator =(const TraceReader &) = delete;
+  ~TraceReader() {
+    {
+      std::lock_guard<std::mutex> lck{mtx_};
+      stop_ = true;
+      cv_.notify_all();
+    }
+    thread_.join();
+    close(fd_);
+  }
+
+  size_t nPkts() const {
+    return nPkts_;
+  }
+
+  // Returns the next block of packets, which stays valid until the next call,
+  // or nullptr at the end of the trace.
+  const PktInfo *next(size_t &n) {
+    std::unique_lock<std::mutex> lck{mtx_};
+    if (held_) {
+      filled_[cur_] = false;
+      cur_ ^= 1;
+      held_ = false;
+      cv_.notify_all();
+    }
+    cv_.wait(lck, [&] { return filled_[cur_]; });
+    if (err_)
+      std::rethrow_exception(err_);
+    n = lens_[cur_];
+    if (n == 0)
+      return nullptr;
+    held_ = true;
+    return bufs_[cur_].data();
+  }
+};
+
+// Columnar trace layout written by trace/bin2col (see trace/columns.h): a
+// header followed by one contiguous array per PktInfo field, so a query only
+// streams the fields it reads.
+constexpr char COLUMN_TRACE_MAGIC[8] = {'A', 'S', 'C', 'O', 'L', 'T', 'R', '1'};
+
+enum TraceColumn : size_t {
+  COL_SRC_IP,
+  COL_DST_IP,
+  COL_SRC_PORT,
+  COL_DST_PORT,
+  COL_PROTO,
+  COL_SIZE,
+  COL_TCP_ACK,
+  COL_TCP_SEQ,
+  COL_TCP_FLAG,
+  COL_PKT_TS,
+  COL_IP_HDR_SIZE,
+  COL_TCP_HDR_SIZE,
+  N_COLUMNS
+};
+
+constexpr size_t COLUMN_WIDTHS[N_COLUMNS] = {4, 4, 2, 2, 1, 4, 4, 4, 1, 8, 1, 1};
+
+struct ColumnTraceHeader {
+  char magic[8];
+  uint64_t nPkts;
+  uint64_t offsets[N_COLUMNS];  // byte offset of each column in the file
+};
+
+class ColumnTrace {
+  std::shared_ptr<const void> storage_;
+  size_t size_ = 0;
+
+  template <typename T>
+  const T *column(TraceColumn col, const ColumnTraceHeader &hdr) const {
+    return reinterpret_cast<const T *>(static_cast<const char *>(storage_.get()) + hdr.offsets[col]);
+  }
+
+public:
+  const uint32_t *src_ip = nullptr;
+  const uint32_t *dst_ip = nullptr;
+  const uint16_t *src_port = nullptr;
+  const uint16_t *dst_port = nullptr;
+  const uint8_t *proto = nullptr;
+  const int32_t *size = nullptr;
+  const uint32_t *tcp_ack = nullptr;
+  const uint32_t *tcp_seq = nullptr;
+  const uint8_t *tcp_flag = nullptr;
+  const double *pkt_ts = nullptr;
+  const uint8_t *ip_hdr_size = nullptr;
+  const uint8_t *tcp_hdr_size = nullptr;
+
+  ColumnTrace() = default;
+  ColumnTrace(std::shared_ptr<const void> storage, size_t fsize)
+    : storage_(std::move(storage)) {
+    if (fsize < sizeof(ColumnTraceHeader))
+      throw std::runtime_error("incorrect column trace file length");
+    const auto &hdr = *static_cast<const ColumnTraceHeader *>(storage_.get());
+    if (memcmp(hdr.magic, COLUMN_TRACE_MAGIC, sizeof(hdr.magic)) != 0)
+      throw std::runtime_error("not a column trace file");
+    size_ = hdr.nPkts;
+    for (size_t c = 0; c < N_COLUMNS; c++)
+      if (hdr.offsets[c] % COLUMN_WIDTHS[c] != 0 || hdr.offsets[c] + size_ * COLUMN_WIDTHS[c] > fsize)
+        throw std::runtime_error("incorrect column trace file length");
+
+    src_ip = column<uint32_t>(COL_SRC_IP, hdr);
+    dst_ip = column<uint32_t>(COL_DST_IP, hdr);
+    src_port = column<uint16_t>(COL_SRC_PORT, hdr);
+    dst_port = column<uint16_t>(COL_DST_PORT, hdr);
+    proto = column<uint8_t>(COL_PROTO, hdr);
+    size = column<int32_t>(COL_SIZE, hdr);
+    tcp_ack = column<uint32_t>(COL_TCP_ACK, hdr);
+    tcp_seq = column<uint32_t>(COL_TCP_SEQ, hdr);
+    tcp_flag = column<uint8_t>(COL_TCP_FLAG, hdr);
+    pkt_ts = column<double>(COL_PKT_TS, hdr);
+    ip_hdr_size = column<uint8_t>(COL_IP_HDR_SIZE, hdr);
+    tcp_hdr_size = column<uint8_t>(COL_TCP_HDR_SIZE, hdr);
+  }
+
+  size_t nPkts() const {
+    return size_;
+  }
+  bool empty() const {
+    return size_ == 0;
+  }
+
+  // Gathers every field of one packet; only meant for slow paths.
+  PktInfo operator [](size_t i) const {
+    PktInfo pkt;
+    pkt.key.src_ip = src_ip[i];
+    pkt.key.dst_ip = dst_ip[i];
+    pkt.key.src_port = src_port[i];
+    pkt.key.dst_port = dst_port[i];
+    pkt.key.proto = proto[i];
+    pkt.size = size[i];
+    pkt.tcp_ack = tcp_ack[i];
+    pkt.tcp_seq = tcp_seq[i];
+    pkt.tcp_flag = tcp_flag[i];
+    pkt.pkt_ts = pkt_ts[i];
+    pkt.ip_hdr_size = ip_hdr_size[i];
+    pkt.tcp_hdr_size = tcp_hdr_size[i];
+    return pkt;
+  }
+};
+
+inline ColumnTrace readColumnTrace(const char *path) {
+  size_t fsize;
+  auto storage = mapFile(path, fsize);
+  return ColumnTrace(std::move(storage), fsize);
+}
+
+// Packet offsets of the epochs of a trace: epoch e covers the packets
+// [begin(e), end(e)). Packets after the last epoch are not part of any epoch.
+class EpochIndex {
+  std::vector<uint64_t> offsets_;
+  std::vector<size_t> selected_;  // epochs kept by select(), empty for all
+
+public:
+  explicit EpochIndex(std::vector<uint64_t> offsets)
+    : offsets_(std::move(offsets)) {
+    assert(!offsets_.empty());
+  }
+
+  size_t nEpoch() const {
+    return selected_.empty() ? offsets_.size() - 1 : selected_.size();
+  }
+  // Position of epoch e in the trace, which differs from e after select().
+  size_t id(size_t e) const {
+    return selected_.empty() ? e : selected_[e];
+  }
+  size_t begin(size_t e) const {
+    return offsets_[id(e)];
+  }
+  size_t end(size_t e) const {
+    return offsets_[id(e) + 1];
+  }
+  const std::vector<uint64_t> &offsets() const {
+    assert(selected_.empty());
+    return offsets_;
+  }
+
+  // Index of only the given epochs, which need not be adjacent.
+  EpochIndex select(const std::vector<size_t> &epochs) const {
+    EpochIndex res(offsets_);
+    for (size_t e : epochs)
+      res.selected_.push_back(id(e));
+    return res;
+  }
+};
+
+// An epoch ends at the first packet at least `interval` seconds after its
+// start; epochs start at the first packet of the trace and are back to back.
+template <typename GetTs>
+EpochIndex buildEpochIndex(size_t nPkts, GetTs getTs, size_t nEpoch, double interval) {
+  if (nPkts == 0)
+    throw std::out_of_range("empty trace");
+  std::vector<uint64_t> offsets{0};
+  double startTime = getTs(0);
+  for (size_t i = 0; i < nPkts && offsets.size() <= nEpoch; i++) {
+    while (getTs(i) - startTime >= interval) {
+      offsets.push_back(i);
+      startTime += interval;
+      if (offsets.size() > nEpoch)
+        break;
+    }
+  }
+  if (offsets.size() <= nEpoch)
+    throw std::runtime_error("finished in epoch " + std::to_string(offsets.size() - 1) + "/" + std::to_string(nEpoch));
+  return EpochIndex(std::move(offsets));
+}
+
+// Sidecar file caching an epoch index next to its trace.
+constexpr char EPOCH_INDEX_MAGIC[8] = {'A', 'S', 'E', 'P', 'O', 'C', 'H', '1'};
+
+struct EpochIndexHeader {
+  char magic[8];
+  uint64_t nPkts;
+  uint64_t nEpoch;
+  double interval;
+  double firstTs;
+};
+
+inline bool loadEpochIndex(const char *path, const EpochIndexHeader &expected, std::vector<uint64_t> &offsets) {
+  FILE *fp = fopen(path, "rb");
+  if (!fp)
+    return false;
+  EpochIndexHeader hdr;
+  bool ok = fread(&hdr, sizeof(hdr), 1, fp) == 1 && memcmp(&hdr, &expected, sizeof(hdr)) == 0;
+  if (ok) {
+    offsets.resize(hdr.nEpoch + 1);
+    ok = fread(offsets.data(), sizeof(uint64_t), offsets.size(), fp) == offsets.size();
+  }
   fclose(fp);
+  return ok;
+}
+
+inline void saveEpochIndex(const char *path, const EpochIndexHeader &hdr, const EpochIndex &idx) {
+  std::string tmpPath = std::string(path) + ".tmp";
+  FILE *fp = fopen(tmpPath.c_str(), "wb");
+  if (!fp)
+    throw std::runtime_error(std::string("fopen: ") + strerror(errno));
+  bool ok = fwrite(&hdr, sizeof(hdr), 1, fp) == 1
+    && fwrite(idx.offsets().data(), sizeof(uint64_t), idx.offsets().size(), fp) == idx.offsets().size();
+  ok = fclose(fp) == 0 && ok;
+  if (!ok || rename(tmpPath.c_str(), path) < 0)
+    throw std::runtime_error(std::string("cannot write epoch index: ") + strerror(errno));
+}
+
+// Loads the epoch index from `sidecar` if it was built for the same trace
+// and parameters, otherwise builds it and saves it there. An empty sidecar
+// path disables caching.
+template <typename GetTs>
+EpochIndex readEpochIndex(const std::string &sidecar, size_t nPkts, GetTs getTs, size_t nEpoch, double interval) {
+  EpochIndexHeader hdr;
+  memset(&hdr, 0, sizeof(hdr));
+  memcpy(hdr.magic, EPOCH_INDEX_MAGIC, sizeof(hdr.magic));
+  hdr.nPkts = nPkts;
+  hdr.nEpoch = nEpoch;
+  hdr.interval = interval;
+  hdr.firstTs = nPkts ? getTs(0) : 0;
+
+  std::vector<uint64_t> offsets;
+  if (!sidecar.empty() && loadEpochIndex(sidecar.c_str(), hdr, offsets))
+    return EpochIndex(std::move(offsets));
+  EpochIndex res = buildEpochIndex(nPkts, getTs, nEpoch, interval);
+  if (!sidecar.empty())
+    saveEpochIndex(sidecar.c_str(), hdr, res);
   return res;
 }
+
+// A trace reduced to the packets that pass a query's stateless filters,
+// together with the epoch offsets of the original trace mapped onto it.
+constexpr char FILTERED_TRACE_MAGIC[8] = {'A', 'S', 'F', 'I', 'L', 'T', 'R', '1'};
+
+struct FilteredTraceHeader {
+  char magic[8];
+  char signature[16];  // hexDigest of the filter chain
+  uint64_t sourcePkts;
+  int64_t sourceMtime;
+  uint64_t nEpoch;
+  double interval;
+  uint64_t nPkts;
+};
+
+// Writes a filtered trace as its packets come, so that it never has to fit
+// in memory. The header and epoch offsets are filled in by finish(), which
+// then moves the file to path; a writer destroyed before removes it.
+class FilteredTraceWriter {
+  std::string path_, tmpPath_;
+  FILE *fp_;
+  FilteredTraceHeader hdr_;
+  std::vector<uint64_t> offsets_{0};
+  uint64_t nPkts_ = 0;
+  bool ok_;
+
+public:
+  FilteredTraceWriter(const char *path, const FilteredTraceHeader &hdr)
+    : path_(path), tmpPath_(path_ + ".tmp" + std::to_string(getpid())), hdr_(hdr) {
+    fp_ = fopen(tmpPath_.c_str(), "wb");
+    if (!fp_)
+      throw std::runtime_error(std::string("fopen: ") + strerror(errno));
+    std::vector<uint64_t> offsets(hdr_.nEpoch + 1);
+    ok_ = fwrite(&hdr_, sizeof(hdr_), 1, fp_) == 1
+      && fwrite(offsets.data(), sizeof(uint64_t), offsets.size(), fp_) == offsets.size();
+  }
+  FilteredTraceWriter(const FilteredTraceWriter &) = delete;
+  FilteredTraceWriter &operator =(const FilteredTraceWriter &) = delete;
+  ~FilteredTraceWriter() {
+    if (fp_) {
+      fclose(fp_);
+      unlink(tmpPath_.c_str());
+    }
+  }
+
+  void add(const PktInfo &pkt) {
+    ok_ = ok_ && fwrite(&pkt, sizeof(pkt), 1, fp_) == 1;
+    nPkts_++;
+  }
+  void endEpoch() {
+    offsets_.push_back(nPkts_);
+  }
+  // Returns the number of packets written.
+  uint64_t finish() {
+    if (offsets_.size() != hdr_.nEpoch + 1)
+      throw std::logic_error("filtered trace misses epochs");
+    hdr_.nPkts = nPkts_;
+    bool ok = ok_ && fseek(fp_, 0, SEEK_SET) == 0
+      && fwrite(&hdr_, sizeof(hdr_), 1, fp_) == 1
+      && fwrite(offsets_.data(), sizeof(uint64_t), offsets_.size(), fp_) == offsets_.size();
+    ok = fclose(fp_) == 0 && ok;
+    fp_ = nullptr;
+    if (!ok || rename(tmpPath_.c_str(), path_.c_str()) < 0) {
+      unlink(tmpPath_.c_str());
+      throw std::runtime_error(std::string("cannot write filtered trace: ") + strerror(errno));
+    }
+    return nPkts_;
+  }
+};
+
+// Maps a filtered trace written for `expected`; returns false if there is
+// none or it was built from a different trace or filter chain.
+inline bool readFilteredTrace(const char *path, const FilteredTraceHeader &expected,
+                              std::shared_ptr<const Trace> &trace, std::shared_ptr<const EpochIndex> &epochs) {
+  if (access(path, R_OK) != 0)
+    return false;
+  size_t fsize;
+  auto storage = mapFile(path, fsize);
+  auto data = static_cast<const char *>(storage.get());
+  size_t offsetsSize = (expected.nEpoch + 1) * sizeof(uint64_t);
+  if (fsize < sizeof(FilteredTraceHeader) + offsetsSize)
+    return false;
+  FilteredTraceHeader hdr;
+  memcpy(&hdr, data, sizeof(hdr));
+  if (memcmp(&hdr, &expected, offsetof(FilteredTraceHeader, nPkts)) != 0
+      || fsize != sizeof(hdr) + offsetsSize + hdr.nPkts * sizeof(PktInfo))
+    return false;
+
+  std::vector<uint64_t> offsets(expected.nEpoch + 1);
+  memcpy(offsets.data(), data + sizeof(hdr), offsetsSize);
+  epochs = std::make_shared<const EpochIndex>(std::move(offsets));
+  auto pkts = reinterpret_cast<const PktInfo *>(data + sizeof(hdr) + offsetsSize);
+  trace = std::make_shared<const Trace>(std::move(storage), pkts, hdr.nPkts);
+  return true;
+}
@@ -0,0 +1,125 @@
+//
+// Converts a preprocessed trace (.bin, an array of tuple_t) into the columnar
+// trace format, see columns.h.
+//
+
+#include <stdlib.h>
+#include <string.h>
+#include <errno.h>
+#include <unistd.h>
+#include <sys/stat.h>
+#include "util.h"
+#include "tuple.h"
+#include "columns.h"
+
+#define BATCH_SIZE (1 << 16)
+
+struct ColumnWriter {
+    char* buf;
+    uint64_t len;    // bytes buffered
+    uint64_t offset; // file offset of the next flush
+};
+
+static void flush_column(int fd, struct ColumnWriter* w) {
+    uint64_t done = 0;
+    while (done < w->len) {
+        ssize_t rc = pwrite(fd, w->buf + done, w->len - done, w->offset + done);
+        if (rc < 0) {
+            LOG_ERR("pwrite: %s\n", strerror(errno));
+        }
+        done += rc;
+    }
+    w->offset += w->len;
+    w->len = 0;
+}
+
+static inline void put_column(struct ColumnWriter* w, const void* v, uint64_t width) {
+    memcpy(w->buf + w->len, v, width);
+    w->len += width;
+}
+
+int main(int argc, char** argv) {
+    if (argc != 3) {
+        printf("usage: %s input.bin output.col\n", argv[0]);
+        return 0;
+    }
+
+    FILE* input = fopen(argv[1], "rb");
+    if (input == NULL) {
+        LOG_ERR("cannot open %s: %s\n", argv[1], strerror(errno));
+    }
+    struct stat st;
+    if (fstat(fileno(input), &st) < 0) {
+        LOG_ERR("cannot stat %s: %s\n", argv[1], strerror(errno));
+    }
+    if (st.st_size % sizeof(tuple_t) != 0) {
+        LOG_ERR("incorrect trace file length of %s\n", argv[1]);
+    }
+    uint64_t n = st.st_size / sizeof(tuple_t);
+
+    column_trace_header_t hdr;
+    memset(&hdr, 0, sizeof(hdr));
+    memcpy(hdr.magic, COLUMN_TRACE_MAGIC, sizeof(hdr.magic));
+    hdr.n_pkts = n;
+    uint64_t offset = sizeof(hdr);
+    for (int c = 0; c < N_COLUMNS; c++) {
+        offset = (offset + COLUMN_ALIGN - 1) / COLUMN_ALIGN * COLUMN_ALIGN;
+        hdr.offsets[c] = offset;
+        offset += n * column_widths[c];
+    }
+
+    FILE* output = fopen(argv[2], "wb");
+    if (output == NULL) {
+        LOG_ERR("cannot open %s: %s\n", argv[2], strerror(errno));
+    }
+    int fd = fileno(output);
+    if (ftruncate(fd, offset) < 0 || pwrite(fd, &hdr, sizeof(hdr), 0) != sizeof(hdr)) {
+        LOG_ERR("cannot write %s: %s\n", argv[2], strerror(errno));
+    }
+
+    struct ColumnWriter writers[N_COLUMNS];
+    for (int c = 0; c < N_COLUMNS; c++) {
+        writers[c].buf = malloc(BATCH_SIZE * column_widths[c]);
+        writers[c].len = 0;
+        writers[c].offset = hdr.offsets[c];
+    }
+
+    tuple_t* batch = malloc(BATCH_SIZE * sizeof(tuple_t));
+    uint64_t start_time = now_us();
+    uint64_t done = 0;
+    while (done < n) {
+        size_t m = fread(batch, sizeof(tuple_t), BATCH_SIZE, input);
+        if (m == 0) {
+            LOG_ERR("fread: %s\n", strerror(errno));
+        }
+        for (size_t i = 0; i < m; i++) {
+            tuple_t* p = &batch[i];
+            put_column(&writers[COL_SRC_IP], &p->key.src_ip, 4);
+            put_column(&writers[COL_DST_IP], &p->key.dst_ip, 4);
+            put_column(&writers[COL_SRC_PORT], &p->key.src_port, 2);
+            put_column(&writers[COL_DST_PORT], &p->key.dst_port, 2);
+            put_column(&writers[COL_PROTO], &p->key.proto, 1);
+            put_column(&writers[COL_SIZE], &p->size, 4);
+            put_column(&writers[COL_TCP_ACK], &p->tcp_ack, 4);
+            put_column(&writers[COL_TCP_SEQ], &p->tcp_seq, 4);
+            put_column(&writers[COL_TCP_FLAG], &p->tcp_flag, 1);
+            put_column(&writers[COL_PKT_TS], &p->pkt_ts, 8);
+            put_column(&writers[COL_IP_HDR_SIZE], &p->ip_hdr_size, 1);
+            put_column(&writers[COL_TCP_HDR_SIZE], &p->tcp_hdr_size, 1);
+        }
+        for (int c = 0; c < N_COLUMNS; c++) {
+            flush_column(fd, &writers[c]);
+        }
+        done += m;
+    }
+
+    LOG_MSG("converted %lu packets in %.2lf s\n", n, (now_us() - start_time) / 1.0e6);
+
+    for (int c = 0; c < N_COLUMNS; c++) {
+        free(writers[c].buf);
+    }
+    free(batch);
+    fclose(input);
+    fclose(output);
+    return 0;
+}
@@ -0,0 +1,174 @@
+#include <stdlib.h>
+#include <string.h>
+#include <errno.h>
+#include <math.h>
+#include "util.h"
+#include "chunks.h"
+
+struct ChunkWriter {
+    FILE* output;
+    uint64_t offset;  // current end of file
+
+    tuple_t* pkts;  // packets of the current chunk
+    uint64_t n;
+    uint32_t* ips;
+    uint8_t* buf;
+
+    chunk_index_t* index;
+    uint64_t n_chunks;
+    uint64_t index_cap;
+    uint64_t n_pkts;
+};
+
+static inline uint8_t* put_varint(uint8_t* q, uint64_t v) {
+    while (v >= 0x80) {
+        *q++ = (uint8_t)(v | 0x80);
+        v >>= 7;
+    }
+    *q++ = (uint8_t)v;
+    return q;
+}
+
+static inline uint64_t zigzag(int64_t v) {
+    return ((uint64_t)v << 1) ^ (uint64_t)(v >> 63);
+}
+
+static inline int64_t ts_us(double ts) {
+    return llround(ts * 1e6);
+}
+
+static int cmp_u32(const void* a, const void* b) {
+    uint32_t x = *(const uint32_t*)a, y = *(const uint32_t*)b;
+    return x < y ? -1 : x > y;
+}
+
+static uint64_t ip_id(const uint32_t* ips, uint64_t n, uint32_t ip) {
+    uint64_t l = 0, r = n;
+    while (l + 1 < r) {
+        uint64_t m = (l + r) / 2;
+        if (ips[m] <= ip) {
+            l = m;
+        } else {
+            r = m;
+        }
+    }
+    return l;
+}
+
+static void write_all(chunk_writer_t* w, const void* data, size_t size) {
+    if (fwrite(data, 1, size, w->output) != size) {
+        LOG_ERR("fwrite: %s\n", strerror(errno));
+    }
+    w->offset += size;
+}
+
+static void flush_chunk(chunk_writer_t* w) {
+    if (w->n == 0) {
+        return;
+    }
+
+    uint64_t n_ips = 0;
+    for (uint64_t i = 0; i < w->n; i++) {
+        w->ips[n_ips++] = w->pkts[i].key.src_ip;
+        w->ips[n_ips++] = w->pkts[i].key.dst_ip;
+    }
+    qsort(w->ips, n_ips, sizeof(uint32_t), cmp_u32);
+    uint64_t m = 0;
+    for (uint64_t i = 0; i < n_ips; i++) {
+        if (m == 0 || w->ips[m - 1] != w->ips[i]) {
+            w->ips[m++] = w->ips[i];
+        }
+    }
+    n_ips = m;
+
+    uint8_t* q = w->buf;
+    int64_t last_ts = ts_us(w->pkts[0].pkt_ts);
+    memcpy(q, &last_ts, sizeof(last_ts));
+    q += sizeof(last_ts);
+    q = put_varint(q, n_ips);
+    for (uint64_t i = 0; i < n_ips; i++) {
+        q = put_varint(q, i == 0 ? w->ips[0] : w->ips[i] - w->ips[i - 1]);
+    }
+    for (uint64_t i = 0; i < w->n; i++) {
+        const tuple_t* p = &w->pkts[i];
+        int64_t ts = ts_us(p->pkt_ts);
+        q = put_varint(q, zigzag(ts - last_ts));
+        last_ts = ts;
+        q = put_varint(q, ip_id(w->ips, n_ips, p->key.src_ip));
+        q = put_varint(q, ip_id(w->ips, n_ips, p->key.dst_ip));
+        q = put_varint(q, p->key.src_port);
+        q = put_varint(q, p->key.dst_port);
+        q = put_varint(q, zigzag(p->size));
+        *q++ = p->key.proto;
+        memcpy(q, &p->tcp_ack, 4);
+        memcpy(q + 4, &p->tcp_seq, 4);
+        q += 8;
+        *q++ = p->tcp_flag;
+        *q++ = p->ip_hdr_size;
+        *q++ = p->tcp_hdr_size;
+    }
+
+    if (w->n_chunks == w->index_cap) {
+        w->index_cap = w->index_cap ? w->index_cap * 2 : 64;
+        w->index = realloc(w->index, w->index_cap * sizeof(chunk_index_t));
+    }
+    chunk_index_t* e = &w->index[w->n_chunks++];
+    e->offset = w->offset;
+    e->size = q - w->buf;
+    e->first_pkt = w->n_pkts;
+    e->n_pkts = w->n;
+    write_all(w, w->buf, e->size);
+
+    w->n_pkts += w->n;
+    w->n = 0;
+}
+
+chunk_writer_t* chunk_writer_open(const char* path) {
+    chunk_writer_t* w = calloc(1, sizeof(chunk_writer_t));
+    w->output = fopen(path, "wb");
+    if (w->output == NULL) {
+        LOG_ERR("cannot open %s: %s\n", path, strerror(errno));
+    }
+    w->pkts = malloc(CHUNK_PKTS * sizeof(tuple_t));
+    w->ips = malloc(2 * CHUNK_PKTS * sizeof(uint32_t));
+    // worst case: 8 bytes timestamp, dictionary of 2 IPs per packet and 45
+    // bytes per packet record
+    w->buf = malloc(16 + CHUNK_PKTS * (2 * 5 + 45));
+
+    // the header is rewritten once the index location is known
+    chunk_trace_header_t hdr;
+    memset(&hdr, 0, sizeof(hdr));
+    write_all(w, &hdr, sizeof(hdr));
+    return w;
+}
+
+void chunk_writer_put(chunk_writer_t* w, const tuple_t* p) {
+    w->pkts[w->n++] = *p;
+    if (w->n == CHUNK_PKTS) {
+        flush_chunk(w);
+    }
+}
+
+void chunk_writer_close(chunk_writer_t* w) {
+    flush_chunk(w);
+
+    chunk_trace_header_t hdr;
+    memcpy(hdr.magic, CHUNK_TRACE_MAGIC, sizeof(hdr.magic));
+    hdr.n_pkts = w->n_pkts;
+    hdr.n_chunks = w->n_chunks;
+    hdr.index_offset = w->offset;
+    write_all(w, w->index, w->n_chunks * sizeof(chunk_index_t));
+    if (fseek(w->output, 0, SEEK_SET) < 0) {
+        LOG_ERR("fseek: %s\n", strerror(errno));
+    }
+    write_all(w, &hdr, sizeof(hdr));
+    if (fclose(w->output) != 0) {
+        LOG_ERR("fclose: %s\n", strerror(errno));
+    }
+
+    free(w->pkts);
+    free(w->ips);
+    free(w->buf);
+    free(w->index);
+    free(w);
+}
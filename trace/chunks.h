@@ -0,0 +1,50 @@
+#ifndef __CHUNKS_H__
+#define __CHUNKS_H__
+#include <stdio.h>
+#include <stdint.h>
+#include "tuple.h"
+
+/*
+ * Compressed chunked trace container. Must match readChunkTrace() in
+ * search/include/Trace.hpp.
+ *
+ * The file starts with a chunk_trace_header_t whose index_offset points to
+ * n_chunks chunk_index_t entries stored after the last chunk. Each chunk holds
+ * up to CHUNK_PKTS packets and decodes independently:
+ *
+ *   int64   first timestamp in microseconds
+ *   varint  number of distinct IP addresses in the chunk
+ *   varint  sorted IP dictionary, delta-encoded
+ *   per packet:
+ *     varint  zigzag timestamp delta (us), src/dst IP dictionary index,
+ *             src/dst port, zigzag size
+ *     u8      proto
+ *     u32     tcp_ack, tcp_seq
+ *     u8      tcp_flag, ip_hdr_size, tcp_hdr_size
+ *
+ * Timestamps are stored with the microsecond resolution of pcap files.
+ */
+#define CHUNK_TRACE_MAGIC "ASCHKTR1"
+#define CHUNK_PKTS (1 << 16)
+
+typedef struct ChunkTraceHeader {
+    char magic[8];
+    uint64_t n_pkts;
+    uint64_t n_chunks;
+    uint64_t index_offset;
+} chunk_trace_header_t;
+
+typedef struct ChunkIndex {
+    uint64_t offset;     // byte offset of the chunk in the file
+    uint64_t size;       // encoded size in bytes
+    uint64_t first_pkt;  // index of the first packet of the chunk
+    uint64_t n_pkts;
+} chunk_index_t;
+
+typedef struct ChunkWriter chunk_writer_t;
+
+chunk_writer_t* chunk_writer_open(const char* path);
+void chunk_writer_put(chunk_writer_t* w, const tuple_t* p);
+void chunk_writer_close(chunk_writer_t* w);
+
+#endif
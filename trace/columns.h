@@ -0,0 +1,36 @@
+#ifndef __COLUMNS_H__
+#define __COLUMNS_H__
+#include <stdint.h>
+
+/*
+ * Columnar trace layout: a header followed by one contiguous array per
+ * tuple_t field. Must match ColumnTrace in search/include/Trace.hpp.
+ */
+#define COLUMN_TRACE_MAGIC "ASCOLTR1"
+#define COLUMN_ALIGN 64
+
+enum TRACE_COLUMN {
+    COL_SRC_IP = 0,
+    COL_DST_IP,
+    COL_SRC_PORT,
+    COL_DST_PORT,
+    COL_PROTO,
+    COL_SIZE,
+    COL_TCP_ACK,
+    COL_TCP_SEQ,
+    COL_TCP_FLAG,
+    COL_PKT_TS,
+    COL_IP_HDR_SIZE,
+    COL_TCP_HDR_SIZE,
+    N_COLUMNS
+};
+
+static const uint64_t column_widths[N_COLUMNS] = {4, 4, 2, 2, 1, 4, 4, 4, 1, 8, 1, 1};
+
+typedef struct ColumnTraceHeader {
+    char magic[8];
+    uint64_t n_pkts;
+    uint64_t offsets[N_COLUMNS];  // byte offset of each column in the file
+} column_trace_header_t;
+
+#endif
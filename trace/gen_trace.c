@@ -0,0 +1,426 @@
+//
+// Generates a synthetic trace (.bin, an array of tuple_t) for benchmarking
+// without a captured one.
+//
+// Background traffic is a fixed set of flows whose packets are drawn with
+// Zipf-distributed popularity; TCP flows open with a complete handshake.
+// Attacks are injected in every epoch with the shapes the example queries
+// look for:
+//
+//   --syn-flood H:F       H servers each answer F spoofed SYNs with a
+//                         SYN-ACK that is never acknowledged
+//   --ddos H:F            H victims each receive packets from F sources
+//   --port-scan H:F       H scanners each probe F ports of one target
+//   --super-spreader H:F  H sources each contact F destinations
+//   --new-conn H:F        H servers each receive F new connections (SYN)
+//
+// The first packet is at 0 and the others are spread evenly over each epoch,
+// so epochs of the search agree with the epochs of the generator when its
+// interval is the epoch length.
+//
+
+#include <stdlib.h>
+#include <string.h>
+#include <math.h>
+#include <errno.h>
+#include <getopt.h>
+#include "util.h"
+#include "tuple.h"
+
+#define BATCH_SIZE (1 << 16)
+
+#define IP_PROTOCOLS_TCP 6
+#define IP_PROTOCOLS_UDP 17
+#define TCP_FLAG_SYN 0x02
+#define TCP_FLAG_PUSH 0x08
+#define TCP_FLAG_ACK 0x10
+
+#define TCP_RATIO 0.85
+#define HDR_SIZE 20
+
+enum AttackType {
+    ATTACK_SYN_FLOOD,
+    ATTACK_DDOS,
+    ATTACK_PORT_SCAN,
+    ATTACK_SUPER_SPREADER,
+    ATTACK_NEW_CONN,
+    N_ATTACKS
+};
+
+static const char* attack_names[N_ATTACKS] = {
+    "syn-flood", "ddos", "port-scan", "super-spreader", "new-conn",
+};
+
+struct Attack {
+    uint64_t n_hosts;
+    uint64_t fanout;     // packets (distinct peers) per host and epoch
+    uint32_t* hosts;
+    uint32_t* targets;   // target of each port scanner
+};
+
+struct Flow {
+    flow_key_t key;      // client to server
+    uint32_t client_seq;
+    uint32_t server_seq;
+    uint64_t n_pkts;     // packets sent so far
+};
+
+// splitmix64, so that a seed reproduces the same trace everywhere
+static uint64_t rng_state;
+
+static inline uint64_t rand_u64(void) {
+    uint64_t z = (rng_state += 0x9e3779b97f4a7c15ULL);
+    z = (z ^ (z >> 30)) * 0xbf58476d1ce4e5b9ULL;
+    z = (z ^ (z >> 27)) * 0x94d049bb133111ebULL;
+    return z ^ (z >> 31);
+}
+
+static inline double rand_unit(void) {
+    return (rand_u64() >> 11) * (1.0 / (1ULL << 53));
+}
+
+static inline uint64_t rand_below(uint64_t n) {
+    return rand_u64() % n;
+}
+
+static inline uint16_t rand_port(void) {
+    return 1024 + rand_below(65536 - 1024);
+}
+
+static void usage(const char* prog) {
+    printf("usage: %s [options] -o output.bin\n"
+           "  -n, --epochs N          number of epochs (default: 10)\n"
+           "  -l, --epoch-len S       epoch length in seconds (default: 0.5)\n"
+           "  -r, --rate R            packets per second (default: 200000)\n"
+           "  -f, --flows N           background flows (default: 100000)\n"
+           "  -S, --servers N         servers of the background flows (default: flows / 10)\n"
+           "  -z, --zipf S            Zipf skew of flow popularity (default: 1.0)\n"
+           "  -s, --seed N            random seed (default: 1)\n"
+           "  -o, --output F          output trace file\n"
+           "      --syn-flood H:F     H servers flooded with F unacknowledged SYN-ACKs\n"
+           "      --ddos H:F          H victims contacted by F sources\n"
+           "      --port-scan H:F     H scanners probing F ports\n"
+           "      --super-spreader H:F\n"
+           "                          H sources contacting F destinations\n"
+           "      --new-conn H:F      H servers receiving F new connections\n"
+           "Attacks are repeated in every epoch.\n",
+           prog);
+}
+
+static void parse_attack(struct Attack* a, const char* name, const char* arg) {
+    char* end;
+    a->n_hosts = strtoull(arg, &end, 10);
+    if (*end != ':' || a->n_hosts == 0) {
+        LOG_ERR("invalid --%s '%s', expected HOSTS:FANOUT\n", name, arg);
+    }
+    a->fanout = strtoull(end + 1, &end, 10);
+    if (*end != '\0' || a->fanout == 0) {
+        LOG_ERR("invalid --%s '%s', expected HOSTS:FANOUT\n", name, arg);
+    }
+}
+
+// Cumulative Zipf distribution over n ranks.
+static double* zipf_cdf(uint64_t n, double skew) {
+    double* cdf = malloc(n * sizeof(double));
+    double sum = 0;
+    for (uint64_t i = 0; i < n; i++) {
+        sum += 1.0 / pow(i + 1, skew);
+        cdf[i] = sum;
+    }
+    for (uint64_t i = 0; i < n; i++) {
+        cdf[i] /= sum;
+    }
+    return cdf;
+}
+
+static uint64_t zipf_sample(const double* cdf, uint64_t n) {
+    double u = rand_unit();
+    uint64_t lo = 0, hi = n - 1;
+    while (lo < hi) {
+        uint64_t mid = (lo + hi) / 2;
+        if (cdf[mid] < u) {
+            lo = mid + 1;
+        } else {
+            hi = mid;
+        }
+    }
+    return lo;
+}
+
+static void set_pkt(tuple_t* p, uint32_t src_ip, uint32_t dst_ip, uint16_t src_port, uint16_t dst_port,
+                    uint8_t proto, int32_t size) {
+    memset(p, 0, sizeof(*p));
+    p->key.src_ip = src_ip;
+    p->key.dst_ip = dst_ip;
+    p->key.src_port = src_port;
+    p->key.dst_port = dst_port;
+    p->key.proto = proto;
+    p->size = size;
+    p->ip_hdr_size = HDR_SIZE;
+    if (proto == IP_PROTOCOLS_TCP) {
+        p->tcp_hdr_size = HDR_SIZE;
+    }
+}
+
+static void set_tcp(tuple_t* p, uint8_t flag, uint32_t seq, uint32_t ack) {
+    p->tcp_flag = flag;
+    p->tcp_seq = seq;
+    p->tcp_ack = ack;
+}
+
+static int32_t data_size(void) {
+    // roughly bimodal, like most backbone traces
+    return rand_unit() < 0.5 ? 1500 : 2 * HDR_SIZE + rand_below(537);
+}
+
+// Next packet of a background flow: SYN, SYN-ACK and ACK, then data in both
+// directions. UDP flows only carry data.
+static void flow_pkt(tuple_t* p, struct Flow* f) {
+    const flow_key_t* k = &f->key;
+    if (k->proto != IP_PROTOCOLS_TCP) {
+        set_pkt(p, k->src_ip, k->dst_ip, k->src_port, k->dst_port, k->proto, 28 + rand_below(1373));
+        f->n_pkts++;
+        return;
+    }
+    int to_server = f->n_pkts % 2 == 0;
+    if (to_server) {
+        set_pkt(p, k->src_ip, k->dst_ip, k->src_port, k->dst_port, k->proto, 2 * HDR_SIZE);
+    } else {
+        set_pkt(p, k->dst_ip, k->src_ip, k->dst_port, k->src_port, k->proto, 2 * HDR_SIZE);
+    }
+    switch (f->n_pkts) {
+        case 0:
+            set_tcp(p, TCP_FLAG_SYN, f->client_seq, 0);
+            break;
+        case 1:
+            set_tcp(p, TCP_FLAG_SYN | TCP_FLAG_ACK, f->server_seq, f->client_seq + 1);
+            break;
+        case 2:
+            set_tcp(p, TCP_FLAG_ACK, f->client_seq + 1, f->server_seq + 1);
+            break;
+        default:
+            p->size = data_size();
+            if (to_server) {
+                set_tcp(p, TCP_FLAG_ACK | TCP_FLAG_PUSH, f->client_seq + 1, f->server_seq + 1);
+            } else {
+                set_tcp(p, TCP_FLAG_ACK | TCP_FLAG_PUSH, f->server_seq + 1, f->client_seq + 1);
+            }
+            break;
+    }
+    f->n_pkts++;
+}
+
+// Writes the attack packets of one epoch to pkts and returns their number.
+static uint64_t attack_pkts(tuple_t* pkts, const struct Attack* attacks) {
+    uint64_t n = 0;
+    for (int t = 0; t < N_ATTACKS; t++) {
+        const struct Attack* a = &attacks[t];
+        for (uint64_t h = 0; h < a->n_hosts; h++) {
+            uint32_t host = a->hosts[h];
+            for (uint64_t i = 0; i < a->fanout; i++) {
+                uint32_t peer = (uint32_t)rand_u64();
+                uint16_t port = rand_port();
+                uint32_t seq = (uint32_t)rand_u64();
+                tuple_t* p = &pkts[n++];
+                switch (t) {
+                    case ATTACK_SYN_FLOOD:
+                        set_pkt(p, peer, host, port, 80, IP_PROTOCOLS_TCP, 2 * HDR_SIZE);
+                        set_tcp(p, TCP_FLAG_SYN, seq, 0);
+                        p = &pkts[n++];
+                        set_pkt(p, host, peer, 80, port, IP_PROTOCOLS_TCP, 2 * HDR_SIZE);
+                        set_tcp(p, TCP_FLAG_SYN | TCP_FLAG_ACK, (uint32_t)rand_u64(), seq + 1);
+                        break;
+                    case ATTACK_DDOS:
+                        set_pkt(p, peer, host, port, 53, IP_PROTOCOLS_UDP, data_size());
+                        break;
+                    case ATTACK_PORT_SCAN:
+                        set_pkt(p, host, a->targets[h], port, i % 65535 + 1, IP_PROTOCOLS_TCP, 2 * HDR_SIZE);
+                        set_tcp(p, TCP_FLAG_SYN, seq, 0);
+                        break;
+                    case ATTACK_SUPER_SPREADER:
+                        set_pkt(p, host, peer, port, 53, IP_PROTOCOLS_UDP, 28 + rand_below(100));
+                        break;
+                    case ATTACK_NEW_CONN:
+                        set_pkt(p, peer, host, port, 443, IP_PROTOCOLS_TCP, 2 * HDR_SIZE);
+                        set_tcp(p, TCP_FLAG_SYN, seq, 0);
+                        break;
+                }
+            }
+        }
+    }
+    // spread the attacks over the whole epoch
+    for (uint64_t i = n; i > 1; i--) {
+        uint64_t j = rand_below(i);
+        tuple_t tmp = pkts[i - 1];
+        pkts[i - 1] = pkts[j];
+        pkts[j] = tmp;
+    }
+    return n;
+}
+
+/*
+ * Main program
+ */
+int main(int argc, char** argv) {
+    static const struct option long_options[] = {
+        {"epochs", required_argument, NULL, 'n'},
+        {"epoch-len", required_argument, NULL, 'l'},
+        {"rate", required_argument, NULL, 'r'},
+        {"flows", required_argument, NULL, 'f'},
+        {"servers", required_argument, NULL, 'S'},
+        {"zipf", required_argument, NULL, 'z'},
+        {"seed", required_argument, NULL, 's'},
+        {"output", required_argument, NULL, 'o'},
+        {"syn-flood", required_argument, NULL, 256 + ATTACK_SYN_FLOOD},
+        {"ddos", required_argument, NULL, 256 + ATTACK_DDOS},
+        {"port-scan", required_argument, NULL, 256 + ATTACK_PORT_SCAN},
+        {"super-spreader", required_argument, NULL, 256 + ATTACK_SUPER_SPREADER},
+        {"new-conn", required_argument, NULL, 256 + ATTACK_NEW_CONN},
+        {NULL, 0, NULL, 0},
+    };
+    uint64_t n_epochs = 10;
+    double epoch_len = 0.5;
+    double rate = 200000;
+    uint64_t n_flows = 100000;
+    uint64_t n_servers = 0;
+    double skew = 1.0;
+    uint64_t seed = 1;
+    const char* output_name = NULL;
+    struct Attack attacks[N_ATTACKS];
+    memset(attacks, 0, sizeof(attacks));
+    int opt;
+    while ((opt = getopt_long(argc, argv, "n:l:r:f:S:z:s:o:", long_options, NULL)) != -1) {
+        switch (opt) {
+            case 'n':
+                n_epochs = strtoull(optarg, NULL, 10);
+                break;
+            case 'l':
+                epoch_len = atof(optarg);
+                break;
+            case 'r':
+                rate = atof(optarg);
+                break;
+            case 'f':
+                n_flows = strtoull(optarg, NULL, 10);
+                break;
+            case 'S':
+                n_servers = strtoull(optarg, NULL, 10);
+                break;
+            case 'z':
+                skew = atof(optarg);
+                break;
+            case 's':
+                seed = strtoull(optarg, NULL, 10);
+                break;
+            case 'o':
+                output_name = optarg;
+                break;
+            default:
+                if (opt >= 256 && opt < 256 + N_ATTACKS) {
+                    parse_attack(&attacks[opt - 256], attack_names[opt - 256], optarg);
+                    break;
+                }
+                usage(argv[0]);
+                return 0;
+        }
+    }
+    if (output_name == NULL || optind != argc || n_epochs == 0 || epoch_len <= 0 || rate <= 0 || n_flows == 0) {
+        usage(argv[0]);
+        return 0;
+    }
+    if (n_servers == 0) {
+        n_servers = n_flows >= 10 ? n_flows / 10 : 1;
+    }
+    rng_state = seed;
+
+    uint64_t pkts_per_epoch = (uint64_t)llround(rate * epoch_len);
+    uint64_t n_attack = 0;
+    for (int t = 0; t < N_ATTACKS; t++) {
+        struct Attack* a = &attacks[t];
+        a->hosts = malloc((a->n_hosts + 1) * sizeof(uint32_t));
+        a->targets = malloc((a->n_hosts + 1) * sizeof(uint32_t));
+        for (uint64_t h = 0; h < a->n_hosts; h++) {
+            a->hosts[h] = (uint32_t)rand_u64();
+            a->targets[h] = (uint32_t)rand_u64();
+        }
+        n_attack += a->n_hosts * a->fanout * (t == ATTACK_SYN_FLOOD ? 2 : 1);
+    }
+    if (n_attack > pkts_per_epoch) {
+        LOG_ERR("attacks need %lu packets per epoch, but the rate only allows %lu\n", n_attack, pkts_per_epoch);
+    }
+
+    uint32_t* servers = malloc(n_servers * sizeof(uint32_t));
+    for (uint64_t i = 0; i < n_servers; i++) {
+        servers[i] = (uint32_t)rand_u64();
+    }
+    struct Flow* flows = malloc(n_flows * sizeof(struct Flow));
+    for (uint64_t i = 0; i < n_flows; i++) {
+        struct Flow* f = &flows[i];
+        memset(f, 0, sizeof(*f));
+        f->key.src_ip = (uint32_t)rand_u64();
+        f->key.dst_ip = servers[rand_below(n_servers)];
+        f->key.src_port = rand_port();
+        if (rand_unit() < TCP_RATIO) {
+            f->key.proto = IP_PROTOCOLS_TCP;
+            f->key.dst_port = rand_unit() < 0.5 ? 443 : 80;
+        } else {
+            f->key.proto = IP_PROTOCOLS_UDP;
+            f->key.dst_port = 53;
+        }
+        f->client_seq = (uint32_t)rand_u64();
+        f->server_seq = (uint32_t)rand_u64();
+    }
+    double* cdf = zipf_cdf(n_flows, skew);
+
+    FILE* output = fopen(output_name, "wb");
+    if (output == NULL) {
+        LOG_ERR("cannot open %s: %s\n", output_name, strerror(errno));
+    }
+    tuple_t* attack = malloc((n_attack + 1) * sizeof(tuple_t));
+    tuple_t* batch = malloc(BATCH_SIZE * sizeof(tuple_t));
+    size_t len = 0;
+    uint64_t start_time = now_us();
+
+    for (uint64_t e = 0; e < n_epochs; e++) {
+        uint64_t n = attack_pkts(attack, attacks);
+        uint64_t next_attack = 0;
+        for (uint64_t i = 0; i < pkts_per_epoch; i++) {
+            tuple_t* p = &batch[len++];
+            // selection sampling keeps the attack packets in their order
+            if (rand_below(pkts_per_epoch - i) < n - next_attack) {
+                *p = attack[next_attack++];
+            } else {
+                flow_pkt(p, &flows[zipf_sample(cdf, n_flows)]);
+            }
+            // the search starts its first epoch at the first packet
+            p->pkt_ts = e == 0 && i == 0 ? 0 : (e + (i + rand_unit()) / pkts_per_epoch) * epoch_len;
+            if (len == BATCH_SIZE) {
+                if (fwrite(batch, sizeof(tuple_t), len, output) != len) {
+                    LOG_ERR("fwrite: %s\n", strerror(errno));
+                }
+                len = 0;
+            }
+        }
+    }
+    // the search closes an epoch at the first packet after it, which the last
+    // one would not have
+    flow_pkt(&batch[len], &flows[zipf_sample(cdf, n_flows)]);
+    batch[len++].pkt_ts = n_epochs * epoch_len;
+    if (fwrite(batch, sizeof(tuple_t), len, output) != len || fclose(output) != 0) {
+        LOG_ERR("cannot write %s: %s\n", output_name, strerror(errno));
+    }
+
+    LOG_MSG("generated %lu packets (%lu attack packets per epoch) in %.2lf s\n",
+            n_epochs * pkts_per_epoch + 1, n_attack, (now_us() - start_time) / 1.0e6);
+
+    for (int t = 0; t < N_ATTACKS; t++) {
+        free(attacks[t].hosts);
+        free(attacks[t].targets);
+    }
+    free(servers);
+    free(flows);
+    free(cdf);
+    free(attack);
+    free(batch);
+    return 0;
+}
@@ -1,6 +1,6 @@
 #include "packet.h"
 
-extern struct PacketStat packet_stat;
+__thread struct PacketStat packet_stat;
 
 void report_final_stat_file(const char* filename) {
   FILE* output = fopen(filename, "w");
@@ -61,7 +61,10 @@ struct PacketStat {
   // uint64_t packets_cnt_of_version[100];
   // uint64_t packets_size_of_version[100];
   // uint64_t packets_totallen_of_version[2000];
-}packet_stat;
+};
+
+// per-thread, so that several threads can decode() at the same time
+extern __thread struct PacketStat packet_stat;
 
 extern uint64_t seq_count;
 
@@ -6,71 +6,373 @@
 #include <string.h>
 #include <pcap.h>
 #include <errno.h>
+#include <limits.h>
+#include <glob.h>
+#include <getopt.h>
+#include <pthread.h>
 #include "util.h"
 #include "packet.h"
+#include "chunks.h"
 
+#define BATCH_SIZE (1 << 16)            // tuples per write/read batch
+#define IO_BUFFER_SIZE (8 * MB)         // stdio buffer of each output stream
+#define MIN_COPY_LEN 128                // shorter packets are decoded from a copy
 
+struct Input {
+    const char* pcap_filename;
+    char run_filename[PATH_MAX];        // decoded tuples of this input, in file order
+    struct PacketStat stat;
+    uint64_t valid_cnt;
+};
+
+struct Job {
+    struct Input* inputs;
+    size_t n_inputs;
+    size_t next;                        // next input to decode
+    pthread_mutex_t mtx;
+};
+
+struct RunReader {
+    FILE* f;
+    tuple_t* batch;
+    size_t len;
+    size_t pos;
+};
+
+struct TupleWriter {
+    FILE* output;
+    chunk_writer_t* chunk_writer;
+    tuple_t* batch;
+    size_t len;
+};
+
+static void usage(const char* prog) {
+    printf("usage: %s [-j threads] [--chunked] -o output input.pcap|'glob'...\n"
+           "  -j, --threads N   decode N input files in parallel (default: all cores)\n"
+           "  -c, --chunked     write a compressed chunked trace instead of a .bin\n"
+           "  -o, --output F    output trace file\n",
+           prog);
+}
+
+static FILE* open_buffered(const char* path, const char* mode) {
+    FILE* f = fopen(path, mode);
+    if (f == NULL) {
+        LOG_ERR("cannot open %s: %s\n", path, strerror(errno));
+    }
+    setvbuf(f, NULL, _IOFBF, IO_BUFFER_SIZE);
+    return f;
+}
+
+static void writer_flush(struct TupleWriter* w) {
+    if (w->chunk_writer == NULL && w->len > 0 &&
+        fwrite(w->batch, sizeof(tuple_t), w->len, w->output) != w->len) {
+        LOG_ERR("fwrite: %s\n", strerror(errno));
+    }
+    w->len = 0;
+}
+
+static inline void writer_put(struct TupleWriter* w, const tuple_t* p) {
+    if (w->chunk_writer != NULL) {
+        chunk_writer_put(w->chunk_writer, p);
+        return;
+    }
+    w->batch[w->len++] = *p;
+    if (w->len == BATCH_SIZE) {
+        writer_flush(w);
+    }
+}
+
+/*
+ * Decode one pcap file into its run file
+ */
+static void decode_input(struct Input* in) {
+    char errbuf[PCAP_ERRBUF_SIZE];
+    pcap_t* pcap = pcap_open_offline(in->pcap_filename, errbuf);
+    if (pcap == NULL) {
+        LOG_ERR("cannot open %s (%s)\n", in->pcap_filename, errbuf);
+    }
+
+    struct TupleWriter w = {
+        .output = open_buffered(in->run_filename, "wb"),
+        .chunk_writer = NULL,
+        .batch = malloc(BATCH_SIZE * sizeof(tuple_t)),
+        .len = 0,
+    };
+    reset_stat();
+    uint64_t start_time = now_us();
+
+    tuple_t p;
+    memset(&p, 0, sizeof(struct Tuple));
+    uint8_t pkt_data[MIN_COPY_LEN];
+    struct pcap_pkthdr* hdr;
+    const u_char* pkt;
+    int rc;
+    while ((rc = pcap_next_ex(pcap, &hdr, &pkt)) == 1) {
+        double pkt_ts = (double)hdr->ts.tv_usec / 1000000 + hdr->ts.tv_sec;
+        int pkt_len = hdr->caplen < MAX_CAPLEN ? hdr->caplen : MAX_CAPLEN;
+        if (pkt_len < MIN_COPY_LEN) {
+            // decode() may look at header fields past a truncated capture
+            memset(pkt_data, 0, sizeof(pkt_data));
+            memcpy(pkt_data, pkt, pkt_len);
+            pkt = pkt_data;
+        }
+
+        if (decode(pkt, pkt_len, hdr->len, pkt_ts, &p) == STATUS_VALID) {
+            in->valid_cnt++;
+            writer_put(&w, &p);
+        }
+    }
+    if (rc == -1) {
+        LOG_ERR("cannot read %s (%s)\n", in->pcap_filename, pcap_geterr(pcap));
+    }
+
+    writer_flush(&w);
+    if (fclose(w.output) != 0) {
+        LOG_ERR("cannot write %s: %s\n", in->run_filename, strerror(errno));
+    }
+    free(w.batch);
+    pcap_close(pcap);
+
+    packet_stat.used_time = now_us() - start_time;
+    in->stat = packet_stat;
+    LOG_MSG("decoded %s: %lu valid packets\n", in->pcap_filename, in->valid_cnt);
+}
+
+static void* decode_thread(void* arg) {
+    struct Job* job = arg;
+    while (1) {
+        pthread_mutex_lock(&job->mtx);
+        size_t i = job->next++;
+        pthread_mutex_unlock(&job->mtx);
+        if (i >= job->n_inputs) {
+            break;
+        }
+        decode_input(&job->inputs[i]);
+    }
+    return NULL;
+}
+
+static void merge_stat(struct PacketStat* dst, const struct PacketStat* src) {
+    int first = dst->tot_pkt_cnt == 0;
+    dst->tot_pkt_cnt += src->tot_pkt_cnt;
+    dst->tot_cap_byte_cnt += src->tot_cap_byte_cnt;
+    dst->tot_act_byte_cnt += src->tot_act_byte_cnt;
+    dst->valid_pkt_cnt += src->valid_pkt_cnt;
+    dst->valid_cap_byte_cnt += src->valid_cap_byte_cnt;
+    dst->valid_act_byte_cnt += src->valid_act_byte_cnt;
+    dst->non_ip_cnt += src->non_ip_cnt;
+    dst->ip_with_option_cnt += src->ip_with_option_cnt;
+    dst->ip_not_full_cnt += src->ip_not_full_cnt;
+    dst->ip_ver_fail_cnt += src->ip_ver_fail_cnt;
+    dst->ip_chksum_fail_cnt += src->ip_chksum_fail_cnt;
+    dst->ip_frag_cnt += src->ip_frag_cnt;
+    dst->tcp_not_full_cnt += src->tcp_not_full_cnt;
+    dst->udp_not_full_cnt += src->udp_not_full_cnt;
+    dst->icmp_not_full_cnt += src->icmp_not_full_cnt;
+    dst->undefined_cnt += src->undefined_cnt;
+    dst->non_gtp_cnt += src->non_gtp_cnt;
+    dst->non_gprs_cnt += src->non_gprs_cnt;
+    if (src->tot_pkt_cnt == 0) {
+        return;
+    }
+    if (first || src->trace_start_ts < dst->trace_start_ts) {
+        dst->trace_start_ts = src->trace_start_ts;
+    }
+    if (first || src->trace_end_ts > dst->trace_end_ts) {
+        dst->trace_end_ts = src->trace_end_ts;
+    }
+    if (src->max_packet_size > dst->max_packet_size) {
+        dst->max_packet_size = src->max_packet_size;
+    }
+}
+
+static int run_next(struct RunReader* r) {
+    if (r->pos == r->len) {
+        r->len = fread(r->batch, sizeof(tuple_t), BATCH_SIZE, r->f);
+        r->pos = 0;
+        if (r->len == 0) {
+            if (ferror(r->f)) {
+                LOG_ERR("fread: %s\n", strerror(errno));
+            }
+            return 0;
+        }
+    }
+    return 1;
+}
+
+static inline int run_less(struct RunReader* runs, size_t x, size_t y) {
+    double tx = runs[x].batch[runs[x].pos].pkt_ts;
+    double ty = runs[y].batch[runs[y].pos].pkt_ts;
+    return tx < ty || (tx == ty && x < y);
+}
+
+static void heap_down(struct RunReader* runs, size_t* heap, size_t n, size_t i) {
+    while (1) {
+        size_t m = i, l = 2 * i + 1, r = 2 * i + 2;
+        if (l < n && run_less(runs, heap[l], heap[m])) {
+            m = l;
+        }
+        if (r < n && run_less(runs, heap[r], heap[m])) {
+            m = r;
+        }
+        if (m == i) {
+            break;
+        }
+        size_t t = heap[i];
+        heap[i] = heap[m];
+        heap[m] = t;
+        i = m;
+    }
+}
+
+/*
+ * K-way merge of the run files by timestamp
+ */
+static void merge_runs(struct Input* inputs, size_t n_inputs, struct TupleWriter* w) {
+    struct RunReader* runs = calloc(n_inputs, sizeof(struct RunReader));
+    size_t* heap = malloc(n_inputs * sizeof(size_t));
+    size_t n = 0;
+    for (size_t i = 0; i < n_inputs; i++) {
+        // reads already come in large batches, skip the stdio buffer
+        runs[i].f = fopen(inputs[i].run_filename, "rb");
+        if (runs[i].f == NULL) {
+            LOG_ERR("cannot open %s: %s\n", inputs[i].run_filename, strerror(errno));
+        }
+        setvbuf(runs[i].f, NULL, _IONBF, 0);
+        runs[i].batch = malloc(BATCH_SIZE * sizeof(tuple_t));
+        if (run_next(&runs[i])) {
+            heap[n++] = i;
+        }
+    }
+    for (size_t i = n; i-- > 0;) {
+        heap_down(runs, heap, n, i);
+    }
+
+    while (n > 0) {
+        struct RunReader* r = &runs[heap[0]];
+        writer_put(w, &r->batch[r->pos++]);
+        if (!run_next(r)) {
+            heap[0] = heap[--n];
+        }
+        heap_down(runs, heap, n, 0);
+    }
+
+    for (size_t i = 0; i < n_inputs; i++) {
+        fclose(runs[i].f);
+        free(runs[i].batch);
+        remove(inputs[i].run_filename);
+    }
+    free(runs);
+    free(heap);
+}
 
 /*
  * Main program
  */
 int main(int argc, char** argv) {
-
-    if(argc != 4){
-        printf("you two three parameters: input file dir, input file name, output file name\n");
-        return 0;
+    static const struct option long_options[] = {
+        {"threads", required_argument, NULL, 'j'},
+        {"chunked", no_argument, NULL, 'c'},
+        {"output", required_argument, NULL, 'o'},
+        {NULL, 0, NULL, 0},
+    };
+    long n_threads = sysconf(_SC_NPROCESSORS_ONLN);
+    int chunked = 0;
+    const char* output_name = NULL;
+    int opt;
+    while ((opt = getopt_long(argc, argv, "j:co:", long_options, NULL)) != -1) {
+        switch (opt) {
+            case 'j':
+                n_threads = atol(optarg);
+                break;
+            case 'c':
+                chunked = 1;
+                break;
+            case 'o':
+                output_name = optarg;
+                break;
+            default:
+                usage(argv[0]);
+                return 1;
+        }
     }
-    const char* dir = argv[1];
-    const char* pcap_file = argv[2];
-    char pcap_filename[100];
-    sprintf(pcap_filename, "%s%s", dir, pcap_file);
-    pcap_t* pcap = NULL;
-    char errbuf[PCAP_ERRBUF_SIZE];
-    if ((pcap = pcap_open_offline(pcap_filename, errbuf)) == NULL) {
-        LOG_ERR("cannot open %s (%s)\n", pcap_filename, errbuf);
+    if (output_name == NULL || optind == argc || n_threads <= 0) {
+        usage(argv[0]);
+        return 1;
     }
 
-    const char* output_name = argv[3];
-    char tmp[100];
-    sprintf(tmp, "%s%s", dir, output_name);
-    FILE* output = fopen(tmp, "wb");
-    if (output == NULL) {
-        LOG_ERR("cannot open %s: %s\n", output_name, strerror(errno));
+    // expand quoted glob patterns, keep plain paths as they are
+    glob_t g;
+    memset(&g, 0, sizeof(g));
+    for (int i = optind; i < argc; i++) {
+        int flags = GLOB_NOCHECK | (i == optind ? 0 : GLOB_APPEND);
+        if (glob(argv[i], flags, NULL, &g) != 0) {
+            LOG_ERR("cannot expand %s\n", argv[i]);
+        }
     }
-//    const char* filename = conf_common_tracefile(conf);
-    tuple_t p;
-    memset(&p, 0, sizeof(struct Tuple));
+    size_t n_inputs = g.gl_pathc;
+    struct Input* inputs = calloc(n_inputs, sizeof(struct Input));
+    for (size_t i = 0; i < n_inputs; i++) {
+        inputs[i].pcap_filename = g.gl_pathv[i];
+        snprintf(inputs[i].run_filename, sizeof(inputs[i].run_filename), "%s.run%zu", output_name, i);
+    }
+
     uint64_t start_time = now_us();
+
+    struct Job job = {.inputs = inputs, .n_inputs = n_inputs, .next = 0};
+    pthread_mutex_init(&job.mtx, NULL);
+    if ((size_t)n_threads > n_inputs) {
+        n_threads = n_inputs;
+    }
+    pthread_t* threads = malloc(n_threads * sizeof(pthread_t));
+    for (long i = 0; i < n_threads; i++) {
+        pthread_create(&threads[i], NULL, decode_thread, &job);
+    }
+    for (long i = 0; i < n_threads; i++) {
+        pthread_join(threads[i], NULL);
+    }
+
+    reset_stat();
     uint64_t valid_cnt = 0;
-    while (1) {
-        double pkt_ts; // packet timestamp
-        int pkt_len; // packet snap length
-        const u_char* pkt; // raw packet
-        enum PACKET_STATUS status;
-        uint8_t pkt_data[MAX_CAPLEN];
-        struct pcap_pkthdr hdr;
-
-        pkt = pcap_next(pcap, &hdr);
-        if (pkt == NULL) {
-            break;
+    for (size_t i = 0; i < n_inputs; i++) {
+        merge_stat(&packet_stat, &inputs[i].stat);
+        valid_cnt += inputs[i].valid_cnt;
+    }
+
+    if (n_inputs == 1 && !chunked) {
+        // a single run is already in file order
+        if (rename(inputs[0].run_filename, output_name) != 0) {
+            LOG_ERR("cannot rename %s: %s\n", inputs[0].run_filename, strerror(errno));
         }
-        pkt_ts = (double)hdr.ts.tv_usec / 1000000 + hdr.ts.tv_sec;
-        pkt_len = hdr.caplen < MAX_CAPLEN ? hdr.caplen : MAX_CAPLEN;
-        memcpy(pkt_data, pkt, pkt_len);
-
-        status = decode(pkt_data, pkt_len, hdr.len, pkt_ts, &p);
-        if (status == STATUS_VALID) {
-            valid_cnt++;
-            fwrite(&p, sizeof(tuple_t), 1, output);
-//            uint64_t key = ((uint64_t)p.key.src_ip<<32) | p.key.dst_ip;
+    } else {
+        struct TupleWriter w = {
+            .output = NULL,
+            .chunk_writer = NULL,
+            .batch = malloc(BATCH_SIZE * sizeof(tuple_t)),
+            .len = 0,
+        };
+        if (chunked) {
+            w.chunk_writer = chunk_writer_open(output_name);
+        } else {
+            w.output = open_buffered(output_name, "wb");
         }
+        merge_runs(inputs, n_inputs, &w);
+        writer_flush(&w);
+        if (chunked) {
+            chunk_writer_close(w.chunk_writer);
+        } else if (fclose(w.output) != 0) {
+            LOG_ERR("cannot write %s: %s\n", output_name, strerror(errno));
+        }
+        free(w.batch);
     }
+    LOG_MSG("wrote %lu valid packets from %zu files to %s\n", valid_cnt, n_inputs, output_name);
 
-    uint64_t cur_ts = now_us();
-    packet_stat.used_time = cur_ts - start_time;
+    packet_stat.used_time = now_us() - start_time;
     report_final_stat();
 
-    pcap_close(pcap);
-    fclose(output);
+    pthread_mutex_destroy(&job.mtx);
+    free(threads);
+    free(inputs);
+    globfree(&g);
     return 0;
 }
@@ -0,0 +1,2 @@
+from .trace import PKT_DTYPE, FIELD_ALIASES, open_trace, epoch_offsets, epochs
+from .stats import packet_counts, distinct_counts, degrees, degree_distributions, heavy_counts
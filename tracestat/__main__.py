@@ -0,0 +1,63 @@
+import argparse
+import json
+
+import numpy as np
+
+from . import open_trace, epoch_offsets, packet_counts, distinct_counts, degree_distributions, heavy_counts
+
+
+def _fields(s: str):
+    return [f.strip() for f in s.split(',') if f.strip()]
+
+
+def _quantile(dist: np.ndarray, q: float) -> int:
+    """Degree at quantile q of a degree distribution (keys per degree)."""
+    cum = np.cumsum(dist)
+    return int(np.searchsorted(cum, q * cum[-1])) if cum.size and cum[-1] else 0
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(prog='python -m tracestat', description='per-epoch statistics of a .bin trace')
+    parser.add_argument("trace", type=str, help="trace file (.bin)")
+    parser.add_argument("--epochs", "-n", type=int, required=True, help="number of epochs, as nEpoch in conf.json")
+    parser.add_argument("--interval", "-t", type=float, required=True, help="epoch length, as interval in conf.json")
+    parser.add_argument("--distinct", "-d", type=str, action="append", default=[],
+                        help="comma-separated fields whose distinct combinations are counted, e.g. ipv4.src_addr,tcp.dport")
+    parser.add_argument("--degree", "-g", type=str, action="append", default=[],
+                        help="KEYS:VALUES, distinct values per key, e.g. ipv4.dst_addr:ipv4.src_addr")
+    parser.add_argument("--threshold", type=int, help="also count the keys whose degree is at least this")
+    parser.add_argument("--json", action="store_true", help="print one JSON object per epoch")
+    arg = parser.parse_args()
+
+    try:
+        pkts = open_trace(arg.trace)
+        offsets = epoch_offsets(pkts, arg.epochs, arg.interval)
+    except (OSError, ValueError) as e:
+        parser.error(str(e))
+    rows = [{'epoch': e, 'packets': int(n)} for e, n in enumerate(packet_counts(offsets))]
+
+    for s in arg.distinct:
+        for row, n in zip(rows, distinct_counts(pkts, offsets, _fields(s))):
+            row[f'distinct({s})'] = int(n)
+
+    for s in arg.degree:
+        keys, sep, values = s.partition(':')
+        if not sep:
+            parser.error(f'invalid --degree \'{s}\', expected KEYS:VALUES')
+        dists = degree_distributions(pkts, offsets, _fields(keys), _fields(values))
+        for row, dist in zip(rows, dists):
+            row[f'degree({s})'] = {
+                'keys': int(dist.sum()),
+                'p50': _quantile(dist, 0.5),
+                'p99': _quantile(dist, 0.99),
+                'max': dist.size - 1,
+            }
+        if arg.threshold is not None:
+            for row, n in zip(rows, heavy_counts(dists, arg.threshold)):
+                row[f'degree({s})'][f'>={arg.threshold}'] = int(n)
+
+    for row in rows:
+        if arg.json:
+            print(json.dumps(row))
+        else:
+            print(', '.join(f'{k} {v}' for k, v in row.items()))
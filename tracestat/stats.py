@@ -0,0 +1,54 @@
+from typing import Iterable, List, Sequence, Tuple
+
+import numpy as np
+
+from .trace import PKT_DTYPE, epochs, field_name
+
+
+def _keys(pkts: np.ndarray, fields: Sequence[str]) -> np.ndarray:
+    """One comparable scalar per packet for the given field combination."""
+    fields = [field_name(f) for f in fields]
+    if sum(PKT_DTYPE[f].itemsize for f in fields) <= 8 and 'pkt_ts' not in fields:
+        key = np.zeros(len(pkts), dtype=np.uint64)
+        for f in fields:
+            key <<= np.uint64(PKT_DTYPE[f].itemsize * 8)
+            key |= pkts[f].view(f'<u{PKT_DTYPE[f].itemsize}').astype(np.uint64)
+        return key
+    # wider combinations are compared as raw bytes
+    sub = np.empty(len(pkts), dtype=[(f, PKT_DTYPE[f]) for f in fields])
+    for f in fields:
+        sub[f] = pkts[f]
+    return sub.view(f'V{sub.dtype.itemsize}')
+
+
+def packet_counts(offsets: np.ndarray) -> np.ndarray:
+    """Number of packets in each epoch."""
+    return np.diff(offsets.astype(np.int64))
+
+
+def distinct_counts(pkts: np.ndarray, offsets: np.ndarray, fields: Sequence[str]) -> np.ndarray:
+    """Number of distinct values of the field combination in each epoch."""
+    return np.array([np.unique(_keys(p, fields)).size for p in epochs(pkts, offsets)], dtype=np.int64)
+
+
+def degrees(pkts: np.ndarray, key_fields: Sequence[str], value_fields: Sequence[str]) -> Tuple[np.ndarray, np.ndarray]:
+    """Distinct keys of some packets and the number of distinct values seen with each.
+
+    For example, the degrees of ['ipv4.dst_addr'] over ['ipv4.src_addr'] are
+    the fan-in counted by the DDoS example.
+    """
+    uniq_keys, key_idx = np.unique(_keys(pkts, key_fields), return_inverse=True)
+    uniq_values, value_idx = np.unique(_keys(pkts, value_fields), return_inverse=True)
+    pairs = np.unique(key_idx.ravel().astype(np.int64) * uniq_values.size + value_idx.ravel())
+    return uniq_keys, np.bincount(pairs // uniq_values.size, minlength=uniq_keys.size)
+
+
+def degree_distributions(pkts: np.ndarray, offsets: np.ndarray,
+                         key_fields: Sequence[str], value_fields: Sequence[str]) -> List[np.ndarray]:
+    """Per epoch, how many keys have each degree: result[e][d] keys of degree d."""
+    return [np.bincount(degrees(p, key_fields, value_fields)[1]) for p in epochs(pkts, offsets)]
+
+
+def heavy_counts(dists: Iterable[np.ndarray], threshold: int) -> np.ndarray:
+    """Per epoch, the number of keys whose degree is at least threshold."""
+    return np.array([d[threshold:].sum() for d in dists], dtype=np.int64)
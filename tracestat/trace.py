@@ -0,0 +1,91 @@
+import numpy as np
+
+# Flattened PktInfo (search/include/Trace.hpp, trace/tuple.h): packed, 36 bytes.
+PKT_DTYPE = np.dtype([
+    ('src_ip', '<u4'),
+    ('dst_ip', '<u4'),
+    ('src_port', '<u2'),
+    ('dst_port', '<u2'),
+    ('proto', 'u1'),
+    ('size', '<i4'),
+    ('tcp_ack', '<u4'),
+    ('tcp_seq', '<u4'),
+    ('tcp_flag', 'u1'),
+    ('pkt_ts', '<f8'),
+    ('ip_hdr_size', 'u1'),
+    ('tcp_hdr_size', 'u1'),
+])
+assert PKT_DTYPE.itemsize == 36
+
+# Field names of the query language, as in search/__init__.py.
+FIELD_ALIASES = {
+    'ipv4.src_addr': 'src_ip',
+    'ipv4.dst_addr': 'dst_ip',
+    'ipv4.protocol': 'proto',
+    'tcp.sport': 'src_port',
+    'tcp.dport': 'dst_port',
+    'tcp.src_port': 'src_port',
+    'tcp.dst_port': 'dst_port',
+    'tcp.timestamp': 'pkt_ts',
+    'tcp.flags': 'tcp_flag',
+    'tcp.flag': 'tcp_flag',
+    'tcp.seq': 'tcp_seq',
+    'tcp.ack': 'tcp_ack',
+}
+
+_MAGICS = {
+    b'ASCOLTR1': 'columnar',
+    b'ASCHKTR1': 'chunked',
+}
+
+
+def field_name(name: str) -> str:
+    name = FIELD_ALIASES.get(name, name)
+    if name not in PKT_DTYPE.names:
+        raise ValueError(f'unknown packet field \'{name}\'')
+    return name
+
+
+def open_trace(path: str) -> np.memmap:
+    """Maps a .bin trace read-only as a structured array of PKT_DTYPE."""
+    with open(path, 'rb') as fp:
+        kind = _MAGICS.get(fp.read(8))
+    if kind:
+        raise ValueError(f'\'{path}\' is a {kind} trace, convert a .bin trace instead')
+    pkts = np.memmap(path, dtype=np.uint8, mode='r')
+    if pkts.size % PKT_DTYPE.itemsize != 0:
+        raise ValueError(f'incorrect trace file length of \'{path}\'')
+    return pkts.view(PKT_DTYPE)
+
+
+def epoch_offsets(pkts: np.ndarray, n_epoch: int, interval: float) -> np.ndarray:
+    """Packet offsets of n_epoch epochs, n_epoch + 1 in total.
+
+    Epoch e covers pkts[offsets[e]:offsets[e + 1]]. The boundaries are the
+    ones buildEpochIndex() in search/include/Trace.hpp picks.
+    """
+    ts = pkts['pkt_ts']
+    n = ts.size
+    if n == 0:
+        raise ValueError('empty trace')
+    offsets = np.zeros(n_epoch + 1, dtype=np.uint64)
+    start = float(ts[0])
+    i = 0
+    for e in range(1, n_epoch + 1):
+        # same comparison as the C++ side, which is not quite ts >= start + interval
+        i = max(i, int(np.searchsorted(ts, start + interval)))
+        while i > offsets[e - 1] and ts[i - 1] - start >= interval:
+            i -= 1
+        while i < n and ts[i] - start < interval:
+            i += 1
+        if i == n:
+            raise ValueError(f'finished in epoch {e - 1}/{n_epoch}')
+        offsets[e] = i
+        start += interval
+    return offsets
+
+
+def epochs(pkts: np.ndarray, offsets: np.ndarray):
+    """Yields the packets of each epoch."""
+    for e in range(len(offsets) - 1):
+        yield pkts[int(offsets[e]):int(offsets[e + 1])]